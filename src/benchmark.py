@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks indexing, querying and crawling on a synthetic corpus and prints results as JSON, so that results of
+different versions can be compared. Everything runs locally: the index is kept by the local storage backend and pages
+are crawled from an HTTP server started in this process.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import string
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from collection import Collection
+from crawler import Webcrawler
+from document import LocalDocument
+from fetcher import Fetcher
+from frontier import Frontier
+from storage import LocalStorage
+
+PERCENTILES = (50, 95, 99)
+BOOLEAN_OPERATORS = ('AND', 'OR', 'AND NOT')
+
+
+def make_vocabulary(rng, size):
+    """
+    :return: list of size distinct pseudo words. Lower ranks get shorter words, like in natural languages
+    """
+    words = []
+    seen = set()
+    while len(words) < size:
+        length = 3 + min(int(rng.expovariate(0.5)), 9) + len(words) * 4 // size
+        word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def zipf_cum_weights(size, skew):
+    """
+    :return: cumulative weights of ranks 1..size of a Zipf distribution with exponent skew, for random.choices
+    """
+    cum_weights = []
+    total = 0
+    for rank in range(1, size + 1):
+        total += 1 / rank ** skew
+        cum_weights.append(total)
+    return cum_weights
+
+
+def generate_corpus(directory, documents, vocabulary, cum_weights, rng, words_per_document):
+    """
+    Writes documents with words drawn from vocabulary to directory
+    :return: tuple (list of paths of documents, set of words that were used)
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    used = set()
+    for i in range(documents):
+        length = max(1, int(rng.gauss(words_per_document, words_per_document / 4)))
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=length)
+        used.update(words)
+        path = os.path.join(directory, 'doc{:07d}.txt'.format(i))
+        with io.open(path, 'w', encoding='utf-8') as f:
+            # ten words per line
+            f.write('\n'.join(' '.join(words[j:j + 10]) for j in range(0, length, 10)))
+        paths.append(path)
+    return paths, used
+
+
+def generate_queries(vocabulary, cum_weights, rng, count):
+    """
+    :return: tuple (vector queries, boolean queries), each one a list of count queries
+    """
+    vector_queries = [' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(1, 4)))
+                      for _ in range(count)]
+    boolean_queries = []
+    for _ in range(count):
+        terms = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(1, 3))
+        query = terms[0]
+        for term in terms[1:]:
+            query += ' {} {}'.format(rng.choice(BOOLEAN_OPERATORS), term)
+        if rng.random() < 0.1:
+            query = 'NOT ' + query
+        boolean_queries.append(query)
+    return vector_queries, boolean_queries
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(dirname, filename))
+               for dirname, _, filenames in os.walk(directory) for filename in filenames)
+
+
+def latency_stats(latencies):
+    """
+    :param latencies: list of durations in seconds
+    :return: dict with count, mean and percentiles of latencies in milliseconds
+    """
+    latencies = sorted(latencies)
+    stats = {'count': len(latencies), 'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0}
+    for p in PERCENTILES:
+        # nearest-rank percentile
+        rank = max(0, -(-p * len(latencies) // 100) - 1)
+        stats['p{}_ms'.format(p)] = 1000 * latencies[rank] if latencies else 0
+    return stats
+
+
+def benchmark_index(paths, index_directory, workers):
+    # Whole corpus is held in memory till the end, so that memory of in-memory index is measured
+    collection = Collection(storage=LocalStorage(index_directory), flush_postings=0, flush_bytes=0)
+    start = time.perf_counter()
+    collection.read_documents([LocalDocument(path) for path in paths], workers=workers)
+    memory = collection.index.memory_size()
+    estimated_memory = collection.index.estimated_size
+    collection.flush_to_mongo()
+    elapsed = time.perf_counter() - start
+    collection.storage.close()
+    return {
+        'documents': len(paths),
+        'workers': workers,
+        'seconds': elapsed,
+        'documents_per_second': len(paths) / elapsed,
+        'input_bytes': sum(os.path.getsize(path) for path in paths),
+        'bytes_written': directory_size(index_directory),
+        'index_memory_bytes': memory,
+        'index_estimated_memory_bytes': estimated_memory,
+    }
+
+
+def benchmark_queries(index_directory, vector_queries, boolean_queries, top):
+    collection = Collection(storage=LocalStorage(index_directory))
+    results = dict()
+    for name, queries, process in (
+            ('vector', vector_queries, lambda q: collection.processquery_vector(q, top=top)),
+            ('boolean', boolean_queries, collection.processquery_boolean)):
+        latencies = []
+        for q in queries:
+            start = time.perf_counter()
+            process(q)
+            latencies.append(time.perf_counter() - start)
+        results[name] = latency_stats(latencies)
+    collection.storage.close()
+    return results
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _SiteHandler(BaseHTTPRequestHandler):
+    """ Serves pages of a synthetic site from memory, with keep-alive connections """
+    protocol_version = 'HTTP/1.1'
+    pages = dict()
+
+    def do_GET(self):
+        body = self.pages.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def generate_site(pages, vocabulary, cum_weights, rng, words_per_document, links_per_page):
+    """
+    :return: dict with paths as keys and html bodies as values. Every page is reachable from '/'
+    """
+    site = dict()
+    for i in range(pages):
+        path = '/' if i == 0 else '/page{}.html'.format(i)
+        # first link makes a chain over all pages, rest are random
+        targets = [i + 1] if i + 1 < pages else []
+        targets += [rng.randrange(pages) for _ in range(links_per_page - 1)]
+        links = ''.join('<a href="/page{}.html">link</a>\n'.format(t) for t in targets if t)
+        words = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=words_per_document))
+        html = '<html><head><title>Page {}</title></head><body>\n<p>{}</p>\n{}</body></html>'.format(i, words, links)
+        site[path] = html.encode('utf-8')
+    return site
+
+
+def benchmark_crawl(site, index_directory, max_connections):
+    handler = type('SiteHandler', (_SiteHandler,), {'pages': site})
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        collection = Collection(storage=LocalStorage(index_directory))
+        fetcher = Fetcher(max_connections=max_connections)
+        crawler = Webcrawler(['http://127.0.0.1:{}/'.format(server.server_address[1])], fetcher, Frontier())
+        start = time.perf_counter()
+        crawler.crawl(collection=collection)
+        collection.flush_to_mongo()
+        elapsed = time.perf_counter() - start
+        fetcher.close()
+        crawler.close()
+        documents = collection.get_documents_count()
+        collection.storage.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'pages': len(site),
+        'documents': documents,
+        'max_connections': max_connections,
+        'seconds': elapsed,
+        'pages_per_second': documents / elapsed,
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, args.vocabulary)
+    cum_weights = zipf_cum_weights(args.vocabulary, args.zipf)
+    work_directory = tempfile.mkdtemp(prefix='benchmark')
+    try:
+        results = {
+            'parameters': vars(args),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        }
+
+        paths, used = generate_corpus(os.path.join(work_directory, 'corpus'), args.documents, vocabulary, cum_weights,
+                                      rng, args.words)
+        index_directory = os.path.join(work_directory, 'index')
+        results['index'] = benchmark_index(paths, index_directory, args.workers)
+
+        # Queries use only words of corpus, since vector model does not accept unknown terms
+        query_vocabulary = [word for word in vocabulary if word in used]
+        vector_queries, boolean_queries = generate_queries(query_vocabulary,
+                                                           zipf_cum_weights(len(query_vocabulary), args.zipf), rng,
+                                                           args.queries)
+        results['query'] = benchmark_queries(index_directory, vector_queries, boolean_queries, args.top)
+
+        if args.crawl_pages > 0:
+            site = generate_site(args.crawl_pages, vocabulary, cum_weights, rng, args.words, args.links)
+            results['crawl'] = benchmark_crawl(site, os.path.join(work_directory, 'crawl-index'),
+                                               args.max_connections)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark indexing, query latency and crawling on a synthetic corpus. Results are printed as JSON.")
+    parser.add_argument('-n', '--documents', type=int, default=2000, help="Count of documents in corpus. Default: 2000")
+    parser.add_argument('-v', '--vocabulary', type=int, default=20000, help="Count of distinct words in corpus. Default: 20000")
+    parser.add_argument('-z', '--zipf', type=float, default=1.1, help="Exponent of Zipf distribution of word frequencies. Default: 1.1")
+    parser.add_argument('--words', type=int, default=300, help="Mean count of words per document. Default: 300")
+    parser.add_argument('-q', '--queries', type=int, default=200, help="Count of queries of each model. Default: 200")
+    parser.add_argument('--top', type=int, default=10, help="Top k documents of vector queries. Default: 10")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Count of worker processes that tokenize documents in parallel. Default: 1")
+    parser.add_argument('--crawl-pages', type=int, default=200, help="Count of pages of the site that is crawled. 0 skips crawl benchmark. Default: 200")
+    parser.add_argument('--links', type=int, default=5, help="Count of links per crawled page. Default: 5")
+    parser.add_argument('-c', '--max-connections', type=int, default=16, help="Max count of pages that are fetched concurrently. Default: 16")
+    parser.add_argument('-s', '--seed', type=int, default=0, help="Seed of random generator, so that runs use the same corpus and queries. Default: 0")
+    parser.add_argument('-o', '--output', help="File to write results to. Default: standard output")
+
+    args = parser.parse_args()
+    results = run(args)
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
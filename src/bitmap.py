@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+try:
+    import numpy as np
+except ImportError:  # bitmaps are built only from iterables of ids
+    np = None
+
+# Document ids are split in 16 high bits, which select a container, and 16 low bits, which select a bit in container
+CONTAINER_BITS = 16
+CONTAINER_MASK = (1 << CONTAINER_BITS) - 1
+
+
+class Bitmap:
+    """
+    Compressed bitmap of document ids in the spirit of roaring bitmaps. The id space is partitioned in chunks of 2^16
+    ids and only non-empty chunks are stored, each one as a Python int used as a bitset. Set operations are done chunk
+    by chunk with int bitwise operators, which run in C over machine words.
+    """
+
+    __slots__ = ('containers',)
+
+    def __init__(self, containers=None):
+        """
+        :param containers: dict with high bits of ids as keys and non-zero int bitsets of low bits as values
+        """
+        self.containers = containers if containers is not None else dict()
+
+    @classmethod
+    def from_ids(cls, doc_ids):
+        """
+        :param doc_ids: iterable of document ids
+        :return: Bitmap with doc_ids
+        """
+        # Bits are set in byte arrays, which are converted to ints at the end, to avoid creating an int for every id
+        chunks = dict()
+        for doc_id in doc_ids:
+            key = doc_id >> CONTAINER_BITS
+            chunk = chunks.get(key)
+            if chunk is None:
+                chunk = chunks[key] = bytearray(1 << (CONTAINER_BITS - 3))
+            low = doc_id & CONTAINER_MASK
+            chunk[low >> 3] |= 1 << (low & 7)
+        return cls({key: int.from_bytes(chunk, 'little') for key, chunk in chunks.items()})
+
+    @classmethod
+    def from_array(cls, doc_ids):
+        """
+        :param doc_ids: numpy array of document ids in ascending order
+        :return: Bitmap with doc_ids. Bits of each container are set by numpy
+        """
+        containers = dict()
+        keys = doc_ids >> CONTAINER_BITS
+        # Ids of each container are a slice of sorted ids
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(doc_ids)]))):
+            bits = np.zeros(1 << CONTAINER_BITS, dtype=bool)
+            bits[doc_ids[start:end] & CONTAINER_MASK] = True
+            containers[int(keys[start])] = int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+        return cls(containers)
+
+    def __and__(self, other):
+        containers = dict()
+        small, large = (self, other) if len(self.containers) <= len(other.containers) else (other, self)
+        for key, bits in small.containers.items():
+            if key in large.containers:
+                bits &= large.containers[key]
+                if bits:
+                    containers[key] = bits
+        return Bitmap(containers)
+
+    def __or__(self, other):
+        containers = dict(self.containers)
+        for key, bits in other.containers.items():
+            containers[key] = containers.get(key, 0) | bits
+        return Bitmap(containers)
+
+    def __sub__(self, other):
+        containers = dict()
+        for key, bits in self.containers.items():
+            if key in other.containers:
+                bits &= ~other.containers[key]
+            if bits:
+                containers[key] = bits
+        return Bitmap(containers)
+
+    def __bool__(self):
+        return bool(self.containers)
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self.containers.values())
+
+    def __contains__(self, doc_id):
+        bits = self.containers.get(doc_id >> CONTAINER_BITS, 0)
+        return bool(bits >> (doc_id & CONTAINER_MASK) & 1)
+
+    def __iter__(self):
+        """ Iterates over document ids in ascending order """
+        for key in sorted(self.containers):
+            base = key << CONTAINER_BITS
+            # binary digits of container from least significant bit
+            digits = bin(self.containers[key])[:1:-1]
+            low = digits.find('1')
+            while low >= 0:
+                yield base + low
+                low = digits.find('1', low + 1)
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            return self.containers == other.containers
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Bitmap({})'.format(list(self))
@@ -1,41 +1,196 @@
 # -*- coding: utf-8 -*-
 
+import math
+import operator
+import threading
+from functools import lru_cache, reduce
+
 from pyparsing import infixNotation, opAssoc, Word, alphanums
 
+# Count of parsed queries that a BooleanExpressionParser keeps in its cache
+PARSE_CACHE_SIZE = 1024
+
+
+class Node:
+    """
+    Node of a parsed boolean expression. Its op is one of 'term', 'not', 'and', 'or' and its value is respectively: the
+    term, the negated Node, or a tuple of the Nodes combined. Nodes are immutable and equal nodes have equal hashes.
+    """
+
+    __slots__ = ('op', 'value')
+
+    def __init__(self, op, value):
+        self.op = op
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.op == other.op and self.value == other.value
+
+    def __hash__(self):
+        return hash((self.op, self.value))
+
+    def __repr__(self):
+        return 'Node({!r}, {!r})'.format(self.op, self.value)
+
+
+def simplify(node):
+    """
+    Rewrites a parsed boolean expression to an equivalent one that is cheaper to evaluate: nested 'and' and 'or' are
+    flattened, repeated operands are dropped, double negations are removed and an 'and' of negations only is turned to
+    one negation of an 'or' (De Morgan), so that one complement is computed instead of many
+    :param node: Node
+    :return: Node
+    """
+    if node.op == 'term':
+        return node
+    if node.op == 'not':
+        child = simplify(node.value)
+        return child.value if child.op == 'not' else Node('not', child)
+
+    operands = []
+    for child in map(simplify, node.value):
+        for operand in (child.value if child.op == node.op else (child,)):
+            if operand not in operands:
+                operands.append(operand)
+    if len(operands) == 1:
+        return operands[0]
+    if node.op == 'and' and all(operand.op == 'not' for operand in operands):
+        return Node('not', simplify(Node('or', tuple(operand.value for operand in operands))))
+    return Node(node.op, tuple(operands))
+
+
+def terms(node):
+    """ :return: set of terms of a parsed boolean expression """
+    if node.op == 'term':
+        return {node.value}
+    if node.op == 'not':
+        return terms(node.value)
+    return set().union(*map(terms, node.value))
+
+
+class _Evaluation:
+    """
+    Evaluation of a boolean expression with a cost-based plan. Operands of 'and' are evaluated from the cheapest on and
+    evaluation stops as soon as their intersection is empty. Negated operands of 'and' are subtracted from the
+    intersection, instead of intersecting it with their complement. Results of subexpressions are kept, so that any
+    subexpression that occurs many times is evaluated once.
+    """
+
+    def __init__(self, evalfn, NOTevalfunc, costfn=None):
+        self.evalfn = evalfn
+        self.NOTevalfunc = NOTevalfunc
+        self.costfn = costfn
+        self.results = dict()  # dict with evaluated Nodes as keys and their results as values
+
+    def cost(self, node):
+        """ :return: estimated size of result of node """
+        if node.op == 'term':
+            return self.costfn(node.value) if self.costfn is not None else 0
+        if node.op == 'and':
+            return min(self.cost(child) for child in node.value if child.op != 'not')
+        if node.op == 'or':
+            return sum(self.cost(child) for child in node.value)
+        return math.inf  # complement is about as large as the collection
+
+    def evaluate(self, node):
+        result = self.results.get(node)
+        if result is not None:
+            return result
+
+        if node.op == 'term':
+            result = self.evalfn(node.value)
+        elif node.op == 'not':
+            result = self.NOTevalfunc(self.evaluate(node.value))
+        elif node.op == 'or':
+            result = reduce(operator.or_, map(self.evaluate, node.value))
+        else:
+            # Simplified 'and' has at least one operand that is not negated
+            positives = sorted((child for child in node.value if child.op != 'not'), key=self.cost)
+            negatives = [child.value for child in node.value if child.op == 'not']
+            result = self.evaluate(positives[0])
+            for child in positives[1:]:
+                if not result:
+                    break
+                result = result & self.evaluate(child)
+            for child in negatives:
+                if not result:
+                    break
+                result = result - self.evaluate(child)
+
+        self.results[node] = result
+        return result
+
+
+def evaluate(node, evalfn, NOTevalfunc, costfn=None):
+    """
+    Evaluates a parsed boolean expression
+    :param node: Node returned by :meth:`BooleanExpressionParser.parse`
+    :param evalfn: Function that converts a term to appropriate data. Data must support operators &, | and -
+    :param NOTevalfunc: Function that will be called to get result of NOT operator
+    :param costfn: Function that returns estimated size of data of a term, e.g. its document frequency. Operands of AND
+     are evaluated in increasing order of it. If it is not given, they are evaluated in query order
+    :return: result of boolean expression
+    """
+    return _Evaluation(evalfn, NOTevalfunc, costfn).evaluate(node)
+
 
 class BooleanExpressionParser:
     """
-    Boolean expression parser
+    Boolean expression parser. Grammar is built once and expressions are parsed into trees, which can be evaluated many
+    times with any functions. Parsed trees of recent expressions are cached. It is safe to use from many threads.
     """
 
-    def __init__(self, evalfn, NOTevalfunc):
+    def __init__(self, evalfn=None, NOTevalfunc=None):
         """
         :param evalfn: Function that will be called with argument a boolean operand for each boolean operand
                         Example: In expression A: a and not b, there will be 2 calls of evalfunc, evalfunc(a) and
-                        evalfunc(b) in order to convert a,b in appropriate data.
+                        evalfunc(b) in order to convert a,b in appropriate data. Data must support operators & and |
+                        (e.g. sets or Bitmaps) and - . It can also be given to eval_query.
         :param NOTevalfunc: Function that will be called to get result of NOT operator
                         Example: In expression A: a and not b, there will be a call to NOTevalfunc passing as argument
-                        the result of evalfunc(b). It can be seen as NOTevalfunc(evalfunc(b)).
+                        the result of evalfunc(b). It can be seen as NOTevalfunc(evalfunc(b)). It can also be given to
+                        eval_query.
         """
+        self.evalfn = evalfn
+        self.NOTevalfunc = NOTevalfunc
 
         # operand type
         # TODO check for greeks and so
         self.boolOperand = Word(alphanums+'_-')
-        self.boolOperand.setParseAction(lambda t: evalfn(t[0]))
+        self.boolOperand.setParseAction(lambda t: Node('term', t[0]))
 
         # expression grammar
         self.boolExpr = infixNotation(self.boolOperand,
                                       [
-                                          ("not", 1, opAssoc.RIGHT, lambda t: NOTevalfunc(t[0][1])),
-                                          ("and", 2, opAssoc.LEFT, lambda t: set(t[0][0]).intersection(*t[0][2::2])),
-                                          ("or", 2, opAssoc.LEFT, lambda t: set(t[0][0]).union(*t[0][2::2]))
+                                          ("not", 1, opAssoc.RIGHT, lambda t: Node('not', t[0][1])),
+                                          ("and", 2, opAssoc.LEFT, lambda t: Node('and', tuple(t[0][0::2]))),
+                                          ("or", 2, opAssoc.LEFT, lambda t: Node('or', tuple(t[0][0::2])))
                                       ])
 
-    def eval_query(self, q):
+        # pyparsing elements are shared by all parses, so parses are serialized
+        self._lock = threading.Lock()
+        self.parse = lru_cache(maxsize=PARSE_CACHE_SIZE)(self._parse)
+
+    def _parse(self, q):
+        """
+        :param q: boolean expression
+        :return: Node of simplified expression tree. It is simplified once, when it is cached
+        """
+        with self._lock:
+            tree = self.boolExpr.parseString(q)[0]
+        return simplify(tree)
+
+    def eval_query(self, q, evalfn=None, NOTevalfunc=None, costfn=None):
         """
         Evals query and returns set of documents that satisfy it
         :param q: boolean expression
+        :param evalfn: evalfn of this evaluation. Defaults to evalfn given to constructor
+        :param NOTevalfunc: NOTevalfunc of this evaluation. Defaults to NOTevalfunc given to constructor
+        :param costfn: Function that returns estimated size of data of a term. See :func:`evaluate`
         :return: result of boolean expression
         """
-        return self.boolExpr.parseString(q)[0]
+        return evaluate(self.parse(q), evalfn or self.evalfn, NOTevalfunc or self.NOTevalfunc, costfn)
+
 
+# Parser shared by collections
+parser = BooleanExpressionParser()
@@ -1,117 +1,921 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import heapq
 import math
 import operator
-from collections import defaultdict
-from pymongo import HASHED
+import sys
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice, repeat
 
+try:
+    import numpy as np
+except ImportError:  # vector model queries are scored in pure Python
+    np = None
 
-from boolean_expression_parse import BooleanExpressionParser
+import stats
+
+from bitmap import Bitmap
+import boolean_expression_parse
 from document import textpreprocess
+from postings import Postings, decode_blocks, tf_weight
+from simhash import simhash, format_fingerprint, parse_fingerprint
+from storage import MongoStorage, POSTINGS_BLOCK_SIZE
+
+
+# Flush triggers. In-memory index is written to storage when any of them is reached. 0 disables a trigger
+FLUSH_POSTINGS_LIMIT = 16000000
+FLUSH_BYTES_LIMIT = 256 * 1024 * 1024
+
+# Type of array items of in-memory postings (unsigned 32 bit document ids and counts)
+POSTING_TYPECODE = 'I'
+
+# Rough in-memory cost of index entries in bytes: a term costs its string, dict entry and two empty arrays, a posting
+# costs two array items plus the arrays' over-allocation
+ESTIMATED_TERM_SIZE = 300
+ESTIMATED_POSTING_SIZE = 9
+
+# Count of documents that are sent to a worker process at once by Collection.read_documents
+READ_DOCUMENTS_CHUNK_SIZE = 64
+
+# Relative slack added to term upper bounds, so that rounding errors in score sums never prune a document
+UPPER_BOUND_SLACK = 1e-9
 
+# Count of results whose locations are fetched at once by result generators
+RESULT_BATCH_SIZE = 1000
 
-READ_LIMIT_TO_WRITE_TO_MONGO = 100
+# Postings of terms with at least that many documents are fetched block by block by top-k queries, on storage that
+# splits postings in blocks, so that blocks without documents that may enter the top-k are skipped
+SKIP_BLOCKS_MIN_DF = 4 * POSTINGS_BLOCK_SIZE
 
+# Initial size of the table of tf weights of counts that vectorized scoring looks up. It grows with the largest count
+TF_WEIGHTS_TABLE_SIZE = 1024
+_tf_weights_table = None
+
+
+class InvertedIndex:
+    """
+    In-memory inverted index, which holds documents read since last flush. Terms are interned to integer ids and
+    postings of each term are kept in two typed arrays, of document ids and of counts, so that a posting takes 8 bytes
+    instead of a dict entry with two int objects. Documents must be added in ascending order of their ids, so postings
+    are always sorted by document id.
+    """
 
-class InvertedIndex(defaultdict):
     def __init__(self):
-        super().__init__(dict)
+        self.term_ids = dict()  # dict with terms as keys and their ids as values
+        self.terms = []  # terms by id
+        self.doc_ids = []  # array of document ids of each term, by term id
+        self.counts = []  # array of counts of each term in its documents, by term id
+        self.max_impacts = array('d')  # max of weight/L_d over documents of each term, by term id
+        self.postings_count = 0  # count of (term, document) entries
+        self.estimated_size = 0  # estimated memory used by index in bytes
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __getitem__(self, term):
+        """ :return: Postings of term, with arrays of document ids and counts """
+        term_id = self.term_ids[term]
+        return Postings(self.doc_ids[term_id], self.counts[term_id])
+
+    def items(self):
+        """ :return: iterable of tuples (term, Postings) in order of term ids """
+        return zip(self.terms, map(Postings, self.doc_ids, self.counts))
 
-    def add_document(self, d):
+    def get_max_impact(self, term):
+        """ :return: max of weight/L_d of term over its documents """
+        return self.max_impacts[self.term_ids[term]]
+
+    def clear(self):
+        self.term_ids.clear()
+        self.terms.clear()
+        self.doc_ids.clear()
+        self.counts.clear()
+        self.max_impacts = array('d')
+        self.postings_count = 0
+        self.estimated_size = 0
+
+    def memory_size(self):
+        """
+        :return: memory used by index in bytes, as measured by sys.getsizeof. It visits every term, so it is much slower
+         than estimated_size, which is kept up to date on every insert
+        """
+        size = sum(map(sys.getsizeof, (self.term_ids, self.terms, self.doc_ids, self.counts, self.max_impacts)))
+        size += sum(map(sys.getsizeof, self.terms))
+        size += sum(map(sys.getsizeof, self.doc_ids)) + sum(map(sys.getsizeof, self.counts))
+        # Ids from 0 to 256 are cached int objects, next ones are allocated
+        return size + sys.getsizeof(1 << 20) * max(len(self.terms) - 257, 0)
+
+    def _term_id(self, term):
+        """ :return: id of term. Term is added if it is not in index """
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+            self.doc_ids.append(array(POSTING_TYPECODE))
+            self.counts.append(array(POSTING_TYPECODE))
+            self.max_impacts.append(0)
+            self.estimated_size += ESTIMATED_TERM_SIZE + len(term)
+        return term_id
+
+    def add_document(self, d, doc_id, tokens=None):
         """
         Adds a document in inverted index. It, also, calculates property L_d, which is the norm of vector of w
         as is in [chapter4-vector.pdf page 14].
         :param d: Document
+        :param doc_id: integer id of document. Documents must be added in ascending order of their ids
+        :param tokens: result of d.tokenize(), if document has already been tokenized
         :return: L_d
         """
+        with stats.timed('add_document'):
+            return self._add_document(d, doc_id, tokens)
+
+    def _add_document(self, d, doc_id, tokens):
         l_d = 0
-        for term, count in d.tokenize().items():
+        if tokens is None:
+            tokens = d.tokenize()
+        stats.incr('documents_indexed')
+        stats.incr('postings_indexed', len(tokens))
+        term_ids = []
+        for term, count in tokens.items():
             # Document add
-            self[term][d] = count
+            term_id = self._term_id(term)
+            term_ids.append(term_id)
+            self.doc_ids[term_id].append(doc_id)
+            self.counts[term_id].append(count)
             # L_d calculation
             if count == 1:
                 l_d += 1  # Faster for count=1, same result though
             else:
                 l_d += (1 + math.log(count))**2
+        l_d = math.sqrt(l_d)
+        self.postings_count += len(tokens)
+        self.estimated_size += len(tokens) * ESTIMATED_POSTING_SIZE
 
-        return math.sqrt(l_d)
+        # Upper bound of a document's normalized weight for each term, used for top-k pruning
+        max_impacts = self.max_impacts
+        for term_id, count in zip(term_ids, tokens.values()):
+            impact = tf_weight(count) / l_d
+            if impact > max_impacts[term_id]:
+                max_impacts[term_id] = impact
+
+        return l_d
+
+    def merge(self, other, offset, skip=None):
+        """
+        Merges another inverted index in this one
+        :param other: InvertedIndex. Its document ids must be greater than ids of this index after adding offset
+        :param offset: number added to document ids of other
+        :param skip: set of document ids of other that are left out. Ids of next documents are decreased, so that ids
+         stay consecutive
+        """
+        if skip:
+            skipped = sorted(skip)
+        postings_count = 0
+        for (term, (doc_ids, counts)), impact in zip(other.items(), other.max_impacts):
+            if skip:
+                kept = [i for i, doc_id in enumerate(doc_ids) if doc_id not in skip]
+                if not kept:
+                    continue
+                doc_ids = [doc_ids[i] - bisect.bisect_left(skipped, doc_ids[i]) for i in kept]
+                counts = array(POSTING_TYPECODE, (counts[i] for i in kept))
+            term_id = self._term_id(term)
+            self.doc_ids[term_id].extend(array(POSTING_TYPECODE, (doc_id + offset for doc_id in doc_ids))
+                                         if offset or skip else doc_ids)
+            self.counts[term_id].extend(counts)
+            postings_count += len(counts)
+            # Impact of a skipped document may be kept, which is still an upper bound
+            if impact > self.max_impacts[term_id]:
+                self.max_impacts[term_id] = impact
+        self.postings_count += postings_count
+        self.estimated_size += postings_count * ESTIMATED_POSTING_SIZE
+
+
+def index_documents(documents, record_stats=False, fingerprints=False):
+    """
+    Builds a partial inverted index of documents. It runs in worker processes of Collection.read_documents
+    :param documents: list of Documents
+    :param record_stats: If it is set, instrumentation is recorded and returned
+    :param fingerprints: If it is set, simhash fingerprints of documents are computed and returned
+    :return: tuple (InvertedIndex with document ids 0, 1, ... in order of documents, list with L_d of each document,
+     list with fingerprint of each document or None, stats snapshot or None)
+    """
+    stats.enable(record_stats)
+    stats.stats.clear()
+    index = InvertedIndex()
+    L_ds = []
+    document_fingerprints = [] if fingerprints else None
+    for doc_id, d in enumerate(documents):
+        tokens = d.tokenize()
+        L_ds.append(index.add_document(d, doc_id, tokens))
+        if fingerprints:
+            document_fingerprints.append(simhash(tokens))
+    return index, L_ds, document_fingerprints, stats.stats.snapshot() if record_stats else None
 
 
 class Collection:
-    def __init__(self, mongo_db=None, mongo_collections=None):
+    def __init__(self, mongo_db=None, mongo_collections=None, storage=None, flush_postings=FLUSH_POSTINGS_LIMIT,
+                 flush_bytes=FLUSH_BYTES_LIMIT, background_flush=False, cache_L_d=False, query_cache=None,
+                 near_duplicates=None):
         """
 
         :param mongo_db: MongoClient object
         :param mongo_collections: dict with collections: 'invertedIndex' for inverted index collection (will contain
-         term as key and document locations as value and 'documents' for documents collection (will contain document
-         location as key and L_d as value)
+         blocks of compressed document ids and counts of each term) and 'documents' for documents collection
+         (will contain document id as key and location and L_d as values)
+        :param storage: Storage object where index is persisted. If it is not given, a MongoStorage on mongo_db and
+         mongo_collections is used
+        :param flush_postings: In-memory index is flushed to storage when it holds that many postings. 0 disables it
+        :param flush_bytes: In-memory index is flushed to storage when its estimated size reaches that many bytes. 0
+         disables it
+        :param background_flush: If it is set, flushes triggered by read_document are written to storage by a
+         background thread, while next documents are read
+        :param cache_L_d: If it is set, documents' L_d that are fetched from storage are kept in memory for next queries.
+         Cache is kept in sync by flush_to_mongo
+        :param query_cache: QueryCache object where query results are cached. Results are invalidated when index
+         generation changes, i.e. after every flush
+        :param near_duplicates: FingerprintIndex object. If it is given, new documents that are near-duplicates of
+         documents in it are not added; they are linked to the documents they duplicate and stored with their metadata
+         as near-duplicates. Fingerprints of stored documents are loaded in it when first document is read. It can be
+         shared by collections (e.g. shards)
         """
         self.index = InvertedIndex()  # inverted index
-        self.documents = dict()  # dict with documents as keys and L_d as values
-        self.mongo_db = mongo_db
-        self.mongo_collections = mongo_collections
-
-    def flush_to_mongo(self):
-        if self.index and self.documents:
-            # Write to mongo
-            for term, docs in self.index.items():
-                mdocs = [{'doc': str(doc), 'count': count} for doc, count in docs.items()]
-                self.mongo_db[self.mongo_collections['invertedIndex']].update({'term': term}, {"$push": {"docs": {"$each": mdocs}}}, upsert=True)
-            mdocs = [{'doc': str(doc), 'L_d': L_d} for doc, L_d in self.documents.items()]
-            self.mongo_db[self.mongo_collections['documents']].insert_many(mdocs)
-
-            # Clear memory
-            self.index.clear()
-            self.documents.clear()
+        self.documents = dict()  # dict with document locations as keys and tuples (document id, L_d) as values
+        self.metadata = dict()  # dict with document locations as keys and dicts {'etag', 'last_modified', 'hash'}
+        self.deleted = set()  # ids of stored documents that are deleted on next flush
+        # dict with locations of near-duplicates as keys and dicts {'duplicate_of', 'etag', 'last_modified', 'hash'} as
+        # values, or None for stored near-duplicates that are removed on next flush
+        self.duplicates = dict()
+        self.storage = storage if storage is not None else MongoStorage(mongo_db, mongo_collections)
+        self.flush_postings = flush_postings
+        self.flush_bytes = flush_bytes
+        self.background_flush = background_flush
+
+        # Background flush state. At most one flush is in progress, so memory is bounded to two in-memory indexes
+        self._flush_executor = ThreadPoolExecutor(max_workers=1) if background_flush else None
+        self._flush_future = None
+        self._flushing_documents = dict()
+
+        # Id of next document to be read. It is fetched from storage when first document is read
+        self._next_document_id = None
+
+        # Query caches. Documents count is cached till next flush. L_d cache is a dict with document ids as keys.
+        # Bitmap of all documents is loaded once and updated by flushes
+        self._documents_count = None
+        self._all_documents = None
+        self._deleted_documents = None
+        self.query_cache = query_cache
+        self.L_d_cache = dict() if cache_L_d else None
+
+        self.near_duplicates = near_duplicates
+        self._fingerprints_loaded = False
+
+    def _wait_flush(self):
+        """ Waits for background flush in progress, if any, and raises its exception if it failed """
+        if self._flush_future is not None:
+            future, self._flush_future = self._flush_future, None
+            try:
+                future.result()
+            finally:
+                self._flushing_documents = dict()
+
+    def flush_to_mongo(self, background=False):
+        """
+        Writes in-memory index and documents to storage and clears memory
+        :param background: If it is set and collection has background_flush enabled, it returns immediately and
+         writing is done by a background thread. Otherwise it returns when everything is written, including any
+         background flush in progress.
+        """
+        with stats.timed('flush'):
+            self._flush(background)
+
+    def _flush(self, background):
+        self._wait_flush()
+        if (self.index and self.documents) or self.deleted or self.duplicates:
+            self._documents_count = None
+            if self.L_d_cache is not None:
+                self.L_d_cache.update(self.documents.values())
+            if self._all_documents is not None:
+                self._all_documents |= Bitmap.from_ids(doc_id for doc_id, _ in self.documents.values())
+                self._all_documents -= Bitmap.from_ids(self.deleted)
+            if self._deleted_documents is not None:
+                self._deleted_documents |= self.deleted
+
+            if background and self._flush_executor is not None:
+                # Hand over in-memory index to writer thread and continue with a new one
+                index, documents, metadata, deleted, duplicates = \
+                    self.index, self.documents, self.metadata, self.deleted, self.duplicates
+                self.index, self.documents, self.metadata, self.deleted, self.duplicates = \
+                    InvertedIndex(), dict(), dict(), set(), dict()
+                self._flushing_documents = documents
+                self._flush_future = self._flush_executor.submit(self._write, index, documents, metadata, deleted,
+                                                                 duplicates)
+            else:
+                # Write to storage
+                self._write(self.index, self.documents, self.metadata, self.deleted, self.duplicates)
+
+                # Clear memory
+                self.index.clear()
+                self.documents.clear()
+                self.metadata.clear()
+                self.deleted.clear()
+                self.duplicates.clear()
+
+    def _write(self, index, documents, metadata, deleted, duplicates):
+        with stats.timed('storage_write'):
+            self.storage.write(index, documents, metadata, deleted, duplicates)
+        stats.incr('flushes')
+        stats.incr('flushed_documents', len(documents))
+        stats.incr('flushed_postings', index.postings_count)
+
+        # Pieces of index that flushes leave behind are merged by the thread that writes, once there are enough of them.
+        # Only terms of this write can have gained pieces
+        with stats.timed('storage_compact'):
+            stats.incr('compacted_terms', self.storage.compact(terms=list(index)))
+
+    def compact(self, min_fragments=2, full=False):
+        """
+        Merges pieces of stored index that flushes leave behind and drops postings of deleted documents from them
+        :param min_fragments: only terms with at least that many pieces are merged
+        :param full: If it is set, the whole stored index is rewritten without postings of deleted documents
+        :return: count of terms merged
+        """
+        self._wait_flush()
+        ans = self.storage.compact(min_fragments, full)
+        self._deleted_documents = None  # deleted documents whose postings were dropped are no longer filtered out
+        return ans
+
+    def needs_flush(self):
+        """ Checks if in-memory index has reached any of the flush limits """
+        return (0 < self.flush_postings <= self.index.postings_count) or \
+               (0 < self.flush_bytes <= self.index.estimated_size)
+
+    def close(self):
+        """
+        Waits for background flush in progress, if any, and closes storage. In-memory index is not flushed
+        """
+        try:
+            self._wait_flush()
+        finally:
+            if self._flush_executor is not None:
+                self._flush_executor.shutdown()
+            self.storage.close()
 
     def create_mongo_indexes(self):
-        self.mongo_db[self.mongo_collections['invertedIndex']].create_index([('term', HASHED)])
-        self.mongo_db[self.mongo_collections['documents']].create_index([('doc', HASHED)])
+        self.storage.create_indexes()
+
+    def get_generation(self):
+        """ :return: index generation of storage, which changes on every flush """
+        return self.storage.get_generation()
+
+    def get_identity(self):
+        """ :return: string that identifies the stored index """
+        return self.storage.get_identity()
+
+    def get_locations(self):
+        """ :return: set with locations of all stored documents """
+        return self.storage.get_locations()
 
     def get_documents_count(self):
-        return self.mongo_db[self.mongo_collections['documents']].count()
+        if self._documents_count is None:
+            self._documents_count = self.storage.get_documents_count()
+        return self._documents_count
 
     def get_index_count(self):
-        return self.mongo_db[self.mongo_collections['invertedIndex']].count()
+        return self.storage.get_index_count()
+
+    def warm_up(self):
+        """ Loads documents count, documents and deleted documents, which queries use, before the first query """
+        self.get_documents_count()
+        self.get_all_documents()
+        self.get_deleted_documents()
+
+    def get_deleted_documents(self):
+        """
+        :return: set of ids of deleted documents. It is loaded once and updated by flushes
+        """
+        if self._deleted_documents is None:
+            self._deleted_documents = set(self.storage.get_deleted_document_ids())
+        return self._deleted_documents
+
+    def _without_deleted(self, docs):
+        """
+        Removes deleted documents from postings. Storage keeps postings of deleted documents till they are compacted
+        :param docs: Postings
+        :return: Postings
+        """
+        deleted = self.get_deleted_documents()
+        if not deleted:
+            return docs
+        if np is not None and isinstance(docs.doc_ids, np.ndarray):
+            live = ~np.isin(docs.doc_ids, np.fromiter(deleted, dtype=np.int64, count=len(deleted)))
+            return Postings(docs.doc_ids[live], docs.counts[live])
+        live = [(d, count) for d, count in zip(*docs) if d not in deleted]
+        return Postings([d for d, _ in live], [count for _, count in live])
 
     def get_documents_for_term(self, term):
-        ans = self.mongo_db[self.mongo_collections['invertedIndex']].find_one({'term': term}, {'docs': 1})
-        if ans:
-            return ans['docs']
+        with stats.timed('postings_fetch'):
+            ans = self.storage.get_documents_for_term(term)
+        if ans is not None:
+            return self._without_deleted(ans)
         else:  # Check if term is in our collection
             raise Exception("Term '" + term + "' does not exist in our inverted index.")
 
+    def get_documents_for_terms(self, terms, arrays=False):
+        """
+        Fetches postings of many terms at once
+        :param terms: list of terms
+        :param arrays: If it is set, postings are numpy arrays instead of lists
+        :return: dict with each term as key and its postings as value
+        """
+        with stats.timed('postings_fetch'):
+            ans = self.storage.get_documents_for_terms(terms, arrays)
+        stats.incr('postings_fetched', sum(len(postings.doc_ids) for postings in ans.values()))
+        for term in terms:
+            if term not in ans:  # Check if term is in our collection
+                raise Exception("Term '" + term + "' does not exist in our inverted index.")
+        return {term: self._without_deleted(docs) for term, docs in ans.items()}
+
+    def get_blocks_for_terms(self, terms):
+        """
+        Fetches headers of postings blocks of many terms at once
+        :param terms: list of terms
+        :return: dict with each term whose postings storage splits in blocks as key and list of dicts
+         {'min_id', 'max_id', 'df', 'max_tf'} of its blocks as value
+        """
+        with stats.timed('postings_fetch'):
+            return self.storage.get_blocks_for_terms(terms)
+
+    def get_documents_for_blocks(self, term, blocks, arrays=False):
+        """
+        Fetches postings of a term in some of its blocks
+        :param term: term
+        :param blocks: list of block headers of term, as returned by get_blocks_for_terms
+        :param arrays: If it is set, postings are numpy arrays instead of lists
+        :return: Postings of term with at least the documents in the ranges of ids of blocks
+        """
+        if not blocks:
+            return decode_blocks([], arrays)
+        with stats.timed('postings_fetch'):
+            ans = self.storage.get_documents_for_blocks(term, blocks, arrays)
+        stats.incr('postings_fetched', len(ans.doc_ids))
+        return self._without_deleted(ans)
+
+    def get_live_terms_statistics(self, terms):
+        """
+        Fetches statistics of many terms at once, with document frequencies of documents that are not deleted
+        :param terms: list of terms
+        :return: dict with each term of terms that is in documents which are not deleted as key and a dict
+         {'df': document frequency, 'max_impact': max weight/L_d} as value
+        """
+        with stats.timed('terms_statistics_fetch'):
+            ans = self.storage.get_terms_statistics(terms)
+        if ans and self.get_deleted_documents():
+            # Stored document frequencies count deleted documents till compaction drops their postings, so they are
+            # counted from live postings
+            with stats.timed('postings_fetch'):
+                term_documents = self.storage.get_documents_for_terms(list(ans), arrays=np is not None)
+            for term in list(ans):
+                df = len(self._without_deleted(term_documents[term]).doc_ids) if term in term_documents else 0
+                if df:
+                    ans[term] = dict(ans[term], df=df)
+                else:
+                    del ans[term]
+        return ans
+
+    def get_terms_statistics(self, terms):
+        """
+        Fetches statistics of many terms at once
+        :param terms: list of terms
+        :return: dict with each term as key and a dict {'df': document frequency, 'max_impact': max weight/L_d} as value
+        """
+        ans = self.get_live_terms_statistics(terms)
+        for term in terms:
+            if term not in ans:  # Check if term is in our collection
+                raise Exception("Term '" + term + "' does not exist in our inverted index.")
+        return ans
+
     def get_only_documents_for_term(self, term):
-        ans = self.mongo_db[self.mongo_collections['invertedIndex']].find_one({'term': term}, {'docs': 1})
-        return set([doc_entry['doc'] for doc_entry in ans['docs']]) if ans else set()
+        with stats.timed('postings_fetch'):
+            ans = self.storage.get_documents_for_term(term, arrays=np is not None)
+        stats.incr('postings_fetched', len(ans.doc_ids) if ans else 0)
+        if not ans or not len(ans.doc_ids):
+            return Bitmap()
+        documents = Bitmap.from_array(ans.doc_ids) if np is not None else Bitmap.from_ids(ans.doc_ids)
+        # Bitmap of all documents leaves out deleted ones
+        return documents & self.get_all_documents() if self.get_deleted_documents() else documents
+
+    def get_all_documents(self):
+        if self._all_documents is None:
+            self._all_documents = Bitmap.from_ids(self.storage.get_document_ids())
+        return self._all_documents
 
     def get_documents_not_in(self, other_doc_set):
-        ans = self.mongo_db[self.mongo_collections['documents']].find({'doc': {"$nin": list(other_doc_set)}}, {'doc': 1})
-        return set([doc_entry['doc'] for doc_entry in ans]) if ans else set()
+        """
+        :param other_doc_set: Bitmap of document ids
+        :return: Bitmap of collection's documents that are not in other_doc_set
+        """
+        return self.get_all_documents() - other_doc_set
 
-    def get_document_L_d(self, doc: str):
-        ans = self.mongo_db[self.mongo_collections['documents']].find_one({'doc': doc}, {'L_d': 1})
-        if ans:
-            return ans['L_d']
+    def get_document_L_d(self, doc: int):
+        ans = self.storage.get_document_L_d(doc)
+        if ans is not None:
+            return ans
         else:  # Check if doc is in our collection
-            raise Exception("Document '" + doc + "' does not exist in our collection.")
+            raise Exception("Document '" + str(doc) + "' does not exist in our collection.")
+
+    def get_documents_L_d(self, docs):
+        """
+        Fetches L_d of many documents at once. Documents found in L_d cache are not fetched from storage.
+        :param docs: iterable of document ids
+        :return: dict with each document as key and its L_d as value
+        """
+        with stats.timed('L_d_fetch'):
+            return self._get_documents_L_d(docs)
+
+    def _get_documents_L_d(self, docs):
+        if self.L_d_cache is None:
+            ans = self.storage.get_documents_L_d(docs)
+        else:
+            ans = {doc: self.L_d_cache[doc] for doc in docs if doc in self.L_d_cache}
+            fetched = self.storage.get_documents_L_d([doc for doc in docs if doc not in ans])
+            self.L_d_cache.update(fetched)
+            ans.update(fetched)
+
+        for doc in docs:
+            if doc not in ans:  # Check if doc is in our collection
+                raise Exception("Document '" + str(doc) + "' does not exist in our collection.")
+        return ans
+
+    def get_documents_L_d_array(self, docs):
+        """
+        Fetches L_d of many documents at once
+        :param docs: numpy array of document ids
+        :return: numpy array with L_d of each document
+        """
+        with stats.timed('L_d_fetch'):
+            if self.L_d_cache is not None:
+                L_d = self._get_documents_L_d(docs.tolist())
+                return np.fromiter((L_d[doc] for doc in docs.tolist()), dtype=np.float64, count=len(docs))
+            ans = self.storage.get_documents_L_d_array(docs)
+        missing = np.isnan(ans)
+        if missing.any():  # Check if docs are in our collection
+            raise Exception("Document '" + str(docs[missing][0]) + "' does not exist in our collection.")
+        return ans
+
+    def get_documents_locations(self, docs):
+        """
+        Resolves ids of many documents to their locations at once
+        :param docs: iterable of document ids
+        :return: dict with each document id as key and its location as value
+        """
+        ans = self.storage.get_documents_locations(docs)
+        for doc in docs:
+            if doc not in ans:  # Check if doc is in our collection
+                raise Exception("Document '" + str(doc) + "' does not exist in our collection.")
+        return ans
+
+    def with_locations(self, result):
+        """
+        :param result: list of tuples (document id, similarity)
+        :return: list of tuples (document location, similarity)
+        """
+        locations = self.get_documents_locations([d for d, _ in result])
+        return [(locations[d], similarity) for d, similarity in result]
+
+    def iter_with_locations(self, results):
+        """
+        :param results: iterable of tuples (document id, similarity)
+        :return: generator of tuples (document location, similarity). Locations are fetched in batches
+        """
+        results = iter(results)
+        while True:
+            batch = list(islice(results, RESULT_BATCH_SIZE))
+            if not batch:
+                return
+            yield from self.with_locations(batch)
 
     def in_collection(self, d):
-        return d in self.documents or self.mongo_db[self.mongo_collections['documents']].find({'doc': str(d)}, {'_id': 1}).limit(1).count()
+        location = str(d)
+        return location in self.documents or location in self._flushing_documents or self.storage.has_document(location)
 
-    def read_document(self, d):
+    def read_document(self, d, metadata=None):
         """
         Reads a document add adds its terms in inverted index. It is also adds documents' L_d in self.documents set
 
         :param d:
+        :param metadata: dict {'etag', 'last_modified', 'hash'} stored with document, used to re-crawl it
         :return:
         """
         if not self.in_collection(d):
-            self.documents[d] = self.index.add_document(d)
+            self._add_document(d, metadata)
+
+    def _add_document(self, d, metadata):
+        """
+        :return: True if document was added, False if it is a near-duplicate
+        """
+        location = str(d)
+        tokens = d.tokenize()
+        if self.near_duplicates is not None:
+            fingerprint = self._check_near_duplicate(location, simhash(tokens))
+            if fingerprint is None:
+                self._add_duplicate(location, metadata)
+                return False
+            metadata = dict(metadata or (), simhash=format_fingerprint(fingerprint))
+
+        doc_id = self._take_document_ids(1)
+        self.documents[location] = (doc_id, self.index.add_document(d, doc_id, tokens))
+        if metadata:
+            self.metadata[location] = metadata
+
+        if self.needs_flush():
+            self.flush_to_mongo(background=self.background_flush)
+        return True
+
+    def load_fingerprints(self):
+        """ Loads fingerprints of stored documents in near_duplicates once, if near-duplicates are detected """
+        if self.near_duplicates is not None and not self._fingerprints_loaded:
+            for stored_location, stored_fingerprint in self.storage.get_fingerprints():
+                self.near_duplicates.add(stored_location, parse_fingerprint(stored_fingerprint))
+            self._fingerprints_loaded = True
+
+    def _check_near_duplicate(self, location, fingerprint):
+        """
+        Checks if a new document is a near-duplicate of a document in collection. If it is, it is linked to that
+        document, otherwise its fingerprint is added in near_duplicates.
+        :return: fingerprint or None if document is a near-duplicate
+        """
+        self.load_fingerprints()
+        canonical = self.near_duplicates.find(fingerprint, exclude=location)
+        if canonical is not None:
+            self.near_duplicates.link(location, canonical)
+            stats.incr('near_duplicates')
+            return None
+        self.near_duplicates.add(location, fingerprint)
+        return fingerprint
+
+    def _add_duplicate(self, location, metadata):
+        """
+        Keeps a near-duplicate that was not added, so that it is stored with its metadata and link on next flush
+        """
+        entry = {'etag': None, 'last_modified': None, 'hash': None}
+        entry.update(metadata or ())
+        entry['duplicate_of'] = self.near_duplicates.links[location]
+        self.duplicates[location] = entry
+
+    def update_document(self, d, metadata):
+        """
+        Reads a document that may already be in collection. If it is stored with a different content hash, stored
+        version is deleted and document is added again with a new id.
+        :param d: Document
+        :param metadata: dict {'etag', 'last_modified', 'hash'} of document
+        :return: True if document was added. A document that has become a near-duplicate is deleted and not added
+        """
+        location = str(d)
+        if location in self.documents or location in self._flushing_documents:
+            return False
+        stored = self.get_document_metadata(location)
+        if stored is not None:
+            if stored['hash'] is not None and stored['hash'] == metadata.get('hash'):
+                return False
+            self.deleted.add(stored['id'])
+        return self._add_document(d, metadata)
 
-            if len(self.index) >= READ_LIMIT_TO_WRITE_TO_MONGO:
-                self.flush_to_mongo()
+    def delete_document(self, location):
+        """
+        Deletes a stored document on next flush
+        :param location: location of document
+        :return: True if document was stored
+        """
+        stored = self.get_document_metadata(location)
+        if stored is None:
+            return False
+        self.load_fingerprints()
+        self._delete_stored(location, stored['id'])
+        return True
+
+    def get_document_metadata(self, location):
+        """
+        :param location: location of document
+        :return: dict {'id', 'etag', 'last_modified', 'hash'} of stored document or None if it is not stored
+        """
+        return self.storage.get_document_metadata(location)
+
+    def _take_document_ids(self, count):
+        """ Reserves count consecutive ids for new documents and returns the first one """
+        if self._next_document_id is None:
+            self._wait_flush()
+            self._next_document_id = self.storage.get_next_document_id()
+        doc_id = self._next_document_id
+        self._next_document_id += count
+        return doc_id
+
+    def read_documents(self, docs, workers=1):
+        """
+        Reads many documents. Documents already in collection are found with one bulk query and skipped. If workers
+        is greater than 1, documents are tokenized in a pool of worker processes, each one building partial inverted
+        indexes, which are merged in collection's index in document order.
+
+        :param docs: iterable of Documents
+        :param workers: count of worker processes
+        """
+        existing = self.storage.get_locations()
+        new_docs = []
+        for d in docs:
+            location = str(d)
+            if location not in existing and location not in self.documents and location not in self._flushing_documents:
+                existing.add(location)
+                new_docs.append(d)
+        self._read_new_documents(new_docs, dict(), workers)
+
+    def sync_documents(self, docs, workers=1, delete_missing=False):
+        """
+        Brings collection up to date with docs, reading only documents that are new or have changed since they were
+        stored. Stored metadata of all documents is fetched with one bulk query. A stored document is unchanged if its
+        etag (e.g. size and modification time of a file) is the stored one, without opening it, or else if its content
+        hash is the stored one. Changed documents are deleted and read again with new ids. Stored near-duplicates are
+        checked the same way, and read again if they have changed or if the documents they duplicate are deleted or
+        changed. In-memory documents are flushed first.
+        :param docs: iterable of Documents with methods get_etag and get_metadata, e.g. LocalDocuments
+        :param workers: count of worker processes that tokenize documents
+        :param delete_missing: If it is set, stored documents that are not in docs are deleted
+        :return: dict with counts of 'added', 'changed', 'unchanged' and 'deleted' documents and of new or changed
+         documents that were not added as 'duplicates' of other documents
+        """
+        plan = self.prepare_sync(docs, delete_missing)
+        return self.finish_sync(plan, workers, plan['kept'])
+
+    def prepare_sync(self, docs, delete_missing=False):
+        """
+        First step of sync_documents: finds new and changed documents and deletes changed and missing stored documents
+        :param docs: iterable of Documents with methods get_etag and get_metadata
+        :param delete_missing: If it is set, stored documents that are not in docs are deleted
+        :return: dict with sync state, for finish_sync. Its 'kept' value is the set of locations of stored documents
+         that are not deleted or changed
+        """
+        self.flush_to_mongo()
+        # Fingerprints of deleted and changed documents are removed, so they must be loaded first
+        self.load_fingerprints()
+        stored = dict(self.storage.get_documents_metadata())
+        stored_duplicates = dict(self.storage.get_duplicates())
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0, 'duplicates': 0}
+        new_docs = []
+        added = set()
+        metadata = dict()
+        seen = set()
+        kept = set(stored)
+        # dict with locations of unchanged stored near-duplicates as keys and their Documents as values
+        unchanged_duplicates = dict()
+        for d in docs:
+            location = str(d)
+            if location in seen:
+                continue
+            seen.add(location)
+            stored_metadata = stored.get(location) or stored_duplicates.get(location)
+            if stored_metadata is not None and stored_metadata['etag'] == d.get_etag():
+                counts['unchanged'] += 1
+                if location in stored_duplicates:
+                    unchanged_duplicates[location] = d
+                continue
+            metadata[location] = d.get_metadata()
+            if stored_metadata is not None:
+                if stored_metadata['hash'] == metadata[location]['hash']:
+                    counts['unchanged'] += 1
+                    if location in stored_duplicates:
+                        unchanged_duplicates[location] = d
+                    continue
+                if location in stored:
+                    self._delete_stored(location, stored_metadata['id'])
+                    kept.discard(location)
+                counts['changed'] += 1
+            else:
+                counts['added'] += 1
+                added.add(location)
+            new_docs.append(d)
+
+        if delete_missing:
+            for location, stored_metadata in stored.items():
+                if location not in seen:
+                    self._delete_stored(location, stored_metadata['id'])
+                    kept.discard(location)
+                    counts['deleted'] += 1
+            for location in stored_duplicates:
+                if location not in seen:
+                    self.duplicates[location] = None
+                    counts['deleted'] += 1
+
+        return {'counts': counts, 'docs': new_docs, 'added': added, 'metadata': metadata, 'kept': kept,
+                'duplicates': {location: (d, stored_duplicates[location]['duplicate_of'])
+                               for location, d in unchanged_duplicates.items()}}
+
+    def finish_sync(self, plan, workers=1, kept=None):
+        """
+        Second step of sync_documents: reads new and changed documents, and unchanged stored near-duplicates of
+        documents that are not kept, which are checked again
+        :param plan: dict returned by prepare_sync
+        :param workers: count of worker processes that tokenize documents
+        :param kept: set of locations of stored documents that are kept, e.g. in all shards. Defaults to those of plan
+        :return: dict with counts of documents, as sync_documents
+        """
+        counts = plan['counts']
+        new_docs = list(plan['docs'])
+        metadata = dict(plan['metadata'])
+        kept = plan['kept'] if kept is None else kept
+        for location, (d, canonical) in plan['duplicates'].items():
+            if canonical not in kept:
+                # Stored near-duplicate is forgotten and read again, since document that it duplicates is gone
+                self.duplicates[location] = None
+                metadata[location] = d.get_metadata()
+                new_docs.append(d)
+                counts['unchanged'] -= 1
+                counts['changed'] += 1
+
+        skipped = self._read_new_documents(new_docs, metadata, workers)
+        counts['duplicates'] = len(skipped)
+        counts['added'] -= len(skipped & plan['added'])
+        counts['changed'] -= len(skipped - plan['added'])
+        return counts
+
+    def _delete_stored(self, location, doc_id):
+        """ Deletes a stored document on next flush, and its fingerprint """
+        self.deleted.add(doc_id)
+        if self.near_duplicates is not None:
+            self.near_duplicates.remove(location)
+
+    def _read_new_documents(self, docs, metadata, workers):
+        """
+        Reads documents that are not in collection
+        :param docs: list of Documents
+        :param metadata: dict with locations of documents as keys and their metadata as values
+        :param workers: count of worker processes
+        :return: set with locations of near-duplicates that were not added
+        """
+        skipped = set()
+        if workers <= 1:
+            for d in docs:
+                if not self._add_document(d, metadata.get(str(d))):
+                    skipped.add(str(d))
+            return skipped
+
+        chunks = [docs[i:i + READ_DOCUMENTS_CHUNK_SIZE] for i in range(0, len(docs), READ_DOCUMENTS_CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(index_documents, chunks, repeat(stats.stats.enabled),
+                                   repeat(self.near_duplicates is not None))
+            for chunk, (partial_index, L_ds, fingerprints, snapshot) in zip(chunks, results):
+                if snapshot:
+                    stats.stats.merge(snapshot)
+                # Near-duplicates are checked in document order, and left out of partial index
+                skip = set()
+                simhashes = dict()
+                if fingerprints is not None:
+                    for i, (d, fingerprint) in enumerate(zip(chunk, fingerprints)):
+                        if self._check_near_duplicate(str(d), fingerprint) is None:
+                            self._add_duplicate(str(d), metadata.get(str(d)))
+                            skipped.add(str(d))
+                            skip.add(i)
+                        else:
+                            simhashes[i] = format_fingerprint(fingerprint)
+                first_id = self._take_document_ids(len(chunk) - len(skip))
+                self.index.merge(partial_index, first_id, skip)
+                doc_id = first_id
+                for i, (d, L_d) in enumerate(zip(chunk, L_ds)):
+                    if i not in skip:
+                        location = str(d)
+                        self.documents[location] = (doc_id, L_d)
+                        document_metadata = dict(metadata.get(location) or ())
+                        if i in simhashes:
+                            document_metadata['simhash'] = simhashes[i]
+                        if document_metadata:
+                            self.metadata[location] = document_metadata
+                        doc_id += 1
+                if self.needs_flush():
+                    self.flush_to_mongo(background=self.background_flush)
+        return skipped
+
+    def _cached(self, key, process):
+        """
+        Returns result of a query from query cache, or processes it and caches its result
+        :param key: key of query
+        :param process: function that processes query and returns its result
+        """
+        if self.query_cache is None:
+            return process()
+        # Cache may be shared by many indexes, e.g. when it is saved to a file, so key tells which index it is for
+        key = (self.get_identity(),) + key
+        generation = self.get_generation()
+        result = self.query_cache.get(key, generation)
+        if result is None:
+            result = process()
+            self.query_cache.put(key, generation, result)
+        return result
 
     def processquery_boolean(self, q):
         """
@@ -119,21 +923,53 @@ class Collection:
         :param q: query in boolean expression format
         :return: Documents that satisfy the query
         """
+        # process query text the same way as a document (do the same text preprocessing)
+        with stats.timed('query_boolean'):
+            newq = ' '.join(textpreprocess(q))
+            return self._cached(('boolean', newq), lambda: self._processquery_boolean(newq))
+
+    def _processquery_boolean(self, newq):
+        with stats.timed('boolean_eval'):
+            result = [(d, 1) for d in self._boolean_documents(newq)]
+        return self.with_locations(result)
+
+    def iter_boolean(self, q, offset=0, limit=-1):
+        """
+        Processes a query with the boolean model and yields its results one by one, in order of document id
+        :param q: query in boolean expression format
+        :param offset: count of results to skip
+        :param limit: max count of results. Unlimited if it is -1
+        :return: generator of tuples (document location, 1)
+        """
+        newq = ' '.join(textpreprocess(q))
+        with stats.timed('boolean_eval'):
+            documents = self._boolean_documents(newq)
+        ids = islice(documents, offset, None if limit < 0 else offset + limit)
+        yield from self.iter_with_locations((d, 1) for d in ids)
+
+    def _boolean_documents(self, newq):
+        """
+        :param newq: preprocessed query in boolean expression format
+        :return: Bitmap of documents that satisfy the query
+        """
+        # the shared parser keeps parsed trees of recent queries, which are evaluated on this collection
+        parser = boolean_expression_parse.parser
+        tree = parser.parse(newq)
+
+        # Document frequencies of all terms are fetched at once and operands of AND are evaluated from the rarest on
+        with stats.timed('terms_statistics_fetch'):
+            df = {term: term_statistics['df'] for term, term_statistics in
+                  self.storage.get_terms_statistics(boolean_expression_parse.terms(tree)).items()}
+
         def term_documents(term):
             """ Returns documents in this index that contain term """
-            return self.get_only_documents_for_term(term)
+            return self.get_only_documents_for_term(term) if term in df else Bitmap()
 
         def rest_documents(documents_set):
             """ Returns set difference between this index's documents and documents_set"""
             return self.get_documents_not_in(documents_set)
 
-        # get a BooleanExpressionParser, which will evaluate the query
-        bparser = BooleanExpressionParser(term_documents, rest_documents)
-
-        # process query text the same way as a document (do the same text preprocessing)
-        newq = ' '.join(textpreprocess(q))
-
-        return [(d, 1) for d in bparser.eval_query(newq)]
+        return boolean_expression_parse.evaluate(tree, term_documents, rest_documents, lambda term: df.get(term, 0))
 
     def processquery_vector(self, q, above=0.2, top=-1):
         """
@@ -143,32 +979,388 @@ class Collection:
         :param top: Returns top x documents if is set. Defaults to unlimited (-1)
         :return: Documents that satisfy the query
         """
-        def tf_t_d(f_t_d):
-            return 1+math.log(f_t_d) if f_t_d > 1 else 1
-
-        q_tokens = textpreprocess(q)
+        with stats.timed('query_vector'):
+            q_tokens = textpreprocess(q)
+            return self._cached(('vector', tuple(q_tokens), above, top),
+                                lambda: self._processquery_vector(q_tokens, above, top))
 
-        # S for Sums. Dict with key a document and value similarity computation
-        S = defaultdict(float)
+    def _processquery_vector(self, q_tokens, above, top):
+        idf, terms_statistics = self._get_idf(q_tokens)
+        return self.score_vector(q_tokens, idf, terms_statistics, above, top)
 
+    def _get_idf(self, q_tokens):
+        """
+        :return: tuple (dict with idf of each query token, dict with stored statistics of each query token)
+        """
         # N: count of collection documents
         N = self.get_documents_count()
 
+        # n_t: Count of documents that contain term
+        terms_statistics = self.get_terms_statistics(q_tokens)
+
+        # idf_t: inverse frequency of documents for term
+        idf = {term: math.log(1 + N / term_stats['df']) for term, term_stats in terms_statistics.items()}
+        return idf, terms_statistics
+
+    def iter_vector(self, q, above=0.2, offset=0, limit=-1):
+        """
+        Processes a query with the vector model and yields its results one by one, in decreasing order of similarity.
+        Results are the same as those of processquery_vector, in the same order.
+        :param q: query. Any sentence
+        :param above: lowest limit in similarity of documet and query. Defaults to 0.2
+        :param offset: count of results to skip
+        :param limit: max count of results. Unlimited if it is -1
+        :return: generator of tuples (document location, similarity)
+        """
+        q_tokens = textpreprocess(q)
+        idf, terms_statistics = self._get_idf(q_tokens)
+        if limit >= 0:
+            # Top-k evaluation of the results up to the last one requested
+            yield from self.score_vector(q_tokens, idf, terms_statistics, above, offset + limit)[offset:]
+        else:
+            yield from islice(self.iter_score_vector(q_tokens, idf, above), offset, None)
+
+    def iter_score_vector(self, q_tokens, idf, above=0.2):
+        """
+        Scores documents of collection for a vector model query with given term weights and yields them in decreasing
+        order of similarity. Documents are ordered incrementally with a heap, so first results are yielded without
+        sorting all of them.
+        :param q_tokens: query tokens. They must all be in collection
+        :param idf: dict with query tokens as keys and their idf as values
+        :param above: lowest limit in similarity of documet and query
+        :return: generator of tuples (document location, similarity)
+        """
+        # Position of each document breaks ties, in the same way as the stable sort of score_vector
+        heap = [(-s, i, d) for i, (d, s) in enumerate(self._score_exhaustive(q_tokens, idf, above))]
+        heapq.heapify(heap)
+
+        def ordered():
+            while heap:
+                s, _, d = heapq.heappop(heap)
+                yield d, -s
+
+        yield from self.iter_with_locations(ordered())
+
+    def score_vector(self, q_tokens, idf, terms_statistics, above=0.2, top=-1):
+        """
+        Scores documents of collection for a vector model query with given term weights. It is used by
+        processquery_vector, and by ShardedCollection with idf computed on statistics of all shards.
+        :param q_tokens: query tokens. They must all be in collection
+        :param idf: dict with query tokens as keys and their idf as values
+        :param terms_statistics: dict with query tokens as keys and dicts {'df', 'max_impact'} of collection as values
+        :param above: lowest limit in similarity of documet and query
+        :param top: Returns top x documents if is set. Unlimited if it is -1
+        :return: list of tuples (document location, similarity) in decreasing order of similarity
+        """
+        if top >= 0:
+            return self._processquery_vector_top(q_tokens, idf, terms_statistics, above, top) if top else []
+
+        if np is not None:
+            docs_for_terms = self.get_documents_for_terms(q_tokens, arrays=True)
+            with stats.timed('score'):
+                doc_ids, S, first = self._score_arrays(q_tokens, q_tokens, idf, docs_for_terms, above)
+                order = np.lexsort((doc_ids, first, -S))
+            return self.with_locations(list(zip(doc_ids[order].tolist(), S[order].tolist())))
+
+        S_passed = self._score_exhaustive(q_tokens, idf, above)
+        return self.with_locations(sorted(S_passed, key=operator.itemgetter(1), reverse=True))
+
+    def _score_exhaustive(self, q_tokens, idf, above):
+        """
+        :return: list of tuples (document id, similarity) of all documents with similarity above lower limit, in order
+         of first appearance in postings of query tokens
+        """
+        # Postings of all query terms in one go
+        docs_for_terms = self.get_documents_for_terms(q_tokens, arrays=np is not None)
+
+        # Scoring time includes fetch of L_d, which is also recorded on its own
+        with stats.timed('score'):
+            if np is not None:
+                doc_ids, S, first = self._score_arrays(q_tokens, q_tokens, idf, docs_for_terms, above)
+                order = np.lexsort((doc_ids, first))
+                return list(zip(doc_ids[order].tolist(), S[order].tolist()))
+
+            # S for Sums. Dict with key a document and value similarity computation
+            S = defaultdict(float)
+            for term in q_tokens:
+                idf_t = idf[term]
+                for d, count in zip(*docs_for_terms[term]):
+                    S[d] += tf_weight(count) * idf_t
+
+            L_d = self.get_documents_L_d(S.keys())
+            for d in S.keys():
+                S[d] /= L_d[d]
+
+            # Keep only documents with similarity above lower limit
+            return [(k, v) for k, v in S.items() if v >= above] if above > 0 else list(S.items())
+
+    def _processquery_vector_top(self, q_tokens, idf, terms_statistics, above, top):
+        """
+        Top-k evaluation of a vector model query with MaxScore dynamic pruning (term at a time).
+        Terms are processed in decreasing order of their score upper bound. Once the upper bounds of the terms left
+        sum below the score threshold (the k-th best score found so far or above), documents not seen yet cannot enter
+        the top-k, so next terms only update documents already seen and those which cannot reach the threshold are
+        dropped. L_d is fetched only for documents seen before that point. Scores of documents left are computed in
+        the same way as in exhaustive evaluation, so results are identical.
+
+        Postings of terms with at least SKIP_BLOCKS_MIN_DF documents, on storage that splits postings in blocks, are
+        fetched when their term is processed. Blocks of a term that only updates candidates are skipped when no
+        candidate in their range of ids could reach the threshold, even with the max count of term in the block.
+        """
+        q_tf = Counter(q_tokens)
+        # Upper bound of each term's contribution to a document's similarity
+        upper_bound = {term: q_tf[term] * idf[term] * terms_statistics[term]['max_impact'] * (1 + UPPER_BOUND_SLACK)
+                       for term in q_tf}
+        terms = sorted(q_tf, key=upper_bound.get, reverse=True)
+
+        long_terms = [term for term in terms if terms_statistics[term]['df'] >= SKIP_BLOCKS_MIN_DF]
+        blocks = self.get_blocks_for_terms(long_terms) if long_terms else dict()
+        short_terms = [term for term in terms if term not in blocks]
+        docs_for_terms = self.get_documents_for_terms(short_terms, arrays=np is not None) if short_terms else dict()
+
+        with stats.timed('score'):
+            if np is not None:
+                result = self._maxscore_arrays(q_tokens, terms, docs_for_terms, blocks, q_tf, idf, upper_bound, above,
+                                               top)
+            else:
+                result = self._maxscore(q_tokens, terms, docs_for_terms, blocks, q_tf, idf, upper_bound, above, top)
+        return self.with_locations(result)
+
+    def _score_arrays(self, q_tokens, terms, idf, docs_for_terms, above):
+        """
+        Vectorized scoring of all documents that contain any query token. Similarities are summed in the order of query
+        tokens and with weights computed by tf_weight, so that they are identical to those of pure Python scoring.
+        :param q_tokens: query tokens
+        :param terms: distinct query tokens, in the order that breaks ties of similarity
+        :param idf: dict with query tokens as keys and their idf as values
+        :param docs_for_terms: dict with query tokens as keys and their Postings of numpy arrays as values
+        :param above: lowest limit in similarity of documet and query
+        :return: tuple of arrays (document ids in ascending order, similarities, index in terms of first term in whose
+         postings each document appears), with documents above lower limit only
+        """
+        arrays = {term: docs_for_terms[term] for term in dict.fromkeys(q_tokens)}
+        doc_ids = np.unique(np.concatenate([ids for ids, _ in arrays.values()])) if arrays else \
+            np.zeros(0, dtype=np.int64)
+
+        # Documents' positions in dense space of documents found, and weights of postings
+        positions = dict()
+        weights = dict()
+        for term, (ids, counts) in arrays.items():
+            positions[term] = np.searchsorted(doc_ids, ids)
+            weights[term] = tf_weights(counts) * idf[term]
+
+        S = np.zeros(len(doc_ids))
         for term in q_tokens:
-            docs_for_term = self.get_documents_for_term(term)
-            # n_t: Count of documents that contain term
-            n_t = len(docs_for_term)
+            # Document ids are distinct in postings of a term, so fancy indexing adds every posting
+            S[positions[term]] += weights[term]
+
+        S /= self.get_documents_L_d_array(doc_ids)
+
+        first = np.full(len(doc_ids), len(terms), dtype=np.int64)
+        for i, term in reversed(list(enumerate(terms))):
+            first[positions[term]] = i
 
-            # idf_t: inverse frequency of documents for term
-            idf_t = math.log(1 + N / n_t)
+        if above > 0:
+            passed = S >= above
+            return doc_ids[passed], S[passed], first[passed]
+        return doc_ids, S, first
+
+    def _maxscore_arrays(self, q_tokens, terms, docs_for_terms, blocks, q_tf, idf, upper_bound, above, top):
+        """
+        Vectorized MaxScore, the same as _maxscore over numpy arrays. Candidates are kept as a sorted array of document
+        ids with arrays of their partial similarities, L_d and index in terms of the first term in whose postings they
+        appear. Postings of terms that only update candidates are matched against them with a binary search, and L_d is
+        fetched only for candidates.
+        :return: list of tuples (document id, similarity) of top documents, ordered as by exhaustive evaluation
+        """
+        remaining = sum(upper_bound.values())
+        threshold = above if above > 0 else 0
+
+        candidates = np.zeros(0, dtype=np.int64)
+        partial = np.zeros(0)
+        L_d = np.zeros(0)
+        first = np.zeros(0, dtype=np.int64)
+        weights = dict()
+        for i, term in enumerate(terms):
+            if term in blocks:
+                needed = blocks[term]
+                if remaining < threshold:
+                    limit = threshold - max(remaining - upper_bound[term], 0)
+                    needed = [block for block in needed
+                              if _may_reach(block, candidates, partial, L_d, q_tf[term] * idf[term], limit)]
+                    stats.incr('postings_blocks_skipped', len(blocks[term]) - len(needed))
+                docs_for_terms[term] = self.get_documents_for_blocks(term, needed, arrays=True)
+            ids, counts = docs_for_terms[term]
+            weights[term] = tf_weights(counts)
+            if remaining >= threshold:  # any document may still enter the top-k
+                if len(candidates):
+                    new = ids[~_match(candidates, ids)[1]]
+                else:
+                    new = ids
+                if len(new):
+                    # Both arrays are sorted, so positions of their elements in the merged array are found without
+                    # sorting it
+                    size = len(candidates) + len(new)
+                    old_positions = np.arange(len(candidates)) + np.searchsorted(new, candidates)
+                    new_positions = np.arange(len(new)) + np.searchsorted(candidates, new)
+                    candidates = _spread(candidates, old_positions, size, 0)
+                    candidates[new_positions] = new
+                    partial, L_d, first = (_spread(partial, old_positions, size, 0),
+                                           _spread(L_d, old_positions, size, 0),
+                                           _spread(first, old_positions, size, i))
+                    L_d[new_positions] = self.get_documents_L_d_array(new)
+                positions, matched = np.searchsorted(candidates, ids), slice(None)
+            else:  # only candidates may enter the top-k
+                positions, matched = _match(candidates, ids)
+                positions = positions[matched]
+            partial[positions] += weights[term][matched] * (q_tf[term] * idf[term]) / L_d[positions]
+            remaining = max(remaining - upper_bound[term], 0)
+
+            if len(partial) >= top:
+                threshold = max(threshold, np.partition(partial, len(partial) - top)[len(partial) - top])
+            if remaining < threshold:
+                kept = partial + remaining >= threshold
+                candidates, partial, L_d, first = candidates[kept], partial[kept], L_d[kept], first[kept]
+        stats.incr('maxscore_candidates', len(candidates))
+
+        # Exact similarity of candidates, summed in query order as in exhaustive evaluation
+        S = np.zeros(len(candidates))
+        for term in q_tokens:
+            positions, matched = _match(candidates, docs_for_terms[term][0])
+            S[positions[matched]] += weights[term][matched] * idf[term]
+        S /= L_d
 
-            for doc_entry in docs_for_term:
-                S[doc_entry['doc']] += tf_t_d(doc_entry['count']) * idf_t
+        if above > 0:
+            passed = S >= above
+            candidates, S, first = candidates[passed], S[passed], first[passed]
+        order = np.lexsort((candidates, first, -S))[:top]
+        return list(zip(candidates[order].tolist(), S[order].tolist()))
 
-        for d in S.keys():
-            S[d] /= self.get_document_L_d(d)
+    def _maxscore(self, q_tokens, terms, docs_for_terms, blocks, q_tf, idf, upper_bound, above, top):
+        remaining = sum(upper_bound.values())
+        threshold = above if above > 0 else 0
+
+        partial = dict()  # dict with candidate documents as keys and lower bounds of their similarity as values
+        counts = defaultdict(dict)  # dict with candidate documents as keys and their {term: count} as values
+        L_d = dict()
+        for term in terms:
+            weight = q_tf[term] * idf[term]
+            if term in blocks:
+                needed = blocks[term]
+                if remaining < threshold:
+                    limit = threshold - max(remaining - upper_bound[term], 0)
+                    ids = sorted(partial)
+                    values, lengths = [partial[d] for d in ids], [L_d[d] for d in ids]
+                    needed = [block for block in needed if _may_reach(block, ids, values, lengths, weight, limit)]
+                    stats.incr('postings_blocks_skipped', len(blocks[term]) - len(needed))
+                docs_for_terms[term] = self.get_documents_for_blocks(term, needed)
+            docs_for_term = docs_for_terms[term]
+            if remaining >= threshold:  # any document may still enter the top-k
+                L_d.update(self.get_documents_L_d([d for d in docs_for_term.doc_ids if d not in partial]))
+                for d, count in zip(*docs_for_term):
+                    partial[d] = partial.get(d, 0) + tf_weight(count) * weight / L_d[d]
+                    counts[d][term] = count
+            else:  # only candidates may enter the top-k
+                for d, count in zip(*docs_for_term):
+                    if d in partial:
+                        partial[d] += tf_weight(count) * weight / L_d[d]
+                        counts[d][term] = count
+            remaining = max(remaining - upper_bound[term], 0)
+
+            if len(partial) >= top:
+                threshold = max(threshold, heapq.nlargest(top, partial.values())[-1])
+            if remaining < threshold:
+                partial = {d: s for d, s in partial.items() if s + remaining >= threshold}
+
+        # Exact similarity of candidates, summed in query order as in exhaustive evaluation
+        S = dict()
+        for d in partial:
+            s = 0.0
+            for term in q_tokens:
+                if term in counts[d]:
+                    s += tf_weight(counts[d][term]) * idf[term]
+            S[d] = s / L_d[d]
 
-        # Keep only top k and with similarity above lower limit
         S_passed = [(k, v) for k, v in S.items() if v >= above] if above > 0 else S.items()
-        return sorted(S_passed, key=operator.itemgetter(1), reverse=True) if top < 0 else heapq.nlargest(top, S_passed, key=operator.itemgetter(1))
+        return heapq.nlargest(top, S_passed, key=operator.itemgetter(1))
+
+
+def tf_weights(counts):
+    """
+    :param counts: numpy array of counts of a term in documents
+    :return: numpy array of tf_weight of each count. Weights are looked up in a table computed by tf_weight, so that
+     they are identical to those of pure Python scoring
+    """
+    global _tf_weights_table
+    if not len(counts):
+        return np.zeros(0)
+    max_count = int(counts.max())
+    table = _tf_weights_table
+    if table is None or max_count >= len(table):
+        size = max(max_count + 1, 2 * len(table) if table is not None else TF_WEIGHTS_TABLE_SIZE)
+        table = np.array([tf_weight(count) for count in range(size)], dtype=np.float64)
+        _tf_weights_table = table
+    return table[counts]
+
+
+def _may_reach(block, candidates, partial, L_d, weight, limit):
+    """
+    Checks if postings of a term in a block may lift a candidate to a partial similarity
+    :param block: block header {'min_id', 'max_id', 'max_tf'} of postings of term
+    :param candidates: sorted list or numpy array of ids of candidate documents
+    :param partial: list or numpy array of partial similarities of candidates
+    :param L_d: list or numpy array of L_d of candidates
+    :param weight: weight of term in query times its idf
+    :param limit: least partial similarity that a candidate needs after term
+    :return: True if a candidate in the range of ids of block may reach limit with the max count of term in block
+    """
+    start, end = bisect.bisect_left(candidates, block['min_id']), bisect.bisect_right(candidates, block['max_id'])
+    bound = tf_weight(block['max_tf']) * weight * (1 + UPPER_BOUND_SLACK)
+    if np is not None and isinstance(partial, np.ndarray):
+        return end > start and bool((partial[start:end] + bound / L_d[start:end]).max() >= limit)
+    return any(p + bound / length >= limit for p, length in zip(partial[start:end], L_d[start:end]))
+
+
+def _spread(values, positions, size, fill):
+    """ :return: numpy array of size with values at positions and fill everywhere else """
+    ans = np.full(size, fill, dtype=values.dtype)
+    ans[positions] = values
+    return ans
+
+
+def _match(sorted_ids, ids):
+    """
+    :return: tuple (positions of ids in sorted_ids, boolean mask of ids that are in sorted_ids)
+    """
+    positions = np.searchsorted(sorted_ids, ids)
+    matched = positions < len(sorted_ids)
+    matched[matched] = sorted_ids[positions[matched]] == ids[matched]
+    return positions, matched
+
+
+def search(collection, model, q, above=0.2, top=-1, offset=0, limit=-1):
+    """
+    Processes a query and returns a page of its results. If collection has a query cache the whole result is cached
+    and sliced, otherwise results are produced lazily up to the last one requested.
+    :param collection: Collection or ShardedCollection
+    :param model: 'boolean' or 'vector'
+    :param q: query
+    :param above: lowest limit in similarity of documet and query. Valid only for vector model
+    :param top: top k documents of vector model. Unlimited if it is -1
+    :param offset: count of results to skip
+    :param limit: max count of results. Unlimited if it is -1
+    :return: iterable of tuples (document location, similarity)
+    """
+    # Results from offset till limit, and till top for vector model
+    end = -1 if limit < 0 else offset + limit
+    if model == 'vector' and top >= 0:
+        end = top if end < 0 else min(end, top)
+    limit = -1 if end < 0 else max(end - offset, 0)
 
+    if collection.query_cache is not None:
+        # Whole result is cached
+        result = collection.processquery_boolean(q) if model == 'boolean' else \
+            collection.processquery_vector(q, above=above, top=top)
+        return islice(result, offset, None if end < 0 else end)
+    return collection.iter_boolean(q, offset, limit) if model == 'boolean' else \
+        collection.iter_vector(q, above=above, offset=offset, limit=limit)
@@ -3,96 +3,145 @@
 import re
 import sys
 from urllib.error import HTTPError
-from urllib.parse import urljoin
 
-from bs4 import SoupStrainer
 from collection import Collection
 from document import WebDocument
+from fetcher import Fetcher, RejectedResponse
+from frontier import Frontier
 from mongo_initials import *
+import stats
 
 RE_LINKSPLIT = re.compile(r"[?#]")
 
+# Count of crawled links between two checkpoints of collection and frontier
+CHECKPOINT_EVERY = 1000
+
+# HTTP status codes of pages that no longer exist. Their documents are deleted on re-crawl
+GONE_CODES = {404, 410}
+
 
 class Webcrawler:
-    def __init__(self, initial_links=list()):
-        # self.links: dict with key each link that has been collected and value True if it has been visited by crawler
-        self.links = dict()
-        # bad_lnks: set with links that are not good for indexing and/or link scanning for any reason and they must not be included in any activity
-        self.badlinks = set()
+    def __init__(self, initial_links=list(), fetcher=None, frontier=None, checkpoint_every=CHECKPOINT_EVERY):
+        """
+        :param initial_links: list with links to start crawling from
+        :param fetcher: Fetcher object used to download documents. If it is not given, a Fetcher with default limits is
+         used
+        :param frontier: Frontier object with links to crawl. If it is not given, a Frontier in a temporary directory is
+         used. Pass a Frontier created with resume set, to continue a previous crawl
+        :param checkpoint_every: count of crawled links after which collection is flushed and frontier is written to
+         disk, so that an interrupted crawl can be resumed from that point
+        """
+        # self.frontier: links that have been collected, by depth, and links that have been visited or rejected
+        self.frontier = frontier if frontier is not None else Frontier()
+        self.fetcher = fetcher if fetcher is not None else Fetcher()
+        self.checkpoint_every = checkpoint_every
         for l in initial_links:
             self.addlink(l)
 
-    def markvisited(self, link):
-        self.links[link] = True
-
-    def markbad(self, link):
-        del self.links[link]
-        self.badlinks.add(link)
-
-    def addlink(self, link):
-        if link not in self.links and link not in self.badlinks:
-            self.links[RE_LINKSPLIT.split(link, 1)[0]] = False
+    def addlink(self, link, depth=None):
+        """ Adds link to frontier, if it has not been seen. Defaults to current depth """
+        self.frontier.add(RE_LINKSPLIT.split(link, 1)[0], depth)
 
     def addlinks_and_crawl(self, links=list()):
         for l in links:
             self.addlink(l)
         self.crawl()
 
-    def crawl(self, maxdepth=-1, collection=None):
+    def checkpoint(self, collection=None):
+        """ Writes collection and then frontier, so that frontier never has links marked done that are not stored """
+        if collection:
+            collection.flush_to_mongo()
+        self.frontier.checkpoint()
+
+    def crawl(self, maxdepth=-1, collection=None, recrawl=False):
         """
-        Crawls the Web starting from a list with initial links (self.links).
+        Crawls the Web starting from links in self.frontier. Links of each depth are fetched concurrently by
+        self.fetcher, and next depth starts when all of them are done.
         :param maxdepth: This is the depth that crawler will reach. Initial links are in depth 0. Links of initial links
          are in depth 1 and etc. Defaults to unlimited (-1).
         :param collection: Collection object. If it is given it will call collection.read_document function for every
          web document that is read.
+        :param recrawl: If it is set, documents already in collection are refreshed: they are requested with
+         conditional GETs on their stored ETag and Last-Modified, and they are re-indexed only if their content has
+         changed. Documents of pages that no longer exist are deleted. It needs collection.
         :return:
         """
-        c = 0  # DEBUG: counter
-        depth = 0
-        # Loop till all documents in self.links are read
-        while not all(self.links.values()) and c<50:
-            print('depth: {}'.format(depth), file=sys.stderr)  # DEBUG
-            # Get links which have not been visited
-            links_to_visit = [l for l, v in self.links.items() if not v]
-            for link in links_to_visit:
-                c += 1
-                if c>50:
-                    break
-                print("\rCount {}".format(c), end='', flush=True)  # DEBUG
+        get_headers = None
+        if recrawl:
+            def get_headers(link):
+                """ Conditional request headers of link, if it is in collection """
+                metadata = collection.get_document_metadata(link)
+                headers = dict()
+                if metadata is not None:
+                    if metadata['etag']:
+                        headers['If-None-Match'] = metadata['etag']
+                    if metadata['last_modified']:
+                        headers['If-Modified-Since'] = metadata['last_modified']
+                return headers
+
+        # Loop till all links in frontier are read
+        while self.frontier.pending_count() > 0 and (maxdepth < 0 or self.frontier.depth <= maxdepth):
+            depth = self.frontier.depth
+            print('depth: {}, links: {}'.format(depth, self.frontier.pending_count()), file=sys.stderr)
+            crawled = 0
+            for link, response, error in self.fetcher.fetch_all(self.frontier.pending(), get_headers=get_headers):
                 try:
-                    # Create web doc
-                    webdoc = WebDocument(link)
-                    # Get a parser (soup) for doc
-                    soup = webdoc.get_soup(parse_only=SoupStrainer("a"))
-                    if soup:
-                        # For each <a> in doc add link to self.links
-                        for a in soup.find_all('a', href=True):
-                            l = a['href']
-                            if not (l[0] == '#' or l.startswith('mailto')):
-                                if l.startswith('http'):  # absolute links
-                                    self.addlink(l)
-                                else:                     # relative links
-                                    self.addlink(urljoin(webdoc.location, l))
-                        if collection:
-                            collection.read_document(webdoc)
-                            # threading.Thread(target=collection.read_document(webdoc)).start()
-                        self.markvisited(link)
-                    else:  # if soup does not exist something's wrong with this doc
-                        self.markbad(link)
-                # if we get an HTTP error or anything goes wrong, mark bad the document and go on
+                    if error is not None:
+                        raise error
+                    self.process_response(response, depth, collection, recrawl)
+                # if we get an HTTP error or anything goes wrong, the document is rejected and we go on
                 except HTTPError as e:
                     print("{} returned code error {}".format(link, e.code), file=sys.stderr)
-                    self.markbad(link)
-                except:
+                    stats.incr('pages_failed')
+                    if recrawl and e.code in GONE_CODES and collection.delete_document(link):
+                        stats.incr('pages_deleted')
+                except RejectedResponse as e:
+                    print("{} rejected: {}".format(link, e), file=sys.stderr)
+                    stats.incr('pages_rejected')
+                except Exception:
                     print("Unknown error for {}".format(link), file=sys.stderr)
-                    self.markbad(link)
+                    stats.incr('pages_failed')
+                self.frontier.mark_done(link)
+
+                crawled += 1
+                if crawled % self.checkpoint_every == 0:
+                    self.checkpoint(collection)
+
+            self.checkpoint(collection)
+            self.frontier.next_depth()
 
-            if depth-maxdepth == 0:
-                break
-            depth += 1
+    def process_response(self, response, depth, collection=None, recrawl=False):
+        """
+        Adds links of a fetched page to next depth of frontier and reads page in collection
+        :param response: Response of page
+        :param depth: depth of page
+        :param collection: Collection object or None
+        :param recrawl: If it is set, page is re-indexed only if it has changed since it was stored in collection
+        """
+        if response.status == 304:  # not modified since it was stored
+            stats.incr('pages_not_modified')
+            return
+        # Web doc on fetched response. Its location is the final url, in case we were redirected
+        webdoc = WebDocument(response.url, response)
+        # Doc is parsed once for both links and text
+        if webdoc.parse():
+            # For each <a> in doc add link to next depth of frontier
+            for l in webdoc.get_links():
+                self.addlink(l, depth + 1)
+            if recrawl:
+                if collection.update_document(webdoc, webdoc.get_metadata()):
+                    stats.incr('pages_updated')
+            elif collection:
+                collection.read_document(webdoc, webdoc.get_metadata())
+            stats.incr('pages_crawled')
+        else:  # if it is not an html doc something's wrong with this doc
+            stats.incr('pages_rejected')
 
     def getlinks(self):
-        return self.links.keys()
+        return self.frontier.links()
+
+    def close(self):
+        self.frontier.close()
 
 
 if __name__ == '__main__':
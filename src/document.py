@@ -1,17 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import codecs
+import hashlib
 import io
+import os
 import re
 import urllib.request
+from urllib.parse import urljoin
 from abc import abstractmethod
 from collections import Counter
+from functools import lru_cache
 
-from bs4 import BeautifulSoup
+from lxml import etree
+from fetcher import Response, USER_AGENT, ACCEPT_ENCODING, TIMEOUT, check_response, read_body
+import stats
 from stemming.porter2 import stem
 
 
 RE_LINKS = re.compile(r'https?\S+')
 RE_NONALPHABETIC = re.compile(r'[^ \w-]+')
+# Single pass equivalent of RE_LINKS and RE_NONALPHABETIC substitutions and split. It matches either a link, which is
+# skipped, or a word (group 1): a run of letters, numbers, '_' and '-' that stops where a link starts
+RE_TOKENS = re.compile(r'https?\S+|((?:(?!https?\S)[\w-])+)')
+
+# Count of stems that a Tokenizer keeps in its cache
+STEM_CACHE_SIZE = 100000
+
+# Charset declared in a <meta> tag, which is looked for in the first bytes of html documents without a charset header
+RE_META_CHARSET = re.compile(br'''<meta[^>]+charset=["']?([\w-]+)''', re.IGNORECASE)
+META_CHARSET_BYTES = 2048
+
+# Elements whose content is not text of an html document
+SKIPPED_ELEMENTS = {'script', 'style', 'template'}
 
 """
 RE_CHARSET = re.compile(r"<head>.*?charset=\"?[\w-]+")
@@ -46,6 +66,55 @@ stopwords = {"i","me","my","myself","we","our","ours","ourselves","you",
                  "t","can","will","just","don","should","now"}  # {and, or, not} deleted
 
 
+class Tokenizer:
+    """
+    Text tokenizer. Text is preprocessed in the following way:
+            1. links removal
+            2. Non-alphabetic removal. Every character that is not a letter or a number or '_' or '-' is removed
+            3. stopwords removal
+            4. words stemming
+    Words are found with a single regular expression pass and stems are kept in a bounded LRU cache, since words of
+    natural language texts repeat a lot.
+    """
+
+    def __init__(self, cache_size=STEM_CACHE_SIZE):
+        """
+        :param cache_size: max count of stems in cache
+        """
+        self.stem = lru_cache(maxsize=cache_size)(stem)
+
+    def tokenize(self, text):
+        """
+        :param text:
+        :return: tokens of text after processing
+        """
+        with stats.timed('tokenize'):
+            cached_stem = self.stem
+            words = (word.lower() for word in RE_TOKENS.findall(text) if word)
+            tokens = [cached_stem(word) for word in words if word not in stopwords]
+        stats.incr('tokenize_chars', len(text))
+        stats.incr('tokens', len(tokens))
+        return tokens
+
+    def tokenize_many(self, texts):
+        """
+        :param texts: iterable of texts
+        :return: list with tokens of each text
+        """
+        return [self.tokenize(text) for text in texts]
+
+    def cache_stats(self):
+        """
+        :return: dict with stem cache statistics: hits, misses, size and maxsize
+        """
+        info = self.stem.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
+
+
+# Tokenizer used by textpreprocess
+tokenizer = Tokenizer()
+
+
 def textpreprocess(text):
     """
     Text is preprocessed in the following way:
@@ -56,19 +125,91 @@ def textpreprocess(text):
     :param text:
     :return: tokens of text after processing
     """
+    return tokenizer.tokenize(text)
 
-    # clear links and nonalphabetics from text
-    text = RE_LINKS.sub(' ', text)
-    text = RE_NONALPHABETIC.sub(' ', text)
 
-    return [stem(word.lower()) for word in text.split() if word.lower() not in stopwords]
+def get_html_encoding(body, charset=None):
+    """
+    :param body: bytes of html document
+    :param charset: charset of Content-Type header, if any
+    :return: encoding of document: encoding of its byte order mark, charset of header, charset declared in a <meta>
+     tag, utf-8 if body is valid utf-8, or windows-1252
+    """
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if body.startswith(bom):
+            return encoding
+    match = RE_META_CHARSET.search(body, 0, META_CHARSET_BYTES)
+    for encoding in (charset, match.group(1).decode('ascii') if match else None):
+        if encoding:
+            try:
+                return codecs.lookup(encoding).name
+            except LookupError:
+                pass
+    try:
+        body.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'windows-1252'
+
+
+class HTMLExtractor:
+    """
+    Target of an lxml html parser, which collects text and links of a document while it is parsed, without building a
+    tree. Content of script, style and template elements and comments are not text.
+    """
+
+    def __init__(self):
+        self.text = []
+        self.links = []  # href of each <a>, in document order
+        self._skipped = 0  # depth of skipped elements that parser is in
+
+    def start(self, tag, attrib):
+        if tag in SKIPPED_ELEMENTS:
+            self._skipped += 1
+        elif tag == 'a':
+            href = attrib.get('href')
+            if href is not None:
+                self.links.append(href)
+
+    def end(self, tag):
+        if tag in SKIPPED_ELEMENTS and self._skipped:
+            self._skipped -= 1
+
+    def data(self, data):
+        if not self._skipped:
+            self.text.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return ''.join(self.text), self.links
+
+
+def extract_html(body, charset=None):
+    """
+    Extracts text and links of an html document
+    :param body: bytes of document
+    :param charset: charset of Content-Type header, if any
+    :return: tuple (text, list with href of each <a>)
+    """
+    text = body.decode(get_html_encoding(body, charset), 'replace')
+    if not text.strip():
+        return '', []
+    parser = etree.HTMLParser(target=HTMLExtractor())
+    parser.feed(text)
+    return parser.close()
 
 
 class Document:
     """
-    Document Base Class
+    Document Base Class. Documents are equal if they have the same location. Attributes are declared in __slots__, so
+    that many documents can be kept in memory while they wait to be indexed.
     """
 
+    __slots__ = ('location',)
+
     def __int__(self, location):
         self.location = location
 
@@ -81,7 +222,8 @@ class Document:
         return NotImplemented
 
     def __hash__(self):
-        return hash(tuple(sorted(self.__dict__.items())))
+        # Consistent with __eq__. Hash of a string is computed once and cached in the string itself
+        return hash(self.location)
 
     @abstractmethod
     def open(self):
@@ -111,11 +253,21 @@ class LocalDocument(Document):
     """
     Document that is stored locally as a file
     """
-    def __init__(self, location):
+
+    __slots__ = ('name',)
+
+    def __init__(self, location, root=None):
+        """
+        :param location: path of file
+        :param root: directory that files are indexed from. Document is stored under its path relative to root, so
+         that files with the same name in different subdirectories are different documents. If it is not given,
+         document is stored under its file name
+        """
         super().__int__(location)
+        self.name = os.path.relpath(location, root) if root is not None else os.path.basename(location)
 
     def __str__(self):
-        return self.location.rsplit('/', 1)[1]
+        return self.name
 
     def open(self):
         return io.open(self.location, "r", encoding="utf-8")
@@ -125,34 +277,94 @@ class LocalDocument(Document):
             text = f.read()
         return text
 
+    def get_etag(self):
+        """
+        :return: validator of file from its size and modification time, which changes whenever file is written
+        """
+        st = os.stat(self.location)
+        return '"{:x}-{:x}"'.format(st.st_size, st.st_mtime_ns)
+
+    def get_metadata(self):
+        """
+        :return: dict with validator ('etag') and content hash ('hash') of file, in the format of
+         :meth:`WebDocument.get_metadata`
+        """
+        etag = self.get_etag()
+        with io.open(self.location, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        return {'etag': etag, 'last_modified': None, 'hash': content_hash}
+
 
 class WebDocument(Document):
     """
-    HTML Document in the Web
+    HTML Document in the Web. It is downloaded and parsed only once; response, text and links are cached.
     """
-    def __init__(self, location):
+
+    __slots__ = ('response', 'text', 'links')
+
+    def __init__(self, location, response=None):
+        """
+        :param location: url of document
+        :param response: Response of document, if it has already been fetched
+        """
         super().__int__(location)
+        self.response = response
+        self.text = None
+        self.links = None  # hrefs of document. It is set when document is parsed
 
     def open(self):
-        req = urllib.request.urlopen(self.location)
+        request = urllib.request.Request(self.location, headers={'User-Agent': USER_AGENT,
+                                                                 'Accept-Encoding': ACCEPT_ENCODING})
+        req = urllib.request.urlopen(request, timeout=TIMEOUT)
         self.location = req.geturl()  # in case we were redirected
         return req
 
-    def get_soup(self, parse_only=None):
-        req = self.open()
-        return BeautifulSoup(req, "lxml", parse_only=parse_only) if req.headers.get_content_type() == 'text/html' else None
-
-    def read(self):
-        soup = self.get_soup()
-        return soup.get_text() if soup else None
+    def fetch(self):
+        """
+        Downloads document, if it has not been downloaded yet
+        :return: Response
+        :raise RejectedResponse: if it is not an html document or it is too large or too slow to download
+        """
+        if self.response is None:
+            with self.open() as req:
+                check_response(req)
+                self.response = Response(req.geturl(), req.status, req.headers, read_body(req))
+        return self.response
 
+    def parse(self):
+        """
+        Extracts text and links of document, if it has not been parsed yet
+        :return: True if it is an html document
+        """
+        if self.links is None:
+            response = self.fetch()
+            if response.get_content_type() == 'text/html':
+                with stats.timed('parse'):
+                    self.text, self.links = extract_html(response.body, response.get_content_charset())
+                stats.incr('parse_bytes', len(response.body))
+            else:
+                self.links = []
+        return self.text is not None
+
+    def get_links(self):
+        """
+        :return: generator of absolute urls of links (<a href>) in document, except for fragments and mailto links
+        """
+        if self.parse():
+            for l in self.links:
+                if l and not (l[0] == '#' or l.startswith('mailto')):
+                    if l.startswith('http'):  # absolute links
+                        yield l
+                    else:                     # relative links
+                        yield urljoin(self.location, l)
 
-"""
-    def persist(self):
-        # Enables cache. Creates and stores BeatifulSoup object if it's not already cached 
-        self.soup = self.get_soup()
+    def read(self):
+        return self.text if self.parse() else None
 
-    def unpersist(self):
-        # Disables cache and deletes stored text. 
-        del self.soup
-"""
+    def get_metadata(self):
+        """
+        :return: dict with HTTP validators ('etag', 'last_modified') and content hash ('hash') of document
+        """
+        response = self.fetch()
+        return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                'hash': hashlib.sha1(response.body).hexdigest()}
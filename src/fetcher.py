@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+import http.client
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+import stats
+
+USER_AGENT = 'information-retrieval-crawler'
+MAX_REDIRECTS = 5
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+# Content codings that responses are decompressed from
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Timeout in seconds for connecting and for each socket read
+TIMEOUT = 10
+
+# Max time in seconds to read a whole response body. Servers that send pages slowly do not hold a connection longer
+READ_TIMEOUT = 30
+
+# Max size in bytes of a response body, after decompression
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# Response bodies are read and decompressed in chunks of that many bytes
+READ_CHUNK_SIZE = 64 * 1024
+
+# Content types of successful responses whose bodies are downloaded
+CONTENT_TYPES = ('text/html',)
+
+# Count of urls that Fetcher.fetch_all reads ahead of its requests, so that urls of other hosts are requested while the
+# hosts of earlier urls are busy or wait for their politeness delay
+SCHEDULE_WINDOW = 1000
+
+# Seconds that Fetcher.fetch_all waits before it checks again hosts whose connections are all used by other callers
+SCHEDULE_POLL = 0.05
+
+
+class RejectedResponse(Exception):
+    """
+    Raised when a response body is not downloaded, because of its content type or size, because it takes too long or
+    because it cannot be decompressed
+    """
+    pass
+
+
+class Response:
+    """
+    Fetched HTTP response
+    """
+
+    def __init__(self, url, status, headers, body):
+        """
+        :param url: final url of response, after redirects
+        :param status: HTTP status code
+        :param headers: http.client.HTTPMessage with response headers
+        :param body: response body bytes
+        """
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def get_content_type(self):
+        return self.headers.get_content_type()
+
+    def get_content_charset(self, failobj=None):
+        return self.headers.get_content_charset(failobj)
+
+
+def check_response(response, content_types=CONTENT_TYPES, max_body_size=MAX_BODY_SIZE):
+    """
+    Checks headers of a successful response before its body is read
+    :param response: http.client.HTTPResponse
+    :param content_types: accepted content types. None accepts any
+    :param max_body_size: max size in bytes of body. 0 for unlimited
+    :raise RejectedResponse: if its content type is not accepted or its Content-Length is larger than max_body_size
+    """
+    content_type = response.headers.get_content_type()
+    if content_types is not None and content_type not in content_types:
+        raise RejectedResponse("content type {}".format(content_type))
+    length = response.getheader('Content-Length')
+    if max_body_size and length and length.isdigit() and int(length) > max_body_size:
+        raise RejectedResponse("content length {}".format(length))
+
+
+def read_body(response, max_body_size=MAX_BODY_SIZE, read_timeout=READ_TIMEOUT):
+    """
+    Reads body of a response chunk by chunk and decompresses it, if it has a gzip or deflate Content-Encoding. Deflate
+    bodies may be zlib streams or, as some servers send them, raw deflate streams
+    :param response: http.client.HTTPResponse
+    :param max_body_size: max size in bytes of decompressed body. 0 for unlimited
+    :param read_timeout: max time in seconds to read whole body. 0 for unlimited
+    :return: body bytes
+    :raise RejectedResponse: if body is larger than max_body_size, it is not read in read_timeout or it is corrupt
+    """
+    encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = None
+    deadline = time.monotonic() + read_timeout if read_timeout else None
+
+    chunks = []
+    size = 0
+    head = b''  # first bytes of compressed body, till the two bytes of a zlib header
+    while True:
+        raw = response.read1(READ_CHUNK_SIZE)
+        try:
+            if decompressor is None:
+                data = raw
+            elif raw:
+                # Output is bounded, so that a small compressed body cannot expand far beyond max_body_size
+                max_length = max_body_size + 1 - size if max_body_size else 0
+                try:
+                    data = decompressor.decompress(raw, max_length)
+                except zlib.error:
+                    if encoding != 'deflate' or len(head) == 2:
+                        raise
+                    # Body has no zlib header, so it is a raw deflate stream
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    data = decompressor.decompress(head + raw, max_length)
+                if len(head) < 2:
+                    head = (head + raw[:2])[:2]
+            else:
+                data = decompressor.flush()
+        except zlib.error as e:
+            raise RejectedResponse("corrupt {} body: {}".format(encoding, e))
+        size += len(data)
+        if max_body_size and size > max_body_size:
+            raise RejectedResponse("body larger than {} bytes".format(max_body_size))
+        chunks.append(data)
+        if not raw:
+            # Response is marked done, so that its connection can be reused
+            response.close()
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise RejectedResponse("body not read in {} seconds".format(read_timeout))
+    return b''.join(chunks)
+
+
+class _Host:
+    """
+    Per host state: concurrency limit, idle keep-alive connections and politeness schedule
+    """
+
+    def __init__(self, max_connections):
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle_connections = []
+        self.next_request_time = 0
+
+    def reserve(self, delay):
+        """
+        Takes a connection and the next request turn of host, if both are free now, without waiting for them
+        :return: 0 if they are taken, seconds till the next turn of host if it has not come yet, or None if all
+         connections to host are in use
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.next_request_time:
+                return self.next_request_time - now
+            if not self.semaphore.acquire(blocking=False):
+                return None
+            self.next_request_time = now + delay
+            return 0
+
+    def wait_turn(self, delay):
+        """ Sleeps till delay seconds have passed since previous request to host was started """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request_time)
+            self.next_request_time = start + delay
+        if start > now:
+            time.sleep(start - now)
+
+    def get_connection(self):
+        with self.lock:
+            return self.idle_connections.pop() if self.idle_connections else None
+
+    def put_connection(self, connection):
+        with self.lock:
+            self.idle_connections.append(connection)
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle_connections:
+                connection.close()
+            self.idle_connections = []
+
+
+class Fetcher:
+    """
+    Concurrent HTTP fetcher. Requests are run by a pool of threads, with a global and a per host limit of concurrent
+    connections. Connections to each host are kept alive and reused, and requests to the same host can be spaced out by
+    a politeness delay. :meth:`fetch_all` schedules requests per host, so that pool threads never wait for a host.
+    """
+
+    def __init__(self, max_connections=16, max_connections_per_host=2, timeout=TIMEOUT, delay=0,
+                 read_timeout=READ_TIMEOUT, max_body_size=MAX_BODY_SIZE, content_types=CONTENT_TYPES):
+        """
+        :param max_connections: max count of concurrent requests
+        :param max_connections_per_host: max count of concurrent requests to the same host
+        :param timeout: timeout in seconds for connecting and for each socket read
+        :param delay: min time in seconds between the start of two requests to the same host
+        :param read_timeout: max time in seconds to read a whole response body. 0 for unlimited
+        :param max_body_size: max size in bytes of a response body, after decompression. 0 for unlimited
+        :param content_types: content types of successful responses whose bodies are downloaded. Other responses are
+         rejected from their headers. None accepts any
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.delay = delay
+        self.read_timeout = read_timeout
+        self.max_body_size = max_body_size
+        self.content_types = content_types
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+        self._hosts = dict()
+        self._hosts_lock = threading.Lock()
+
+    def _get_host(self, key):
+        with self._hosts_lock:
+            if key not in self._hosts:
+                self._hosts[key] = _Host(self.max_connections_per_host)
+            return self._hosts[key]
+
+    def _new_connection(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _request(self, url, headers=None, reserved=False):
+        """
+        Makes a GET request on a pooled connection
+        :param reserved: If it is set, a connection and the request turn of url's host have already been taken by
+         :meth:`_Host.reserve`. Otherwise they are waited for
+        :return: tuple (http.client.HTTPResponse, body)
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise URLError("unknown url type: {}".format(parts.scheme))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'User-Agent': USER_AGENT, 'Connection': 'keep-alive', 'Accept-Encoding': ACCEPT_ENCODING}
+        if headers:
+            request_headers.update(headers)
+
+        host = self._get_host((parts.scheme, parts.netloc))
+        if not reserved:
+            host.semaphore.acquire()
+            host.wait_turn(self.delay)
+        try:
+            connection = host.get_connection()
+            reused = connection is not None
+            while True:
+                if connection is None:
+                    connection = self._new_connection(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', path, headers=request_headers)
+                    response = connection.getresponse()
+                    if 200 <= response.status < 300:
+                        check_response(response, self.content_types, self.max_body_size)
+                    body = read_body(response, self.max_body_size, self.read_timeout)
+                    break
+                except RejectedResponse:
+                    # Rest of body is not read, so connection cannot be reused
+                    connection.close()
+                    raise
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    if not reused:
+                        raise
+                    # Server may have closed an idle keep-alive connection. Retry once on a new one
+                    connection, reused = None, False
+
+            if response.will_close:
+                connection.close()
+            else:
+                host.put_connection(connection)
+        finally:
+            host.semaphore.release()
+        return response, body
+
+    def fetch(self, url, headers=None, reserved=False):
+        """
+        Fetches url, following redirects
+        :param url: url
+        :param headers: dict with extra request headers
+        :param reserved: If it is set, a connection and the request turn of url's host have already been taken for the
+         first request
+        :return: Response
+        :raise HTTPError: if server returns an error status code
+        :raise RejectedResponse: if body is not downloaded because of its content type, size or read time
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            try:
+                with stats.timed('fetch'):
+                    response, body = self._request(url, headers, reserved)
+            except RejectedResponse:
+                stats.incr('fetch_rejected')
+                raise
+            reserved = False
+            stats.incr('fetch_requests')
+            stats.incr('fetch_bytes', len(body))
+            location = response.getheader('Location')
+            if response.status in REDIRECT_CODES and location:
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.msg, None)
+            return Response(url, response.status, response.msg, body)
+        raise HTTPError(url, response.status, "Too many redirects", response.msg, None)
+
+    @staticmethod
+    def _host_key(url):
+        """
+        :return: tuple (scheme, netloc) of url's host or None if url is not an http(s) url, in which case it fails
+         without a request
+        """
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            return None
+        return (parts.scheme, parts.netloc) if parts.scheme in ('http', 'https') else None
+
+    def fetch_all(self, urls, headers=None, get_headers=None):
+        """
+        Fetches many urls concurrently. Urls are queued per host and a request is submitted to the pool only when its
+        host has a free connection and its politeness delay has passed, so that a host with many urls never holds pool
+        threads that other hosts could use.
+        :param urls: iterable of urls
+        :param headers: dict with extra request headers
+        :param get_headers: function that returns a dict with extra request headers of a url, e.g. conditional request
+         headers. They are added to headers
+        :return: generator of tuples (url, Response, None) or (url, None, exception), in order of completion
+        """
+        urls = iter(urls)
+        queues = dict()  # dict with host keys as keys and deques of their urls that wait for a request as values
+        queued = 0
+        exhausted = False
+        pending = dict()
+        while True:
+            # Read a bounded number of urls ahead, so that huge url lists are not queued at once
+            while not exhausted and queued < SCHEDULE_WINDOW:
+                url = next(urls, None)
+                if url is None:
+                    exhausted = True
+                    break
+                queues.setdefault(self._host_key(url), deque()).append(url)
+                queued += 1
+
+            # Submit urls of hosts that are ready, and find the time till the next turn of the others
+            timeout = None
+            for key in list(queues):
+                queue = queues[key]
+                while queue and len(pending) < self.max_connections:
+                    if key is not None:
+                        wait_time = self._get_host(key).reserve(self.delay)
+                        if wait_time != 0:
+                            if wait_time is not None:
+                                timeout = wait_time if timeout is None else min(timeout, wait_time)
+                            break
+                    url = queue.popleft()
+                    queued -= 1
+                    url_headers = headers
+                    if get_headers is not None:
+                        url_headers = dict(headers or ())
+                        url_headers.update(get_headers(url))
+                    pending[self._executor.submit(self.fetch, url, url_headers, key is not None)] = url
+                if not queue:
+                    del queues[key]
+
+            if not pending:
+                if not queues:
+                    return
+                time.sleep(timeout if timeout is not None else SCHEDULE_POLL)
+                continue
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    yield url, future.result(), None
+                except Exception as e:
+                    yield url, None, e
+
+    def close(self):
+        self._executor.shutdown()
+        with self._hosts_lock:
+            for host in self._hosts.values():
+                host.close()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import math
+import os
+import shutil
+import tempfile
+
+# Expected count of urls of the first Bloom filter and max false positive rate. When a filter is full a new one with
+# double capacity is added, so the frontier is not limited to this count of urls.
+BLOOM_CAPACITY = 1000000
+BLOOM_ERROR_RATE = 0.001
+
+QUEUE_FILE = 'queue.{:06d}'
+DONE_FILE = 'done.{:06d}'
+DEPTH_FILE = 'depth'
+
+
+class BloomFilter:
+    """
+    Scalable Bloom filter of strings. Membership tests may return false positives with probability about error_rate,
+    but never false negatives. It is a chain of fixed-size filters; a new filter with double capacity and tighter error
+    rate is added whenever the last one has reached its capacity.
+    """
+
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        """
+        :param capacity: expected count of items of the first filter
+        :param error_rate: max false positive rate
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        self._filters = []  # list of tuples (bits bytearray, count of bits, count of hashes, capacity)
+        self._add_filter()
+
+    def _add_filter(self):
+        # each new filter gets half the error rate of the previous one, so that total rate stays below error_rate
+        n = len(self._filters)
+        capacity = self.capacity << n
+        error_rate = self.error_rate / (2 << n)
+        nbits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        nhashes = max(1, round(nbits / capacity * math.log(2)))
+        self._filters.append((bytearray((nbits + 7) // 8), nbits, nhashes, capacity))
+        self._last_count = 0
+
+    @staticmethod
+    def _hashes(item):
+        # Two independent 64 bit hashes, combined as h1 + i * h2 for the i-th bit (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+    def __contains__(self, item):
+        h1, h2 = self._hashes(item)
+        for bits, nbits, nhashes, _ in self._filters:
+            for i in range(nhashes):
+                bit = (h1 + i * h2) % nbits
+                if not bits[bit >> 3] & (1 << (bit & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def add(self, item):
+        """
+        Adds item to filter
+        :return: False if item was (probably) already in filter, True otherwise
+        """
+        if item in self:
+            return False
+        if self._last_count >= self._filters[-1][3]:
+            self._add_filter()
+        bits, nbits, nhashes, _ = self._filters[-1]
+        h1, h2 = self._hashes(item)
+        for i in range(nhashes):
+            bit = (h1 + i * h2) % nbits
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self._last_count += 1
+        self.count += 1
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+class Frontier:
+    """
+    Crawl frontier kept on disk. Links of each depth are stored in an append-only queue file, and links of the depth in
+    progress that have been crawled are stored in an append-only done file. Links that have ever been queued, crawled
+    or rejected, are remembered by a Bloom filter, which is rebuilt from queue files when a crawl is resumed.
+
+    Writes are buffered in memory and go to disk on checkpoint, so that a crawl can resume from the last checkpoint.
+    """
+
+    def __init__(self, directory=None, resume=False, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        """
+        :param directory: directory of frontier files. If it is not given a temporary directory is used, which is
+         removed on close
+        :param resume: If it is set frontier continues from files of a previous crawl in directory. Otherwise any such
+         files are removed.
+        :param capacity: expected count of links. Frontier can hold more, with more memory for its Bloom filter
+        :param error_rate: max probability that a new link is considered as seen and is not crawled
+        """
+        self._temporary = directory is None
+        self.directory = tempfile.mkdtemp(prefix='frontier') if directory is None else directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.seen = BloomFilter(capacity, error_rate)
+        self.depth = 0
+        self._queued = dict()  # dict with depths as keys and lists of links to be appended to their queues as values
+        self._done = []  # links of current depth crawled since last checkpoint
+        self._done_set = set()  # links of current depth crawled before last checkpoint
+        self._queue_counts = dict()  # dict with depths as keys and count of links in their queues as values
+
+        if resume:
+            self._load()
+        else:
+            for name in os.listdir(self.directory):
+                if name == DEPTH_FILE or name.startswith(('queue.', 'done.')):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _path(self, name, depth=None):
+        return os.path.join(self.directory, name if depth is None else name.format(depth))
+
+    def _read_lines(self, path):
+        if os.path.exists(path):
+            with io.open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    yield line.rstrip('\n')
+
+    def _load(self):
+        """ Loads state of a previous crawl """
+        for line in self._read_lines(self._path(DEPTH_FILE)):
+            self.depth = int(line)
+        for name in os.listdir(self.directory):
+            if name.startswith('queue.'):
+                depth = int(name.split('.', 1)[1])
+                count = 0
+                for link in self._read_lines(self._path(name)):
+                    self.seen.add(link)
+                    count += 1
+                self._queue_counts[depth] = count
+        self._done_set = set(self._read_lines(self._path(DONE_FILE, self.depth)))
+
+    def add(self, link, depth=None):
+        """
+        Queues link, if it has not been seen before
+        :param link: url
+        :param depth: depth of link. Defaults to current depth
+        :return: True if link was queued
+        """
+        if not self.seen.add(link):
+            return False
+        depth = self.depth if depth is None else depth
+        self._queued.setdefault(depth, []).append(link)
+        self._queue_counts[depth] = self._queue_counts.get(depth, 0) + 1
+        return True
+
+    def mark_done(self, link):
+        """ Marks link of current depth as crawled, either successfully or not """
+        self._done.append(link)
+
+    def pending_count(self):
+        """ :return: count of links of current depth that have not been crawled """
+        return self._queue_counts.get(self.depth, 0) - len(self._done_set) - len(self._done)
+
+    def pending(self):
+        """
+        Links of current depth that had not been crawled at last checkpoint. Any links queued to current depth since
+        then are written to disk first.
+        :return: generator of links
+        """
+        if self._queued.get(self.depth):
+            self.checkpoint()
+        for link in self._read_lines(self._path(QUEUE_FILE, self.depth)):
+            if link not in self._done_set:
+                yield link
+
+    def checkpoint(self):
+        """ Writes buffered links to disk. Queued links are written before done ones, so that no link is lost """
+        for depth, links in self._queued.items():
+            if links:
+                with io.open(self._path(QUEUE_FILE, depth), 'a', encoding='utf-8') as f:
+                    f.writelines(link + '\n' for link in links)
+        self._queued = dict()
+        if self._done:
+            with io.open(self._path(DONE_FILE, self.depth), 'a', encoding='utf-8') as f:
+                f.writelines(link + '\n' for link in self._done)
+            self._done_set.update(self._done)
+            self._done = []
+
+    def next_depth(self):
+        """ Checkpoints and moves to next depth. Files of finished depth are kept, so that its links stay seen """
+        self.checkpoint()
+        self.depth += 1
+        self._done_set = set()
+        with io.open(self._path(DEPTH_FILE) + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(str(self.depth))
+        os.replace(self._path(DEPTH_FILE) + '.tmp', self._path(DEPTH_FILE))
+
+    def links(self):
+        """ :return: generator of all links that have been queued in any depth, in order of depth """
+        self.checkpoint()
+        for depth in sorted(self._queue_counts):
+            for link in self._read_lines(self._path(QUEUE_FILE, depth)):
+                yield link
+
+    def close(self):
+        self.checkpoint()
+        if self._temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
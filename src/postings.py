@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import math
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # postings are decoded only to lists
+    np = None
+
+# Postings list of a term: parallel lists (or numpy arrays) with document ids in ascending order and term's count in
+# each document
+Postings = namedtuple('Postings', ['doc_ids', 'counts'])
+
+
+def tf_weight(count):
+    """ Weight of a term that appears count times in a document [chapter4-vector.pdf page 14] """
+    return 1 + math.log(count) if count > 1 else 1
+
+
+def encode(doc_ids, counts):
+    """
+    Compresses a postings list to a block of bytes. Each posting is stored as a pair of varints: the gap between its
+    document id and the previous one (first gap is from 0) and the count of term in document.
+    :param doc_ids: document ids in ascending order
+    :param counts: count of term in each document
+    :return: bytes
+    """
+    block = bytearray()
+    last = 0
+    for doc_id, count in zip(doc_ids, counts):
+        for value in (doc_id - last, count):
+            while value > 0x7f:
+                block.append((value & 0x7f) | 0x80)
+                value >>= 7
+            block.append(value)
+        last = doc_id
+    return bytes(block)
+
+
+def decode(block, postings=None):
+    """
+    Decompresses a block of bytes created by :func:`encode`
+    :param block: bytes
+    :param postings: Postings to append decoded postings to. If it is not given a new one is created
+    :return: Postings
+    """
+    if postings is None:
+        postings = Postings([], [])
+    doc_ids, counts = postings
+    last = 0
+    value = shift = 0
+    is_count = False
+    for byte in block:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        if is_count:
+            counts.append(value)
+        else:
+            last += value
+            doc_ids.append(last)
+        is_count = not is_count
+        value = shift = 0
+    return postings
+
+
+def decode_array(block):
+    """
+    Decompresses a block of bytes created by :func:`encode` with numpy, without a Python loop over its bytes
+    :param block: bytes
+    :return: Postings of int64 numpy arrays
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)  # last byte of each varint
+    if len(ends) == len(data):  # every varint is one byte
+        values = data.astype(np.int64)
+    else:
+        starts = np.empty(len(ends), dtype=np.int64)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+        values = np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, starts)
+    return Postings(np.cumsum(values[0::2]), values[1::2])
+
+
+def decode_blocks(blocks, arrays=False):
+    """
+    Decompresses and concatenates blocks of a term. Blocks must be in ascending order of their document ids.
+    :param blocks: iterable of blocks
+    :param arrays: If it is set, postings are decoded to numpy arrays. numpy must be installed
+    :return: Postings
+    """
+    if arrays:
+        decoded = [decode_array(block) for block in blocks if block]
+        if not decoded:
+            return Postings(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        if len(decoded) == 1:
+            return decoded[0]
+        return Postings(np.concatenate([p.doc_ids for p in decoded]), np.concatenate([p.counts for p in decoded]))
+
+    postings = Postings([], [])
+    for block in blocks:
+        decode(block, postings)
+    return postings
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+# Max memory in bytes used by cached results
+QUERY_CACHE_SIZE = 64 * 1024 * 1024
+
+# Rough in-memory cost in bytes of a result entry (tuple, float and list slot), without its location string
+ESTIMATED_RESULT_SIZE = 120
+
+
+def estimate_size(key, result):
+    """
+    :return: estimated memory in bytes used by a cached query result
+    """
+    return sys.getsizeof(repr(key)) + sum(ESTIMATED_RESULT_SIZE + len(location) for location, _ in result)
+
+
+class QueryCache:
+    """
+    LRU cache of query results, bounded by their estimated memory size. Each result is stored with the generation of
+    the index it was computed on, and it is valid only as long as index generation stays the same. Cache can be saved
+    to a file and loaded by another process. It is safe to use from many threads.
+    """
+
+    def __init__(self, path=None, max_size=QUERY_CACHE_SIZE):
+        """
+        :param path: file where cache is loaded from and saved to. If it is not given cache lives only in memory
+        :param max_size: max estimated memory in bytes of cached results
+        """
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # dict with keys as keys and tuples (generation, result, size) as values
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with io.open(path, 'rb') as f:
+                    self._entries = pickle.load(f)
+                self.size = sum(entry[2] for entry in self._entries.values())
+            except (OSError, EOFError, pickle.UnpicklingError):
+                self._entries = OrderedDict()
+
+    def get(self, key, generation):
+        """
+        :param key: hashable key of query
+        :param generation: current index generation
+        :return: cached result or None if there is no valid result for key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, result):
+        """
+        Caches result of query, evicting least recently used results if cache exceeds its max size
+        :param key: hashable key of query
+        :param generation: index generation that result was computed on
+        :param result: list of tuples (document location, similarity)
+        """
+        size = estimate_size(key, result)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[2]
+            self._entries[key] = (generation, result, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._entries.popitem(last=False)[1][2]
+            self._dirty = True
+
+    def save(self):
+        """ Saves cache to its file, if it has changed """
+        with self._lock:
+            if self.path and self._dirty:
+                with io.open(self.path + '.tmp', 'wb') as f:
+                    pickle.dump(self._entries, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(self.path + '.tmp', self.path)
+                self._dirty = False
+
+    def __len__(self):
+        return len(self._entries)
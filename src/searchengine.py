@@ -2,16 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import cProfile
+import io
+import json
 import os
 import sys
-from collections import Set, Mapping, deque
+from collections import deque
+from collections.abc import Set, Mapping
+from functools import lru_cache
 from numbers import Number
 
-from collection import Collection
+from collection import Collection, FLUSH_POSTINGS_LIMIT, FLUSH_BYTES_LIMIT, search
 from crawler import Webcrawler
+import document
 from document import LocalDocument
+from fetcher import Fetcher, READ_TIMEOUT, MAX_BODY_SIZE
+from frontier import Frontier
 from mongo_initials import *
 from pymongo import MongoClient
+from querycache import QueryCache, QUERY_CACHE_SIZE
+from server import SearchService, make_server, SERVER_THREADS
+from sharding import ShardedCollection
+from simhash import FingerprintIndex, NEAR_DUPLICATE_DISTANCE
+import stats
+from storage import LocalStorage, COMPACT_FRAGMENTS
 
 zero_depth_bases = (str, bytes, Number, range, bytearray)
 iteritems = 'items'
@@ -40,39 +54,137 @@ def getsize(obj_0):
     return inner(obj_0)
 
 
-def get_Collection_from_mongo_initial(args):
-    mongodb = MongoClient(host=args.mongo_host, port=args.mongo_port)[args.mongo_database]
+@lru_cache(maxsize=None)
+def get_mongo_client(host, port):
+    """ :return: MongoClient of host and port. Its connection pool is shared by all collections of a process """
+    return MongoClient(host=host, port=port)
+
+
+def get_Collection_from_mongo_initial(args, database=None, near_duplicates=None):
+    mongodb = get_mongo_client(args.mongo_host, args.mongo_port)[database or args.mongo_database]
     mongo_colls = {'invertedIndex': args.mongo_collection_index, 'documents': args.mongo_collection_docs}
-    return Collection(mongodb, mongo_colls)
+    return Collection(mongodb, mongo_colls, near_duplicates=near_duplicates, **get_flush_options(args))
+
+
+def get_Collection_from_local_initial(args, directory=None, near_duplicates=None):
+    return Collection(storage=LocalStorage(directory or args.local_directory), near_duplicates=near_duplicates,
+                      **get_flush_options(args))
+
+
+def get_Collection(args):
+    # Near-duplicates are detected over all shards
+    near_duplicates = FingerprintIndex(args.near_duplicates) if args.near_duplicates >= 0 else None
+    if args.shards > 1:
+        # Shard i is kept in database <mongo-database>_shard<i> or in directory <local-directory>/shard<i>
+        if args.backend == 'local':
+            shards = [get_Collection_from_local_initial(args, os.path.join(args.local_directory, 'shard{}'.format(i)),
+                                                        near_duplicates)
+                      for i in range(args.shards)]
+        else:
+            shards = [get_Collection_from_mongo_initial(args, '{}_shard{}'.format(args.mongo_database, i),
+                                                        near_duplicates)
+                      for i in range(args.shards)]
+        return ShardedCollection(shards)
+    if args.backend == 'local':
+        return get_Collection_from_local_initial(args, near_duplicates=near_duplicates)
+    return get_Collection_from_mongo_initial(args, near_duplicates=near_duplicates)
+
+
+def report_near_duplicates(collection):
+    """ Prints count of near-duplicate documents that were not added, if near-duplicates are detected """
+    if collection.near_duplicates is not None:
+        print("Near-duplicate documents skipped: {}".format(len(collection.near_duplicates.links)), file=sys.stderr)
+
+
+def get_flush_options(args):
+    return {'flush_postings': args.flush_postings, 'flush_bytes': args.flush_mbytes * 1024 * 1024,
+            'background_flush': args.background_flush}
+
+
+def write_stats(path):
+    """
+    Writes recorded instrumentation and stem cache statistics of tokenizer as JSON to path, or to standard error if path
+    is '-'
+    """
+    ans = stats.stats.as_dict()
+    ans['tokenizer_cache'] = document.tokenizer.cache_stats()
+    if path == '-':
+        json.dump(ans, sys.stderr, indent=2)
+        print(file=sys.stderr)
+    else:
+        with io.open(path, 'w', encoding='utf-8') as f:
+            json.dump(ans, f, indent=2)
 
 
 def process_search(args):
-    collection = get_Collection_from_mongo_initial(args)
-    result = collection.processquery_boolean(args.query) if args.model == 'boolean' else \
-        collection.processquery_vector(args.query, above=args.above, top=args.top)
+    collection = get_Collection(args)
+    if args.query_cache:
+        collection.query_cache = QueryCache(args.query_cache, max_size=args.query_cache_mbytes * 1024 * 1024)
+
+    # Results are printed as they are produced, unless they are cached
+    result = search(collection, args.model, args.query, args.above, args.top, args.offset, args.limit)
     # print("\nResults:")
     similarity_format = "{},{:.2f}" if args.model == 'vector' else "{},{}"
     for d in result:
         print(similarity_format.format(d[0], d[1]))
+    if collection.query_cache is not None:
+        collection.query_cache.save()
+
+
+def process_serve(args):
+    # Server keeps its recorded values available on /stats
+    stats.enable()
+    query_cache = QueryCache(args.query_cache, max_size=args.query_cache_mbytes * 1024 * 1024) \
+        if args.query_cache_mbytes > 0 else None
+    service = SearchService(lambda: get_Collection(args), query_cache)
+    server = make_server(service, args.host, args.port, args.unix_socket, args.threads)
+    print("Serving on {}".format(args.unix_socket or 'http://{}:{}/'.format(*server.server_address[:2])),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if query_cache is not None:
+            query_cache.save()
 
 
 def process_index_local(args):
-    collection = get_Collection_from_mongo_initial(args)
-    for (dirname, _, filenames) in os.walk(args.directory):
-        for filename in filenames:
-            d = LocalDocument(os.path.join(dirname, filename))
-            collection.read_document(d)
+    collection = get_Collection(args)
+    docs = [LocalDocument(os.path.join(dirname, filename), args.directory)
+            for (dirname, _, filenames) in os.walk(args.directory) for filename in filenames]
+    counts = collection.sync_documents(docs, workers=args.workers, delete_missing=args.delete_missing)
     collection.flush_to_mongo()
+    print("Documents added: {added}, changed: {changed}, unchanged: {unchanged}, deleted: {deleted}, "
+          "near-duplicates skipped: {duplicates}".format(**counts), file=sys.stderr)
 
     if args.create_mongo_indexes:
         collection.create_mongo_indexes()
 
 
+def process_compact(args):
+    collection = get_Collection(args)
+    print("Compacted {} terms".format(collection.compact(args.min_fragments, args.full)), file=sys.stderr)
+
+
 def process_web_crawl(args):
-    collection = get_Collection_from_mongo_initial(args)
-    crawler = Webcrawler([l.strip("'\s") for l in args.seed])
-    crawler.crawl(maxdepth=args.max_depth, collection=collection)
+    collection = get_Collection(args)
+    fetcher = Fetcher(max_connections=args.max_connections, max_connections_per_host=args.max_connections_per_host,
+                      timeout=args.timeout, delay=args.delay, read_timeout=args.read_timeout,
+                      max_body_size=args.max_body_mbytes * 1024 * 1024)
+    frontier = Frontier(args.frontier_directory, resume=args.resume)
+    crawler = Webcrawler([l.strip("'\s") for l in args.seed or []], fetcher, frontier)
+    if args.recrawl:
+        # Every stored document is checked again
+        for location in sorted(collection.get_locations()):
+            crawler.addlink(location)
+    crawler.crawl(maxdepth=args.max_depth, collection=collection, recrawl=args.recrawl)
+    fetcher.close()
+    crawler.close()
     collection.flush_to_mongo()
+    report_near_duplicates(collection)
 
     if args.create_mongo_indexes:
         collection.create_mongo_indexes()
@@ -87,27 +199,81 @@ if __name__ == '__main__':
     parser_search.add_argument('-m', '--model', choices=["boolean", "vector"], required=True, help="Model to use for quering")
     parser_search.add_argument('--above', type=float, default=0.2, help="Lower limit in document-query similarity. Default: 0.2. Valid only for vector model")
     parser_search.add_argument('--top', type=int, default=-1, help="Top k documents based on document-query similarity. Default: Unlimited (-1). Valid only for vector model")
+    parser_search.add_argument('--offset', type=int, default=0, help="Count of results to skip, for paging. Default: 0")
+    parser_search.add_argument('--limit', type=int, default=-1, help="Max count of results to print, for paging. Default: Unlimited (-1)")
+    parser_search.add_argument('--query-cache', help="File where query results are cached between runs. Cached results are used till index changes. Default: no cache")
+    parser_search.add_argument('--query-cache-mbytes', type=int, default=QUERY_CACHE_SIZE // (1024 * 1024), help="Max estimated size in megabytes of cached query results. Default: {}".format(QUERY_CACHE_SIZE // (1024 * 1024)))
     parser_search.add_argument('query', help="Query. Logic expression with keywords and {AND, NOT, OR} for boolean model, anything for vector model.")
     parser_search.set_defaults(func=process_search)
 
-    parser_index_local = subparsers.add_parser("index-local", help="Index local documents")
-    parser_index_local.add_argument('-D', '--directory', default="documents", help="Directory which contains documents to index. Default: documents")
+    parser_serve = subparsers.add_parser("serve", help="Serve queries over HTTP. Index and caches stay in memory between queries. Endpoints: /search?q=QUERY&model=vector|boolean&above=&top=&offset=&limit=, /stats and /health")
+    parser_serve.add_argument('--host', default="127.0.0.1", help="Host to listen on. Default: 127.0.0.1")
+    parser_serve.add_argument('--port', type=int, default=8080, help="Port to listen on. Default: 8080")
+    parser_serve.add_argument('--unix-socket', help="Path of a Unix socket to listen on, instead of host and port. Default: none")
+    parser_serve.add_argument('--threads', type=int, default=SERVER_THREADS, help="Count of requests handled concurrently. Default: {}".format(SERVER_THREADS))
+    parser_serve.add_argument('--query-cache', help="File where query results cache is loaded from and saved to on exit. Default: cache is kept only in memory")
+    parser_serve.add_argument('--query-cache-mbytes', type=int, default=QUERY_CACHE_SIZE // (1024 * 1024), help="Max estimated size in megabytes of cached query results. 0 disables cache. Default: {}".format(QUERY_CACHE_SIZE // (1024 * 1024)))
+    parser_serve.set_defaults(func=process_serve)
+
+    parser_index_local = subparsers.add_parser("index-local", help="Index local documents. Only new files and files that have changed since they were indexed (by size and modification time, then by content hash) are read. Changed files are indexed again")
+    parser_index_local.add_argument('-D', '--directory', default="documents", help="Directory which contains documents to index. Documents are stored under their paths relative to it. Default: documents")
+    parser_index_local.add_argument('-w', '--workers', type=int, default=1, help="Count of worker processes that tokenize documents in parallel. Default: 1")
+    parser_index_local.add_argument('--delete-missing', action='store_true', help="If is set, indexed documents whose files are no longer in directory are deleted. Use it only on an index of this directory alone")
     parser_index_local.set_defaults(func=process_index_local)
 
+    parser_compact = subparsers.add_parser("compact", help="Merge small blocks of postings (MongoDB) or segments (local index) that flushes leave behind and drop postings of deleted documents from them. Indexing does it on its own for terms with {} small blocks or {} segments".format(COMPACT_FRAGMENTS, COMPACT_FRAGMENTS))
+    parser_compact.add_argument('--min-fragments', type=int, default=2, help="Only terms with at least that many small blocks, or at least that many segments, are merged. Default: 2")
+    parser_compact.add_argument('--full', action='store_true', help="If is set, the whole index is rewritten, so that no postings of deleted documents are left")
+    parser_compact.set_defaults(func=process_compact)
+
     parser_web_crawl = subparsers.add_parser("web-crawl", help="Crawl the Web. This crawls the web and collects links from sites and indexes every site that has been visited")
-    parser_web_crawl.add_argument('-s', '--seed', required=True, type=str, nargs='+', help="Initial link(s) for crawl beginning")
+    parser_web_crawl.add_argument('-s', '--seed', type=str, nargs='+', help="Initial link(s) for crawl beginning. Required unless --resume or --recrawl is set")
     parser_web_crawl.add_argument('-m', '--max-depth', type=int, default=-1, help="This is the depth that crawler will reach. Initial links are in depth 0. Links of initial links are in depth 1 and etc. Default: Unlimited (-1)")
+    parser_web_crawl.add_argument('-c', '--max-connections', type=int, default=16, help="Max count of pages that are fetched concurrently. Default: 16")
+    parser_web_crawl.add_argument('--max-connections-per-host', type=int, default=2, help="Max count of pages of the same host that are fetched concurrently. Default: 2")
+    parser_web_crawl.add_argument('-t', '--timeout', type=float, default=10, help="Timeout in seconds for connecting to a host and for each read. Default: 10")
+    parser_web_crawl.add_argument('--read-timeout', type=float, default=READ_TIMEOUT, help="Max time in seconds to download a whole page. Slower pages are rejected. 0 disables this limit. Default: {}".format(READ_TIMEOUT))
+    parser_web_crawl.add_argument('--max-body-mbytes', type=int, default=MAX_BODY_SIZE // (1024 * 1024), help="Max size in megabytes of a page, after decompression. Larger pages are rejected, from their Content-Length header when they have one. 0 disables this limit. Default: {}".format(MAX_BODY_SIZE // (1024 * 1024)))
+    parser_web_crawl.add_argument('--frontier-directory', default="frontier", help="Directory where links to crawl are kept, so that an interrupted crawl can be resumed. Default: frontier")
+    parser_web_crawl.add_argument('--resume', action='store_true', help="If is set, continues the crawl kept in frontier directory, with any seed links added to it. Otherwise frontier directory is cleared first.")
+    parser_web_crawl.add_argument('--recrawl', action='store_true', help="If is set, documents already indexed are crawled again along with seed links. They are requested with conditional GETs and re-indexed only if their content has changed. Documents of pages that return 404 or 410 are deleted. New pages are found only through links of new or changed pages.")
+    parser_web_crawl.add_argument('--delay', type=float, default=0, help="Politeness delay. Min time in seconds between two requests to the same host. Default: 0")
     parser_web_crawl.set_defaults(func=process_web_crawl)
 
+    parser.add_argument('-b', '--backend', choices=["mongo", "local"], default="mongo", help="Storage backend for the index. 'local' keeps the index in segment files of a local directory and does not need a MongoDB server. Default: mongo")
+    parser.add_argument('--local-directory', default="index", help="Directory for index files of local backend. Default: index")
+    parser.add_argument('--shards', type=int, default=1, help="Count of shards that documents are partitioned in. Shard i is kept in MongoDB database <mongo-database>_shard<i> or in directory <local-directory>/shard<i>. It must be the same on every command on the same index. Default: 1 (no sharding)")
     parser.add_argument('-H', '--mongo-host', default="localhost", help="MongoDB host. Default: localhost")
     parser.add_argument('-p', '--mongo-port', type=int, default=27017, help="MongoDB port. Default: 27017")
     parser.add_argument('-d', '--mongo-database', default="inforet", help="MongoDB database. Default: inforet")
-    parser.add_argument('-i', '--mongo-collection-index', required=True, help="MongoDB collection for inverted index")
-    parser.add_argument('-l', '--mongo-collection-docs', required=True, help="MongoDB collection for documents' L_d")
+    parser.add_argument('-i', '--mongo-collection-index', help="MongoDB collection for inverted index. Required for mongo backend")
+    parser.add_argument('-l', '--mongo-collection-docs', help="MongoDB collection for documents' L_d. Required for mongo backend")
+    parser.add_argument('--flush-postings', type=int, default=FLUSH_POSTINGS_LIMIT, help="Write in-memory index to storage when it holds that many postings. 0 disables this limit. Default: {}. Valid only for commands: index-local and web-crawl.".format(FLUSH_POSTINGS_LIMIT))
+    parser.add_argument('--flush-mbytes', type=int, default=FLUSH_BYTES_LIMIT // (1024 * 1024), help="Write in-memory index to storage when its estimated size reaches that many megabytes. 0 disables this limit. Default: {}. Valid only for commands: index-local and web-crawl.".format(FLUSH_BYTES_LIMIT // (1024 * 1024)))
+    parser.add_argument('--background-flush', action='store_true', help="If is set, in-memory index is written to storage by a background thread while next documents are read. Valid only for commands: index-local and web-crawl.")
+    parser.add_argument('--near-duplicates', type=int, default=-1, metavar='BITS', help="If is set, new documents whose SimHash fingerprint differs in at most BITS of 64 bits (similarity at least 1 - BITS/64) from the fingerprint of a stored document are near-duplicates and are not indexed. {} is a usual value. Valid only for commands: index-local and web-crawl. Default: disabled (-1)".format(NEAR_DUPLICATE_DISTANCE))
+    parser.add_argument('--stats', metavar='FILE', help="If is set, counters and timings of each stage (fetch, parse, tokenize, indexing, flush, postings fetch, scoring and boolean evaluation) are written as JSON to FILE, or to standard error if FILE is '-'.")
+    parser.add_argument('--profile', metavar='FILE', help="If is set, command is run under cProfile and profile is written to FILE, for use with pstats")
     parser.add_argument('-I', '--create-mongo-indexes', action='store_true', help="If is set a mongoDB index will be created for each collection that will be created after the read of documents. Valid only for commands: index-local and web-crawl.")
 
     args = parser.parse_args()
-    args.func(args)
+    if args.backend == 'mongo' and not (args.mongo_collection_index and args.mongo_collection_docs):
+        parser.error("arguments -i/--mongo-collection-index and -l/--mongo-collection-docs are required for mongo backend")
+    if args.func == process_web_crawl and not (args.seed or args.resume or args.recrawl):
+        parser.error("argument -s/--seed is required unless --resume or --recrawl is set")
+
+    stats.enable(args.stats is not None)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        args.func(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats is not None:
+            write_stats(args.stats)
 
     '''
     ### Queries ###
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Query server. It keeps one collection open, with its storage connections, documents and query cache in memory, and
+answers queries over HTTP, on a TCP port or a Unix socket. Requests are handled concurrently by a fixed pool of threads.
+
+Endpoints:
+    GET /search?q=QUERY&model=vector|boolean&above=0.2&top=-1&offset=0&limit=100
+        {"results": [[location, similarity], ...]}
+    GET /stats      recorded counters and timings, query cache hits and misses, stem cache statistics of tokenizer
+    GET /health     {"status": "ok", "generation": ...}
+Errors are answered with status 400 and {"error": message}.
+"""
+
+import json
+import os
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import document
+import stats
+from collection import search
+
+# Count of requests handled concurrently
+SERVER_THREADS = 8
+
+# Count of results returned by /search if limit is not given
+PAGE_LIMIT = 100
+
+
+class SearchService:
+    """
+    Holds the collection that queries run on. Collections keep documents, deleted documents and (for local storage)
+    segments as they were when they were opened, so the collection is reopened whenever index generation changes.
+    A replaced collection is closed as soon as no query uses it.
+    """
+
+    def __init__(self, open_collection, query_cache=None):
+        """
+        :param open_collection: function that returns a new Collection or ShardedCollection
+        :param query_cache: QueryCache object shared by all collections that are opened. Cached results stay valid
+         only for the index generation they were computed on
+        """
+        self._open_collection = open_collection
+        self.query_cache = query_cache
+        self._lock = threading.Lock()
+        self._users = dict()  # dict with collections that queries use as keys and counts of these queries as values
+        self.collection = self._open()
+        self.generation = self.collection.get_generation()
+
+    def _open(self):
+        collection = self._open_collection()
+        collection.query_cache = self.query_cache
+        collection.warm_up()
+        return collection
+
+    def get_collection(self):
+        """
+        :return: current collection, reopened if index has been written since it was opened. It is closed when it is
+         replaced, unless it is used by a query
+        """
+        collection = self._acquire()
+        self._release(collection)
+        return collection
+
+    def _acquire(self):
+        """
+        :return: current collection, reopened if index has been written since it was opened. It is not closed till it
+         is released with _release
+        """
+        with self._lock:
+            collection = self.collection
+            self._users[collection] = self._users.get(collection, 0) + 1
+        try:
+            generation = collection.get_generation()
+        except Exception:
+            self._release(collection)
+            raise
+        if generation == self.generation:
+            return collection
+
+        try:
+            with self._lock:
+                # Another thread may have reopened it meanwhile
+                if self.collection is collection:
+                    # Generation read before opening, so that a write during opening causes one more reopen
+                    self.collection, self.generation = self._open(), generation
+                current = self.collection
+                self._users[current] = self._users.get(current, 0) + 1
+        finally:
+            # Replaced collection is closed by its last query
+            self._release(collection)
+        return current
+
+    def _release(self, collection):
+        """ Releases a collection of _acquire, and closes it if it has been replaced and no other query uses it """
+        with self._lock:
+            self._users[collection] -= 1
+            if self._users[collection]:
+                return
+            del self._users[collection]
+            if collection is not self.collection:
+                collection.close()
+
+    def close(self):
+        """ Closes current collection. Service is not used after that """
+        with self._lock:
+            self.collection.close()
+
+    def search(self, model, q, above=0.2, top=-1, offset=0, limit=PAGE_LIMIT):
+        """
+        :return: list of tuples (document location, similarity) of requested page of results
+        """
+        with stats.timed('request_search'):
+            collection = self._acquire()
+            try:
+                return list(search(collection, model, q, above, top, offset, limit))
+            finally:
+                self._release(collection)
+
+    def get_stats(self):
+        ans = stats.stats.as_dict()
+        ans['generation'] = self.generation
+        ans['tokenizer_cache'] = document.tokenizer.cache_stats()
+        if self.query_cache is not None:
+            ans['query_cache'] = {'entries': len(self.query_cache), 'size_bytes': self.query_cache.size,
+                                  'hits': self.query_cache.hits, 'misses': self.query_cache.misses}
+        return ans
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """ Handles requests of a server with a SearchService as attribute service """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == '/search':
+                ans = {'results': self._search(params)}
+            elif url.path == '/stats':
+                ans = self.server.service.get_stats()
+            elif url.path == '/health':
+                ans = {'status': 'ok', 'generation': self.server.service.generation}
+            else:
+                self._send_json(404, {'error': "Unknown path '" + url.path + "'"})
+                return
+        except Exception as e:
+            # Unknown terms and malformed queries are reported by exceptions
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(200, ans)
+
+    def _search(self, params):
+        def param(name, default, cast=str):
+            values = params.get(name)
+            return cast(values[0]) if values else default
+
+        q = param('q', None)
+        if not q:
+            raise ValueError("Parameter 'q' is required")
+        model = param('model', 'vector')
+        if model not in ('boolean', 'vector'):
+            raise ValueError("Parameter 'model' must be boolean or vector")
+        return self.server.service.search(model, q, above=param('above', 0.2, float), top=param('top', -1, int),
+                                          offset=max(param('offset', 0, int), 0),
+                                          limit=param('limit', PAGE_LIMIT, int))
+
+    def _send_json(self, code, ans):
+        body = json.dumps(ans).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class _PooledMixIn:
+    """ Handles each connection in a thread of a fixed-size pool, instead of a new thread per connection """
+
+    def __init__(self, server_address, handler_class, service, threads=SERVER_THREADS):
+        self.service = service
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown()
+
+
+class PooledHTTPServer(_PooledMixIn, HTTPServer):
+    pass
+
+
+class PooledUnixHTTPServer(_PooledMixIn, socketserver.UnixStreamServer):
+
+    def server_bind(self):
+        # Socket file of a previous server is removed
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(service, host='127.0.0.1', port=8080, unix_socket=None, threads=SERVER_THREADS):
+    """
+    :param service: SearchService
+    :param host: host to listen on
+    :param port: port to listen on. 0 picks a free port
+    :param unix_socket: path of Unix socket to listen on, instead of host and port
+    :param threads: count of requests handled concurrently
+    :return: server, which is started with serve_forever
+    """
+    if unix_socket:
+        return PooledUnixHTTPServer(unix_socket, SearchHandler, service, threads)
+    return PooledHTTPServer((host, port), SearchHandler, service, threads)
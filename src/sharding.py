@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import heapq
+import math
+import operator
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from document import textpreprocess
+
+
+def shard_of(location, shards_count):
+    """
+    :param location: document location
+    :param shards_count: count of shards
+    :return: index of shard where document belongs. It is stable across processes and runs
+    """
+    return int.from_bytes(hashlib.md5(location.encode('utf-8')).digest()[:8], 'little') % shards_count
+
+
+class ShardedCollection:
+    """
+    Collection partitioned by document in many Collections (shards), e.g. on different MongoDB databases or local
+    directories. Each document is stored in the shard that its location hashes to. Queries are run on all shards in
+    parallel and their results are merged. Vector model queries are scored with N and document frequencies summed over
+    all shards, so similarities are the same as in a single collection with all documents.
+
+    Count of shards must stay the same for the whole life of a sharded collection, since it decides where documents are.
+    """
+
+    def __init__(self, shards, query_cache=None):
+        """
+        :param shards: list of Collection objects
+        :param query_cache: QueryCache object where query results are cached. Results are invalidated when index
+         generation of any shard changes
+        """
+        self.shards = shards
+        self.query_cache = query_cache
+        self._executor = ThreadPoolExecutor(max_workers=len(shards))
+
+    def _map(self, function, *iterables):
+        """ Calls function on each shard, with arguments from iterables, in parallel and returns list of results """
+        return list(self._executor.map(function, self.shards, *iterables))
+
+    @property
+    def near_duplicates(self):
+        """ FingerprintIndex shared by all shards, or None """
+        return self.shards[0].near_duplicates
+
+    def load_fingerprints(self):
+        """
+        Loads fingerprints of stored documents of all shards in their shared near_duplicates, so that new documents of
+        each shard are checked against documents of every shard
+        """
+        for shard in self.shards:
+            shard.load_fingerprints()
+
+    def get_shard(self, location):
+        """ :return: Collection where document with location belongs """
+        return self.shards[shard_of(location, len(self.shards))]
+
+    def flush_to_mongo(self, background=False):
+        self._map(lambda shard: shard.flush_to_mongo(background))
+
+    def create_mongo_indexes(self):
+        self._map(lambda shard: shard.create_mongo_indexes())
+
+    def compact(self, min_fragments=2, full=False):
+        return sum(self._map(lambda shard: shard.compact(min_fragments, full)))
+
+    def get_generation(self):
+        return tuple(self._map(lambda shard: shard.get_generation()))
+
+    def get_identity(self):
+        return tuple(shard.get_identity() for shard in self.shards)
+
+    def get_locations(self):
+        return set().union(*self._map(lambda shard: shard.get_locations()))
+
+    def get_documents_count(self):
+        return sum(self._map(lambda shard: shard.get_documents_count()))
+
+    def warm_up(self):
+        self._map(lambda shard: shard.warm_up())
+
+    def in_collection(self, d):
+        return self.get_shard(str(d)).in_collection(d)
+
+    def read_document(self, d, metadata=None):
+        self.load_fingerprints()
+        self.get_shard(str(d)).read_document(d, metadata)
+
+    def read_documents(self, docs, workers=1):
+        """
+        Reads many documents. Documents of each shard are read with Collection.read_documents, one shard after the other
+        :param docs: iterable of Documents
+        :param workers: count of worker processes
+        """
+        shard_docs = [[] for _ in self.shards]
+        for d in docs:
+            shard_docs[shard_of(str(d), len(self.shards))].append(d)
+        self.load_fingerprints()
+        for shard, docs in zip(self.shards, shard_docs):
+            if docs:
+                shard.read_documents(docs, workers=workers)
+
+    def sync_documents(self, docs, workers=1, delete_missing=False):
+        """
+        Brings every shard up to date with its documents, as Collection.sync_documents. Deleted and changed documents
+        of all shards are found first, so that stored near-duplicates of documents of other shards are checked again.
+        Then new and changed documents are read, one shard after the other.
+        :param docs: iterable of Documents with methods get_etag and get_metadata
+        :param workers: count of worker processes
+        :param delete_missing: If it is set, stored documents that are not in docs are deleted
+        :return: dict with counts of 'added', 'changed', 'unchanged', 'deleted' and 'duplicates' documents of all shards
+        """
+        shard_docs = [[] for _ in self.shards]
+        for d in docs:
+            shard_docs[shard_of(str(d), len(self.shards))].append(d)
+        self.load_fingerprints()
+        plans = [shard.prepare_sync(docs, delete_missing) for shard, docs in zip(self.shards, shard_docs)]
+        kept = set().union(*(plan['kept'] for plan in plans))
+        counts = dict()
+        for shard, plan in zip(self.shards, plans):
+            for name, count in shard.finish_sync(plan, workers, kept).items():
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+    def update_document(self, d, metadata):
+        self.load_fingerprints()
+        return self.get_shard(str(d)).update_document(d, metadata)
+
+    def delete_document(self, location):
+        return self.get_shard(location).delete_document(location)
+
+    def get_document_metadata(self, location):
+        return self.get_shard(location).get_document_metadata(location)
+
+    def _cached(self, key, process):
+        """
+        Returns result of a query from query cache, or processes it and caches its result
+        :param key: key of query
+        :param process: function that processes query and returns its result
+        """
+        if self.query_cache is None:
+            return process()
+        key = (self.get_identity(),) + key
+        generation = self.get_generation()
+        result = self.query_cache.get(key, generation)
+        if result is None:
+            result = process()
+            self.query_cache.put(key, generation, result)
+        return result
+
+    def processquery_boolean(self, q):
+        """
+        Processes a query with the boolean model on every shard. Each shard evaluates NOT against its own documents,
+        so the union of shard results is the result on all documents.
+        :param q: query in boolean expression format
+        :return: Documents that satisfy the query, ordered by shard and document id in shard
+        """
+        newq = ' '.join(textpreprocess(q))
+        return self._cached(('boolean', newq), lambda: [
+            d for result in self._map(lambda shard: shard.processquery_boolean(q)) for d in result])
+
+    def iter_boolean(self, q, offset=0, limit=-1):
+        """
+        Processes a query with the boolean model and yields its results one by one. Shards are evaluated lazily, one
+        after the other.
+        :param q: query in boolean expression format
+        :param offset: count of results to skip
+        :param limit: max count of results. Unlimited if it is -1
+        :return: generator of tuples (document location, 1), ordered by shard and document id in shard
+        """
+        results = (d for shard in self.shards for d in shard.iter_boolean(q))
+        yield from islice(results, offset, None if limit < 0 else offset + limit)
+
+    def processquery_vector(self, q, above=0.2, top=-1):
+        """
+        Processes a query with the vector model on every shard, with global statistics
+        :param q: query. Any sentence
+        :param above: lowest limit in similarity of documet and query. Defaults to 0.2
+        :param top: Returns top x documents if is set. Defaults to unlimited (-1)
+        :return: Documents that satisfy the query
+        """
+        q_tokens = textpreprocess(q)
+        return self._cached(('vector', tuple(q_tokens), above, top),
+                            lambda: self._processquery_vector(q_tokens, above, top))
+
+    def iter_vector(self, q, above=0.2, offset=0, limit=-1):
+        """
+        Processes a query with the vector model and yields its results one by one, in decreasing order of similarity.
+        If there is no limit, sorted results of all shards are merged lazily.
+        :param q: query. Any sentence
+        :param above: lowest limit in similarity of documet and query. Defaults to 0.2
+        :param offset: count of results to skip
+        :param limit: max count of results. Unlimited if it is -1
+        :return: generator of tuples (document location, similarity)
+        """
+        q_tokens = textpreprocess(q)
+        if limit >= 0:
+            yield from self._processquery_vector(q_tokens, above, offset + limit)[offset:]
+            return
+
+        idf, shard_statistics = self._get_idf(q_tokens)
+        results = [shard.iter_score_vector([term for term in q_tokens if term in terms_statistics], idf, above)
+                   for shard, terms_statistics in zip(self.shards, shard_statistics)]
+        merged = heapq.merge(*results, key=lambda result: -result[1])
+        yield from islice(merged, offset, None)
+
+    def _get_idf(self, q_tokens):
+        """
+        :return: tuple (dict with idf of each query token over all shards, list with dict of stored statistics of query
+         tokens of each shard)
+        """
+        # Statistics of each shard, gathered in one parallel round
+        shard_statistics = self._map(
+            lambda shard: (shard.get_documents_count(), shard.get_live_terms_statistics(q_tokens)))
+
+        # N and n_t of all shards
+        N = sum(count for count, _ in shard_statistics)
+        df = dict()
+        for _, terms_statistics in shard_statistics:
+            for term, term_statistics in terms_statistics.items():
+                df[term] = df.get(term, 0) + term_statistics['df']
+        for term in q_tokens:
+            if term not in df:  # Check if term is in our collection
+                raise Exception("Term '" + term + "' does not exist in our inverted index.")
+
+        idf = {term: math.log(1 + N / n_t) for term, n_t in df.items()}
+        return idf, [terms_statistics for _, terms_statistics in shard_statistics]
+
+    def _processquery_vector(self, q_tokens, above, top):
+        idf, shard_statistics = self._get_idf(q_tokens)
+        if top == 0:
+            return []
+
+        def score(shard, terms_statistics):
+            # Only query tokens which are in shard, in query order, so that similarities are summed in the same order
+            shard_tokens = [term for term in q_tokens if term in terms_statistics]
+            return shard.score_vector(shard_tokens, idf, terms_statistics, above, top) if shard_tokens else []
+
+        results = self._map(score, shard_statistics)
+        merged = (d for result in results for d in result)
+        if top > 0:
+            return heapq.nlargest(top, merged, key=operator.itemgetter(1))
+        return sorted(merged, key=operator.itemgetter(1), reverse=True)
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.close()
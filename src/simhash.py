@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate detection of documents with SimHash fingerprints [Charikar 2002]. Each term of a document votes on every
+bit of the fingerprint with the bit of its own hash, weighted by its tf weight, so documents with mostly the same terms
+get fingerprints that differ in few bits. Fingerprints within a max count of differing bits (Hamming distance) are
+found with a banded index [Manku, Jain, Das Sarma 2007].
+"""
+
+import hashlib
+import math
+import operator
+from functools import lru_cache
+
+FINGERPRINT_BITS = 64
+
+# Default max Hamming distance of near-duplicate fingerprints, i.e. similarity at least 1 - 3/64
+NEAR_DUPLICATE_DISTANCE = 3
+
+# Count of terms whose hash bits are kept in cache
+TERM_CACHE_SIZE = 100000
+
+
+@lru_cache(maxsize=TERM_CACHE_SIZE)
+def term_signs(term):
+    """
+    :return: tuple with +1 for each set bit and -1 for each clear bit of 64 bit hash of term. Hash is stable across
+     processes
+    """
+    h = int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+    return tuple(1 if h >> bit & 1 else -1 for bit in range(FINGERPRINT_BITS))
+
+
+def simhash(tokens):
+    """
+    :param tokens: dict with terms as keys and their counts in document as values
+    :return: 64 bit fingerprint of document
+    """
+    # Votes of terms with the same count are summed first, since they have the same weight
+    votes = dict()
+    for term, count in tokens.items():
+        signs = term_signs(term)
+        count_votes = votes.get(count)
+        votes[count] = list(map(operator.add, count_votes, signs)) if count_votes is not None else signs
+
+    weights = [0.0] * FINGERPRINT_BITS
+    for count, count_votes in votes.items():
+        # tf weight of vector model
+        weight = 1 + math.log(count)
+        weights = [w + weight * v for w, v in zip(weights, count_votes)]
+    return sum(1 << bit for bit, w in enumerate(weights) if w > 0)
+
+
+def distance(a, b):
+    """ :return: count of differing bits of fingerprints a and b """
+    return bin(a ^ b).count('1')
+
+
+def format_fingerprint(fingerprint):
+    """ :return: fingerprint as a hex string, as it is stored in document metadata """
+    return '{:016x}'.format(fingerprint)
+
+
+def parse_fingerprint(text):
+    return int(text, 16)
+
+
+class FingerprintIndex:
+    """
+    Index of document fingerprints that finds fingerprints within max_distance bits of a given one. Fingerprints are
+    split in max_distance + 1 bands of bits. Two fingerprints that differ in at most max_distance bits are equal in at
+    least one band, so only fingerprints that share a band with the given one are compared.
+
+    Documents found to be near-duplicates are not added; each one is linked to the document it duplicates (canonical).
+    """
+
+    def __init__(self, max_distance=NEAR_DUPLICATE_DISTANCE):
+        """
+        :param max_distance: max count of differing bits of near-duplicate fingerprints
+        """
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = FINGERPRINT_BITS // bands
+        # tuples (shift, mask) of each band. Last band takes any bits left
+        self._bands = [(i * width, (1 << (width if i < bands - 1 else FINGERPRINT_BITS - i * width)) - 1)
+                       for i in range(bands)]
+        self._tables = [dict() for _ in range(bands)]  # dicts with band values as keys and sets of locations as values
+        self.fingerprints = dict()  # dict with document locations as keys and their fingerprints as values
+        self.links = dict()  # dict with locations of near-duplicates as keys and locations of canonicals as values
+
+    def _keys(self, fingerprint):
+        return [(fingerprint >> shift) & mask for shift, mask in self._bands]
+
+    def find(self, fingerprint, exclude=None):
+        """
+        :param fingerprint: fingerprint of a document
+        :param exclude: location of document, which is not matched against itself
+        :return: location of closest document within max distance or None if there is no such document
+        """
+        best, best_distance = None, self.max_distance + 1
+        for table, key in zip(self._tables, self._keys(fingerprint)):
+            for location in table.get(key, ()):
+                d = distance(fingerprint, self.fingerprints[location])
+                if d < best_distance and location != exclude:
+                    best, best_distance = location, d
+        return best
+
+    def add(self, location, fingerprint):
+        """ Adds fingerprint of document. It replaces any previous fingerprint of document """
+        self.remove(location)
+        self.fingerprints[location] = fingerprint
+        for table, key in zip(self._tables, self._keys(fingerprint)):
+            table.setdefault(key, set()).add(location)
+
+    def remove(self, location):
+        """ Removes fingerprint of document, if it is in index, or its link if it is a near-duplicate """
+        self.links.pop(location, None)
+        fingerprint = self.fingerprints.pop(location, None)
+        if fingerprint is not None:
+            for table, key in zip(self._tables, self._keys(fingerprint)):
+                locations = table[key]
+                locations.discard(location)
+                if not locations:
+                    del table[key]
+
+    def link(self, location, canonical):
+        """ Records document of location as a near-duplicate of document canonical """
+        self.links[location] = canonical
+
+    def __len__(self):
+        return len(self.fingerprints)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide instrumentation: named counters (counts and byte sizes) and latency histograms of stages such as fetch,
+parse, tokenize, indexing, flush and query evaluation. Recording is off by default and then every hook costs a
+function call that returns immediately. Call :func:`enable` to start recording.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency histogram buckets are powers of 2 microseconds: bucket i holds durations in [2^(i-1), 2^i) us
+HISTOGRAM_BUCKETS = 40
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """
+    Log-scale histogram of durations. Percentiles are estimated as the upper bound of the bucket they fall in, so they
+    are accurate within a factor of 2.
+    """
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def merge(self, count, total, max_, buckets):
+        self.count += count
+        self.total += total
+        self.max = max(self.max, max_)
+        for i, n in enumerate(buckets):
+            self.buckets[i] += n
+
+    def percentile(self, p):
+        """ :return: estimated p-th percentile in seconds """
+        rank = p * self.count / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) / 1000000, self.max)
+        return self.max
+
+    def as_dict(self):
+        ans = {'count': self.count, 'total_seconds': self.total,
+               'mean_ms': 1000 * self.total / self.count if self.count else 0, 'max_ms': 1000 * self.max}
+        for p in PERCENTILES:
+            ans['p{}_ms'.format(p)] = 1000 * self.percentile(p)
+        return ans
+
+
+class Stats:
+    """
+    Registry of counters and histograms. It is safe to use from many threads.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = dict()
+        self.histograms = dict()
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """ Adds value to counter name. Counters of byte sizes are named with suffix '_bytes' """
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """ Records a duration in histogram name """
+        if self.enabled:
+            with self._lock:
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.add(seconds)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        :return: context manager that records duration of its block in histogram name
+        """
+        return self._timed(name) if self.enabled else _NOT_TIMED
+
+    def clear(self):
+        with self._lock:
+            self.counters = dict()
+            self.histograms = dict()
+
+    def snapshot(self):
+        """
+        :return: picklable copy of recorded values, which can be passed to :meth:`merge` of another process's Stats
+        """
+        with self._lock:
+            return dict(self.counters), {name: (h.count, h.total, h.max, list(h.buckets))
+                                         for name, h in self.histograms.items()}
+
+    def merge(self, snapshot):
+        """ Adds values of a snapshot, e.g. from a worker process """
+        counters, histograms = snapshot
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, values in histograms.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].merge(*values)
+
+    def as_dict(self):
+        with self._lock:
+            return {'counters': dict(sorted(self.counters.items())),
+                    'timings': {name: h.as_dict() for name, h in sorted(self.histograms.items())}}
+
+
+class _NotTimed:
+    """ Context manager that does nothing, returned by Stats.timed when recording is off """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOT_TIMED = _NotTimed()
+
+# Process-wide registry used by hooks
+stats = Stats()
+
+
+def enable(enabled=True):
+    stats.enabled = enabled
+
+
+def incr(name, value=1):
+    stats.incr(name, value)
+
+
+def observe(name, seconds):
+    stats.observe(name, seconds)
+
+
+def timed(name):
+    return stats.timed(name)
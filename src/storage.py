@@ -0,0 +1,1023 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import io
+import json
+import math
+import mmap
+import os
+import struct
+from abc import abstractmethod
+
+try:
+    import numpy as np
+except ImportError:  # array lookups are not used
+    np = None
+
+import postings
+from postings import tf_weight
+
+# Count of operations sent to MongoDB in one bulk request
+MONGO_BULK_SIZE = 1000
+
+# Max count of postings in one MongoDB document of postings. A term's postings are split in blocks of that many
+# postings, so no document grows towards MongoDB's document size limit
+POSTINGS_BLOCK_SIZE = 4096
+
+# A term's blocks are compacted on write when it has that many fragments, i.e. blocks with less than
+# POSTINGS_BLOCK_SIZE postings. Every flush leaves at most one fragment per term
+COMPACT_FRAGMENTS = 8
+
+# Trailing segments of a local index are merged from the first one that is at most that many times larger than all
+# segments after it together. Every merge grows the segment of a posting by at least 1 + 1 / SEGMENT_MERGE_RATIO, so a
+# posting is rewritten a logarithmic number of times
+SEGMENT_MERGE_RATIO = 2
+
+
+class Storage:
+    """
+    Storage Base Class. A storage persists the inverted index and the documents table (id, location and L_d of each
+    document) of a Collection. Documents are referenced by their integer ids everywhere except for the documents table.
+
+    Documents are never updated in place. A changed document is deleted and stored again with a new id. Deleted
+    documents are kept as tombstones: they are left out of every lookup of documents, but their postings stay in the
+    inverted index till :meth:`compact` drops them. Stored document frequencies count them too, so while there are
+    deleted documents Collection filters them out of postings and counts document frequencies from live postings.
+    """
+
+    @abstractmethod
+    def write(self, index, documents, metadata=None, deleted=None, duplicates=None):
+        """
+        Writes (appends) an in-memory inverted index and its documents to storage. Document ids must be greater than
+        the ids of documents already written.
+        :param index: InvertedIndex with terms as keys and their Postings as values
+        :param documents: dict with document locations as keys and tuples (document id, L_d) as values
+        :param metadata: dict with locations of documents as keys and dicts {'etag', 'last_modified', 'hash'} as values.
+         Dicts may also have a 'simhash' fingerprint, as a hex string
+        :param deleted: iterable of ids of stored documents to be deleted. They are deleted before documents are added
+        :param duplicates: dict with locations of near-duplicate documents that were not added as keys and dicts
+         {'duplicate_of', 'etag', 'last_modified', 'hash'} as values, where 'duplicate_of' is the location of the
+         document they duplicate. A value of None removes the stored near-duplicate of location. Near-duplicates of the
+         locations of documents are removed too
+        """
+        pass
+
+    def create_indexes(self):
+        """
+        Creates indexes that speed up lookups, if storage supports them
+        """
+        pass
+
+    def compact(self, min_fragments=COMPACT_FRAGMENTS, full=False, terms=None):
+        """
+        Merges small pieces of inverted index that flushes leave behind, if storage has any, and drops postings of
+        deleted documents from them
+        :param min_fragments: only terms with at least that many pieces are merged
+        :param full: If it is set, the whole inverted index is rewritten, so that no postings of deleted documents are
+         left and :meth:`get_deleted_document_ids` no longer returns them
+        :param terms: If it is given, only pieces of these terms are checked, e.g. of the terms of the last write
+        :return: count of terms merged
+        """
+        return 0
+
+    @abstractmethod
+    def get_generation(self):
+        """
+        :return: index generation, a counter that is increased by every write. It is read from storage every time, so
+         that writes of other processes are seen
+        """
+        pass
+
+    @abstractmethod
+    def get_identity(self):
+        """
+        :return: string that identifies the stored index, e.g. among indexes whose query results share a cache
+        """
+        pass
+
+    @abstractmethod
+    def get_documents_count(self):
+        """
+        :return: count of stored documents, except for deleted ones
+        """
+        pass
+
+    @abstractmethod
+    def get_index_count(self):
+        pass
+
+    @abstractmethod
+    def get_documents_for_term(self, term, arrays=False):
+        """
+        :param term: term
+        :param arrays: If it is set, Postings hold numpy arrays instead of lists
+        :return: Postings of term or None if term is not stored
+        """
+        pass
+
+    @abstractmethod
+    def get_terms_statistics(self, terms):
+        """
+        :param terms: iterable of terms
+        :return: dict with each stored term of terms as key and a dict {'df': document frequency, 'max_impact': max
+         over term's documents of weight/L_d} as value
+        """
+        pass
+
+    def get_documents_for_terms(self, terms, arrays=False):
+        """
+        :param terms: iterable of terms
+        :param arrays: If it is set, Postings hold numpy arrays instead of lists
+        :return: dict with each stored term of terms as key and its Postings as value
+        """
+        ans = dict()
+        for term in set(terms):
+            docs = self.get_documents_for_term(term, arrays)
+            if docs is not None:
+                ans[term] = docs
+        return ans
+
+    def get_blocks_for_terms(self, terms):
+        """
+        Fetches the headers of postings blocks of terms, without their postings, so that readers can skip blocks
+        :param terms: iterable of terms
+        :return: dict with each stored term of terms as key and a list of dicts {'min_id', 'max_id', 'df', 'max_tf'} of
+         its blocks, in ascending order of min_id, as value. It is empty if storage does not split postings in blocks
+        """
+        return dict()
+
+    def get_documents_for_blocks(self, term, blocks, arrays=False):
+        """
+        :param term: term
+        :param blocks: list of block headers of term, as returned by get_blocks_for_terms
+        :param arrays: If it is set, Postings hold numpy arrays instead of lists
+        :return: Postings of term with at least the postings of documents in the ranges of ids of blocks
+        """
+        return self.get_documents_for_term(term, arrays)
+
+    @abstractmethod
+    def get_document_ids(self):
+        """
+        :return: iterable of ids of all stored documents, except for deleted ones
+        """
+        pass
+
+    @abstractmethod
+    def get_deleted_document_ids(self):
+        """
+        :return: iterable of ids of deleted documents whose postings may still be in inverted index
+        """
+        pass
+
+    @abstractmethod
+    def get_document_metadata(self, doc):
+        """
+        :param doc: document location
+        :return: dict {'id', 'etag', 'last_modified', 'hash'} of stored document or None if document is not stored.
+         Values that were not given when document was written are None
+        """
+        pass
+
+    @abstractmethod
+    def get_documents_metadata(self):
+        """
+        :return: generator of tuples (location, dict {'id', 'etag', 'last_modified', 'hash'}) of all stored documents,
+         except for deleted ones, fetched at once
+        """
+        pass
+
+    @abstractmethod
+    def get_duplicates(self):
+        """
+        :return: generator of tuples (location, dict {'duplicate_of', 'etag', 'last_modified', 'hash'}) of stored
+         near-duplicate documents
+        """
+        pass
+
+    @abstractmethod
+    def get_document_L_d(self, doc):
+        """
+        :param doc: document id
+        :return: L_d of document or None if document is not stored
+        """
+        pass
+
+    def get_documents_L_d(self, docs):
+        """
+        :param docs: iterable of document ids
+        :return: dict with each stored document of docs as key and its L_d as value
+        """
+        ans = dict()
+        for doc in docs:
+            L_d = self.get_document_L_d(doc)
+            if L_d is not None:
+                ans[doc] = L_d
+        return ans
+
+    def get_documents_L_d_array(self, docs):
+        """
+        :param docs: numpy array of document ids
+        :return: numpy array with L_d of each document of docs, or NaN for documents that are not stored
+        """
+        L_d = self.get_documents_L_d(docs.tolist())
+        return np.fromiter((L_d.get(doc, math.nan) for doc in docs.tolist()), dtype=np.float64, count=len(docs))
+
+    @abstractmethod
+    def get_documents_locations(self, docs):
+        """
+        :param docs: iterable of document ids
+        :return: dict with each stored document of docs as key and its location as value
+        """
+        pass
+
+    @abstractmethod
+    def get_locations(self):
+        """
+        :return: set with locations of all stored documents, except for deleted ones
+        """
+        pass
+
+    @abstractmethod
+    def get_fingerprints(self):
+        """
+        :return: generator of tuples (location, simhash hex string) of stored documents that have a fingerprint, except
+         for deleted ones
+        """
+        pass
+
+    @abstractmethod
+    def get_next_document_id(self):
+        """
+        :return: id to be given to next document, which is greater than all stored ids
+        """
+        pass
+
+    @abstractmethod
+    def has_document(self, doc):
+        """
+        :param doc: document location
+        :return: True if document is stored and it is not deleted
+        """
+        pass
+
+    def close(self):
+        """
+        Releases files that storage keeps open. Storage is not used after that. A MongoDB client is closed by whoever
+        created it
+        """
+        pass
+
+
+class MongoStorage(Storage):
+    """
+    Storage on a MongoDB database.
+
+    Postings of each term are split in blocks of at most POSTINGS_BLOCK_SIZE postings. Each block is a document
+    {'term', 'min_id', 'max_id', 'df', 'max_tf', 'postings'} of index collection, with the range of its document ids,
+    its count of postings, the max count of term in its documents and its compressed postings. Top-k queries read the
+    headers of blocks of long postings first and fetch only blocks with documents that may enter the top-k. Every write
+    appends new blocks, so terms collect small blocks (fragments), which :meth:`compact` merges. Document frequency and
+    max impact of each term are kept in a separate collection of term statistics.
+    """
+
+    def __init__(self, mongo_db, mongo_collections):
+        """
+        :param mongo_db: MongoClient object
+        :param mongo_collections: dict with collections: 'invertedIndex' for inverted index collection (will contain
+         blocks of compressed document ids and counts of each term) and 'documents' for documents collection
+         (will contain document id as key and location and L_d as values)
+        """
+        self.mongo_db = mongo_db
+        self.mongo_collections = mongo_collections
+
+    @property
+    def index_collection(self):
+        return self.mongo_db[self.mongo_collections['invertedIndex']]
+
+    @property
+    def terms_collection(self):
+        """ Collection with term as _id and df, max_impact and count of fragments of term as values """
+        return self.mongo_db[self.mongo_collections['invertedIndex'] + '.terms']
+
+    @property
+    def documents_collection(self):
+        return self.mongo_db[self.mongo_collections['documents']]
+
+    @property
+    def duplicates_collection(self):
+        """ Collection with location of near-duplicate documents as _id and their metadata and canonical as values """
+        return self.mongo_db[self.mongo_collections['documents'] + '.duplicates']
+
+    @property
+    def meta_collection(self):
+        """ Collection with storage metadata, such as index generation """
+        return self.mongo_db[self.mongo_collections['documents'] + '.meta']
+
+    @staticmethod
+    def _blocks(term, doc_ids, counts):
+        """
+        Splits postings of a term in blocks
+        :return: list of documents of index collection
+        """
+        ans = []
+        for i in range(0, len(doc_ids), POSTINGS_BLOCK_SIZE):
+            block_ids, block_counts = doc_ids[i:i + POSTINGS_BLOCK_SIZE], counts[i:i + POSTINGS_BLOCK_SIZE]
+            ans.append({'term': term, 'min_id': int(block_ids[0]), 'max_id': int(block_ids[-1]),
+                        'df': len(block_ids), 'max_tf': int(max(block_counts)),
+                        'postings': postings.encode(block_ids, block_counts)})
+        return ans
+
+    def _insert_blocks(self, blocks):
+        for i in range(0, len(blocks), MONGO_BULK_SIZE):
+            self.index_collection.insert_many(blocks[i:i + MONGO_BULK_SIZE], ordered=False)
+
+    def write(self, index, documents, metadata=None, deleted=None, duplicates=None):
+        from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+        deleted = list(deleted or [])
+        for i in range(0, len(deleted), MONGO_BULK_SIZE):
+            self.documents_collection.update_many({'id': {"$in": deleted[i:i + MONGO_BULK_SIZE]}},
+                                                  {"$set": {'deleted': True}})
+
+        blocks = []
+        requests = []
+        for term, (doc_ids, counts) in index.items():
+            term_blocks = self._blocks(term, doc_ids, counts)
+            blocks.extend(term_blocks)
+            requests.append(UpdateOne({'_id': term}, {"$inc": {"df": len(doc_ids),
+                                                               "fragments": sum(block['df'] < POSTINGS_BLOCK_SIZE
+                                                                                for block in term_blocks)},
+                                                      "$max": {"max_impact": index.get_max_impact(term)}}, upsert=True))
+            if len(blocks) >= MONGO_BULK_SIZE:
+                self._insert_blocks(blocks)
+                blocks = []
+            if len(requests) == MONGO_BULK_SIZE:
+                self.terms_collection.bulk_write(requests, ordered=False)
+                requests = []
+        # Blocks are inserted before statistics of their terms, so a term with statistics always has its blocks
+        self._insert_blocks(blocks)
+        if requests:
+            self.terms_collection.bulk_write(requests, ordered=False)
+
+        mdocs = [{'id': doc_id, 'doc': location, 'L_d': L_d} for location, (doc_id, L_d) in documents.items()]
+        if metadata:
+            for mdoc in mdocs:
+                mdoc.update(metadata.get(mdoc['doc'], ()))
+        for i in range(0, len(mdocs), MONGO_BULK_SIZE):
+            self.documents_collection.insert_many(mdocs[i:i + MONGO_BULK_SIZE], ordered=False)
+
+        requests = [DeleteOne({'_id': location}) if entry is None else ReplaceOne({'_id': location}, entry, upsert=True)
+                    for location, entry in (duplicates or dict()).items()]
+        if documents and self.duplicates_collection.estimated_document_count():
+            requests.extend(DeleteOne({'_id': location}) for location in documents)
+        for i in range(0, len(requests), MONGO_BULK_SIZE):
+            self.duplicates_collection.bulk_write(requests[i:i + MONGO_BULK_SIZE], ordered=True)
+
+        self._increase_generation()
+
+    def _increase_generation(self):
+        self.meta_collection.update_one({'_id': 'generation'}, {"$inc": {'value': 1}}, upsert=True)
+
+    def compact(self, min_fragments=COMPACT_FRAGMENTS, full=False, terms=None):
+        """
+        Merges blocks of terms with at least min_fragments fragments. Blocks of a term are rewritten from its first
+        fragment on, as full blocks and at most one fragment at the end. Since new postings are always appended, each
+        posting is rewritten about once per COMPACT_FRAGMENTS flushes. Postings of deleted documents in rewritten blocks
+        are dropped and document frequency of term is decreased accordingly.
+
+        New blocks are inserted before the old ones are removed, so a concurrent reader may see both. Readers merge
+        blocks with overlapping document ids, which hold the same postings.
+        :param min_fragments: only terms with at least that many fragments are merged. It must be at least 2
+        :param full: If it is set, all blocks of all terms are rewritten and deleted documents are marked as purged
+        :param terms: If it is given, only these terms are checked, with lookups on term ids instead of a query on the
+         fragments of all terms
+        :return: count of terms merged
+        """
+        query = {} if full else {'fragments': {"$gte": max(min_fragments, 2)}}
+        if terms is None:
+            terms = [entry['_id'] for entry in self.terms_collection.find(query, {'_id': 1})]
+        else:
+            terms = list(terms)
+            terms = [entry['_id'] for i in range(0, len(terms), MONGO_BULK_SIZE)
+                     for entry in self.terms_collection.find(dict(query, _id={"$in": terms[i:i + MONGO_BULK_SIZE]}),
+                                                             {'_id': 1})]
+        deleted = set(self.get_deleted_document_ids())
+        for term in terms:
+            self._compact_term(term, deleted, full)
+        if full and deleted:
+            # Postings of documents deleted during compaction may be left, so only the documents read above are purged
+            deleted = list(deleted)
+            for i in range(0, len(deleted), MONGO_BULK_SIZE):
+                self.documents_collection.update_many({'id': {"$in": deleted[i:i + MONGO_BULK_SIZE]}},
+                                                      {"$set": {'purged': True}})
+        if terms or (full and deleted):
+            self._increase_generation()
+        return len(terms)
+
+    def _compact_term(self, term, deleted, full=False):
+        """
+        Rewrites blocks of term from its first fragment on
+        :param deleted: set of ids of deleted documents
+        :param full: If it is set, all blocks of term are rewritten
+        """
+        entries = sorted(self.index_collection.find({'term': term}, {'postings': 0}),
+                         key=lambda entry: (entry['min_id'], entry['max_id']))
+        first = 0 if full else next((i for i, entry in enumerate(entries) if entry['df'] < POSTINGS_BLOCK_SIZE),
+                                    len(entries))
+        old_ids = [entry['_id'] for entry in entries[first:]]
+
+        merged = self._decode_entries(list(self.index_collection.find({'_id': {"$in": old_ids}})))
+        doc_ids, counts = [], []
+        for doc_id, count in zip(*merged):
+            if doc_id not in deleted:
+                doc_ids.append(doc_id)
+                counts.append(count)
+        blocks = self._blocks(term, doc_ids, counts)
+
+        self._insert_blocks(blocks)
+        for i in range(0, len(old_ids), MONGO_BULK_SIZE):
+            self.index_collection.delete_many({'_id': {"$in": old_ids[i:i + MONGO_BULK_SIZE]}})
+        if not blocks and first == 0:  # all postings of term were of deleted documents
+            self.terms_collection.delete_one({'_id': term})
+            return
+        self.terms_collection.update_one({'_id': term}, {
+            "$inc": {'df': len(doc_ids) - len(merged.doc_ids)},
+            "$set": {'fragments': sum(block['df'] < POSTINGS_BLOCK_SIZE for block in blocks)}})
+
+    @staticmethod
+    def _decode_entries(entries, arrays=False):
+        """
+        Decodes blocks of a term
+        :param entries: documents of index collection with blocks of term, in any order
+        :param arrays: If it is set, postings are decoded to numpy arrays
+        :return: Postings
+        """
+        entries.sort(key=lambda entry: (entry['min_id'], entry['max_id']))
+        if all(a['max_id'] < b['min_id'] for a, b in zip(entries, entries[1:])):
+            return postings.decode_blocks((entry['postings'] for entry in entries), arrays)
+
+        # Blocks of a compaction in progress overlap the blocks they replace. Equal ids have equal counts
+        merged = dict()
+        for entry in entries:
+            merged.update(zip(*postings.decode(entry['postings'])))
+        doc_ids = sorted(merged)
+        counts = [merged[doc_id] for doc_id in doc_ids]
+        if arrays:
+            return postings.Postings(np.array(doc_ids, dtype=np.int64), np.array(counts, dtype=np.int64))
+        return postings.Postings(doc_ids, counts)
+
+    def create_indexes(self):
+        from pymongo import ASCENDING, HASHED
+        self.index_collection.create_index([('term', ASCENDING), ('min_id', ASCENDING)])
+        self.terms_collection.create_index('fragments')
+        self.documents_collection.create_index([('doc', HASHED)])
+        self.documents_collection.create_index('id', unique=True)
+
+    def get_generation(self):
+        ans = self.meta_collection.find_one({'_id': 'generation'})
+        return ans['value'] if ans else 0
+
+    def get_identity(self):
+        client = self.mongo_db.client
+        # Addresses of servers are known from client settings, without a round trip. Clients without a topology, such
+        # as mongomock's, have one address
+        if hasattr(type(client), 'topology_description'):
+            addresses = sorted(client.topology_description.server_descriptions())
+        else:
+            addresses = [client.address]
+        return 'mongodb://{}/{}/{}/{}'.format(','.join('{}:{}'.format(*address) for address in addresses),
+                                              self.mongo_db.name, self.mongo_collections['invertedIndex'],
+                                              self.mongo_collections['documents'])
+
+    def get_documents_count(self):
+        return self.documents_collection.count_documents({'deleted': {"$ne": True}})
+
+    def get_index_count(self):
+        return self.terms_collection.count_documents({})
+
+    def get_documents_for_term(self, term, arrays=False):
+        entries = list(self.index_collection.find({'term': term}))
+        return self._decode_entries(entries, arrays) if entries else None
+
+    def get_terms_statistics(self, terms):
+        ans = self.terms_collection.find({'_id': {"$in": list(set(terms))}}, {'df': 1, 'max_impact': 1})
+        return {entry['_id']: {'df': entry['df'], 'max_impact': entry['max_impact']} for entry in ans}
+
+    def get_documents_for_terms(self, terms, arrays=False):
+        term_entries = dict()
+        for entry in self.index_collection.find({'term': {"$in": list(set(terms))}}):
+            term_entries.setdefault(entry['term'], []).append(entry)
+        return {term: self._decode_entries(entries, arrays) for term, entries in term_entries.items()}
+
+    def get_blocks_for_terms(self, terms):
+        ans = dict()
+        for entry in self.index_collection.find({'term': {"$in": list(set(terms))}}, {'_id': 0, 'postings': 0}):
+            ans.setdefault(entry.pop('term'), []).append(entry)
+        for blocks in ans.values():
+            blocks.sort(key=lambda block: (block['min_id'], block['max_id']))
+        return ans
+
+    def get_documents_for_blocks(self, term, blocks, arrays=False):
+        # Blocks are found by their ranges of ids, so blocks that a concurrent compaction wrote in their place are found
+        # as well and merged with them
+        ranges = []
+        for block in sorted(blocks, key=lambda block: block['min_id']):
+            if ranges and block['min_id'] <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], block['max_id'])
+            else:
+                ranges.append([block['min_id'], block['max_id']])
+        entries = []
+        for i in range(0, len(ranges), MONGO_BULK_SIZE):
+            overlapping = [{'min_id': {"$lte": max_id}, 'max_id': {"$gte": min_id}}
+                           for min_id, max_id in ranges[i:i + MONGO_BULK_SIZE]]
+            entries.extend(self.index_collection.find({'term': term, "$or": overlapping}))
+        return self._decode_entries(entries, arrays)
+
+    def get_document_ids(self):
+        return (doc_entry['id'] for doc_entry in self.documents_collection.find({'deleted': {"$ne": True}},
+                                                                                {'_id': 0, 'id': 1}))
+
+    def get_deleted_document_ids(self):
+        return (doc_entry['id'] for doc_entry in self.documents_collection.find({'deleted': True,
+                                                                                 'purged': {"$ne": True}},
+                                                                                {'_id': 0, 'id': 1}))
+
+    def get_document_metadata(self, doc):
+        ans = self.documents_collection.find_one({'doc': doc, 'deleted': {"$ne": True}},
+                                                 {'id': 1, 'etag': 1, 'last_modified': 1, 'hash': 1})
+        return {field: ans.get(field) for field in ('id', 'etag', 'last_modified', 'hash')} if ans else None
+
+    def get_documents_metadata(self):
+        for entry in self.documents_collection.find({'deleted': {"$ne": True}},
+                                                    {'_id': 0, 'doc': 1, 'id': 1, 'etag': 1, 'last_modified': 1,
+                                                     'hash': 1}):
+            yield entry['doc'], {field: entry.get(field) for field in ('id', 'etag', 'last_modified', 'hash')}
+
+    def get_duplicates(self):
+        for entry in self.duplicates_collection.find():
+            yield entry.pop('_id'), entry
+
+    def get_document_L_d(self, doc):
+        ans = self.documents_collection.find_one({'id': doc}, {'L_d': 1})
+        return ans['L_d'] if ans else None
+
+    def _get_documents_field(self, docs, field):
+        docs = list(docs)
+        ans = dict()
+        for i in range(0, len(docs), MONGO_BULK_SIZE):
+            for entry in self.documents_collection.find({'id': {"$in": docs[i:i + MONGO_BULK_SIZE]}}, {'id': 1, field: 1}):
+                ans[entry['id']] = entry[field]
+        return ans
+
+    def get_documents_L_d(self, docs):
+        return self._get_documents_field(docs, 'L_d')
+
+    def get_documents_locations(self, docs):
+        return self._get_documents_field(docs, 'doc')
+
+    def get_locations(self):
+        return set(doc_entry['doc'] for doc_entry in self.documents_collection.find({'deleted': {"$ne": True}},
+                                                                                    {'_id': 0, 'doc': 1}))
+
+    def get_fingerprints(self):
+        return ((doc_entry['doc'], doc_entry['simhash'])
+                for doc_entry in self.documents_collection.find({'simhash': {"$exists": True}, 'deleted': {"$ne": True}},
+                                                                {'_id': 0, 'doc': 1, 'simhash': 1}))
+
+    def get_next_document_id(self):
+        ans = self.documents_collection.find_one({}, {'id': 1}, sort=[('id', -1)])
+        return ans['id'] + 1 if ans else 0
+
+    def has_document(self, doc):
+        return self.documents_collection.find_one({'doc': doc, 'deleted': {"$ne": True}}, {'_id': 1}) is not None
+
+
+# Segment file formats (all integers little-endian):
+#   <segment>.tis  term dictionary, sorted by term: nterms (I), then for each term
+#                  termlen (H), term (utf-8), postings offset (Q), postings length (I),
+#                  document frequency (I), max over term's documents of weight/L_d (d)
+#   <segment>.pst  postings lists, one after the other, each one compressed as a block by :func:`postings.encode`
+#   documents      documents table, one line "id<TAB>L_d<TAB>location" per document
+#   metadata       HTTP validators, content hash and simhash fingerprint of documents, one JSON object {"id", "etag",
+#                  "last_modified", "hash", "simhash"} per line
+#   deleted        ids of deleted documents, one per line
+#   duplicates     near-duplicate documents that were not added, one JSON object {"location", "duplicate_of", "etag",
+#                  "last_modified", "hash"} per line. A later line of a location replaces the earlier ones and a line
+#                  with null "duplicate_of" removes them
+#   purged         ids of deleted documents whose postings a full compaction dropped, one per line
+#   segments       list of committed segments, one name per line
+#   generation     index generation, increased by every write
+SEGMENT_TERMS_EXT = '.tis'
+SEGMENT_POSTINGS_EXT = '.pst'
+DOCUMENTS_FILE = 'documents'
+METADATA_FILE = 'metadata'
+DELETED_FILE = 'deleted'
+DUPLICATES_FILE = 'duplicates'
+PURGED_FILE = 'purged'
+SEGMENTS_FILE = 'segments'
+GENERATION_FILE = 'generation'
+
+_NTERMS = struct.Struct('<I')
+_TERMLEN = struct.Struct('<H')
+_TERMPOINTER = struct.Struct('<QIId')
+
+
+class Segment:
+    """
+    Immutable on-disk piece of inverted index. Its term dictionary is kept in memory and its postings are memory-mapped.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: segment path without extension
+        """
+        self.name = os.path.basename(path)
+        self.terms = []
+        self.pointers = []
+        with io.open(path + SEGMENT_TERMS_EXT, 'rb') as f:
+            data = f.read()
+        pos = _NTERMS.size
+        for _ in range(_NTERMS.unpack_from(data)[0]):
+            termlen, = _TERMLEN.unpack_from(data, pos)
+            pos += _TERMLEN.size
+            self.terms.append(data[pos:pos + termlen].decode('utf-8'))
+            pos += termlen
+            self.pointers.append(_TERMPOINTER.unpack_from(data, pos))
+            pos += _TERMPOINTER.size
+
+        self._postings_file = io.open(path + SEGMENT_POSTINGS_EXT, 'rb')
+        self.postings = mmap.mmap(self._postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def write(path, index):
+        """
+        Writes an in-memory inverted index as a new segment
+        :param path: segment path without extension
+        :param index: InvertedIndex
+        """
+        Segment.write_entries(path, ((term, postings.encode(*index[term]), len(index[term].doc_ids),
+                                      index.get_max_impact(term)) for term in sorted(index)))
+
+    @staticmethod
+    def write_entries(path, entries):
+        """
+        Writes a new segment
+        :param path: segment path without extension
+        :param entries: iterable of tuples (term, compressed postings block, df, max_impact) in ascending order of terms
+        :return: count of terms written
+        """
+        nterms = 0
+        with io.open(path + SEGMENT_POSTINGS_EXT, 'wb') as pst, io.open(path + SEGMENT_TERMS_EXT, 'wb') as tis:
+            tis.write(_NTERMS.pack(0))
+            offset = 0
+            for term, block, df, max_impact in entries:
+                pst.write(block)
+                encoded_term = term.encode('utf-8')
+                tis.write(_TERMLEN.pack(len(encoded_term)) + encoded_term +
+                          _TERMPOINTER.pack(offset, len(block), df, max_impact))
+                offset += len(block)
+                nterms += 1
+            tis.seek(0)
+            tis.write(_NTERMS.pack(nterms))
+        return nterms
+
+    def find(self, term):
+        """
+        :return: position of term in term dictionary or None if term is not in segment
+        """
+        i = bisect.bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def get_entry(self, term):
+        """
+        :return: tuple (compressed postings block, df, max_impact) of term or None if term is not in segment
+        """
+        i = self.find(term)
+        if i is None:
+            return None
+        offset, length, df, max_impact = self.pointers[i]
+        return self.postings[offset:offset + length], df, max_impact
+
+    @property
+    def size(self):
+        """ Size of postings of segment in bytes """
+        return len(self.postings)
+
+    def get_term_statistics(self, term):
+        """
+        :return: tuple (df, max_impact) of term or None if term is not in segment
+        """
+        i = self.find(term)
+        return self.pointers[i][2:] if i is not None else None
+
+    def get_block(self, term):
+        """
+        :return: compressed postings block of term or None if term is not in segment
+        """
+        i = self.find(term)
+        if i is None:
+            return None
+        offset, length = self.pointers[i][:2]
+        return self.postings[offset:offset + length]
+
+    def close(self):
+        self.postings.close()
+        self._postings_file.close()
+
+
+class LocalStorage(Storage):
+    """
+    Embedded storage in a local directory. Every write creates a new immutable segment and appends to documents table.
+    Segments that writes leave behind are merged by :meth:`compact`.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory with segment files. It is created if it does not exist
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []
+        segments_path = os.path.join(directory, SEGMENTS_FILE)
+        if os.path.exists(segments_path):
+            with io.open(segments_path, 'r', encoding='utf-8') as f:
+                self.segments = [Segment(os.path.join(directory, name)) for name in f.read().split()]
+
+        # documents table: dict with document ids as keys and tuples (location, L_d) as values and its inverse on
+        # locations
+        self.documents = dict()
+        self.ids = dict()
+        documents_path = os.path.join(directory, DOCUMENTS_FILE)
+        if os.path.exists(documents_path):
+            with io.open(documents_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    doc_id, L_d, location = line.rstrip('\n').split('\t', 2)
+                    self.documents[int(doc_id)] = (location, float(L_d))
+                    self.ids[location] = int(doc_id)
+
+        # metadata: dict with document ids as keys and dicts {'etag', 'last_modified', 'hash'} as values
+        self.metadata = dict()
+        metadata_path = os.path.join(directory, METADATA_FILE)
+        if os.path.exists(metadata_path):
+            with io.open(metadata_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.metadata[entry.pop('id')] = entry
+
+        # duplicates: dict with locations of near-duplicate documents as keys and dicts {'duplicate_of', 'etag',
+        # 'last_modified', 'hash'} as values
+        self.duplicates = dict()
+        duplicates_path = os.path.join(directory, DUPLICATES_FILE)
+        if os.path.exists(duplicates_path):
+            with io.open(duplicates_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    location = entry.pop('location')
+                    if entry['duplicate_of'] is None:
+                        self.duplicates.pop(location, None)
+                    else:
+                        self.duplicates[location] = entry
+
+        self._L_d_array = None  # numpy array with L_d of documents by id, for get_documents_L_d_array
+
+        self.deleted = set()
+        deleted_path = os.path.join(directory, DELETED_FILE)
+        if os.path.exists(deleted_path):
+            with io.open(deleted_path, 'r', encoding='utf-8') as f:
+                self.deleted = set(int(line) for line in f)
+        self.purged = set()
+        purged_path = os.path.join(directory, PURGED_FILE)
+        if os.path.exists(purged_path):
+            with io.open(purged_path, 'r', encoding='utf-8') as f:
+                self.purged = set(int(line) for line in f)
+
+    def write(self, index, documents, metadata=None, deleted=None, duplicates=None):
+        if deleted:
+            with io.open(os.path.join(self.directory, DELETED_FILE), 'a', encoding='utf-8') as f:
+                for doc_id in sorted(deleted):
+                    f.write('{}\n'.format(doc_id))
+            self.deleted.update(deleted)
+
+        if index:
+            name = self._next_segment_name()
+            Segment.write(os.path.join(self.directory, name), index)
+            self.segments.append(Segment(os.path.join(self.directory, name)))
+
+        with io.open(os.path.join(self.directory, DOCUMENTS_FILE), 'a', encoding='utf-8') as f:
+            for location, (doc_id, L_d) in sorted(documents.items(), key=lambda item: item[1]):
+                f.write('{}\t{!r}\t{}\n'.format(doc_id, L_d, location))
+                self.documents[doc_id] = (location, L_d)
+                self.ids[location] = doc_id
+        self._L_d_array = None
+
+        if metadata:
+            with io.open(os.path.join(self.directory, METADATA_FILE), 'a', encoding='utf-8') as f:
+                for location, entry in metadata.items():
+                    doc_id = documents[location][0]
+                    f.write(json.dumps(dict(entry, id=doc_id), sort_keys=True) + '\n')
+                    self.metadata[doc_id] = dict(entry)
+
+        duplicates = dict(duplicates or ())
+        duplicates.update((location, None) for location in documents if location in self.duplicates)
+        if duplicates:
+            with io.open(os.path.join(self.directory, DUPLICATES_FILE), 'a', encoding='utf-8') as f:
+                for location, entry in duplicates.items():
+                    if entry is None:
+                        self.duplicates.pop(location, None)
+                        entry = {'duplicate_of': None}
+                    else:
+                        self.duplicates[location] = dict(entry)
+                    f.write(json.dumps(dict(entry, location=location), sort_keys=True) + '\n')
+
+        self._commit()
+
+    def _next_segment_name(self):
+        return 'seg{:06d}'.format(int(self.segments[-1].name[3:]) + 1 if self.segments else 0)
+
+    def _commit(self):
+        """ Lists segments in segments file and increases index generation """
+        # Commit point: a segment becomes visible only after it is listed in segments file
+        segments_path = os.path.join(self.directory, SEGMENTS_FILE)
+        with io.open(segments_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(s.name for s in self.segments))
+        os.replace(segments_path + '.tmp', segments_path)
+
+        generation_path = os.path.join(self.directory, GENERATION_FILE)
+        with io.open(generation_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(str(self.get_generation() + 1))
+        os.replace(generation_path + '.tmp', generation_path)
+
+    def compact(self, min_fragments=COMPACT_FRAGMENTS, full=False, terms=None):
+        """
+        Merges trailing segments into one new segment. Postings of deleted documents are dropped and document frequency
+        and max impact of terms are computed again from the postings that are left. Segments are merged from the first
+        one that is at most SEGMENT_MERGE_RATIO times larger than all segments after it together, if they are at least
+        min_fragments.
+        :param min_fragments: only that many segments or more are merged. It must be at least 2
+        :param full: If it is set, all segments are merged and deleted documents are marked as purged
+        :param terms: not used, since segments are merged as a whole
+        :return: count of terms merged
+        """
+        deleted = self.get_deleted_document_ids()
+        if full:
+            start = 0 if len(self.segments) > 1 or (self.segments and deleted) else len(self.segments)
+        else:
+            start = len(self.segments)
+            after = sum(segment.size for segment in self.segments)
+            for i, segment in enumerate(self.segments[:len(self.segments) - max(min_fragments, 2) + 1]):
+                after -= segment.size
+                if segment.size <= SEGMENT_MERGE_RATIO * after:
+                    start = i
+                    break
+
+        if start < len(self.segments):
+            merged = self.segments[start:]
+            name = self._next_segment_name()
+            nterms = Segment.write_entries(os.path.join(self.directory, name), self._merge_entries(merged, deleted))
+            self.segments = self.segments[:start]
+            if nterms:
+                self.segments.append(Segment(os.path.join(self.directory, name)))
+            self._commit()
+            # Segments are removed after the commit point; readers that still map them keep their data till they close
+            for segment in merged:
+                segment.close()
+                for ext in (SEGMENT_TERMS_EXT, SEGMENT_POSTINGS_EXT):
+                    os.remove(os.path.join(self.directory, segment.name + ext))
+            if not nterms:
+                for ext in (SEGMENT_TERMS_EXT, SEGMENT_POSTINGS_EXT):
+                    os.remove(os.path.join(self.directory, name + ext))
+        else:
+            nterms = 0
+
+        if full and deleted:
+            purged_path = os.path.join(self.directory, PURGED_FILE)
+            with io.open(purged_path + '.tmp', 'w', encoding='utf-8') as f:
+                for doc_id in sorted(self.deleted):
+                    f.write('{}\n'.format(doc_id))
+            os.replace(purged_path + '.tmp', purged_path)
+            self.purged = set(self.deleted)
+        return nterms
+
+    def _merge_entries(self, segments, deleted):
+        """
+        Merges postings of segments without postings of deleted documents
+        :param segments: list of adjacent segments, in ascending order of their document ids
+        :param deleted: set of ids of deleted documents
+        :return: generator of tuples (term, compressed postings block, df, max_impact) in ascending order of terms
+        """
+        for term in sorted(set().union(*(segment.terms for segment in segments))):
+            entries = [entry for entry in (segment.get_entry(term) for segment in segments) if entry is not None]
+            if len(entries) == 1 and not deleted:
+                yield (term,) + entries[0]
+                continue
+
+            doc_ids, counts = postings.decode_blocks(block for block, _, _ in entries)
+            max_impact = max(impact for _, _, impact in entries)
+            if deleted:
+                live = [i for i, doc_id in enumerate(doc_ids) if doc_id not in deleted]
+                if not live:
+                    continue
+                if len(live) < len(doc_ids):
+                    doc_ids, counts = [doc_ids[i] for i in live], [counts[i] for i in live]
+                    max_impact = max(tf_weight(count) / self.documents[doc_id][1]
+                                     for doc_id, count in zip(doc_ids, counts))
+            yield term, postings.encode(doc_ids, counts), len(doc_ids), max_impact
+
+    def get_generation(self):
+        try:
+            with io.open(os.path.join(self.directory, GENERATION_FILE), 'r', encoding='utf-8') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def get_identity(self):
+        return 'local:' + os.path.realpath(self.directory)
+
+    def get_documents_count(self):
+        return len(self.documents) - len(self.deleted)
+
+    def get_index_count(self):
+        return len(set().union(*(s.terms for s in self.segments)))
+
+    def get_documents_for_term(self, term, arrays=False):
+        # Segments are in ascending order of their document ids, so their postings are just concatenated
+        blocks = [block for block in (segment.get_block(term) for segment in self.segments) if block is not None]
+        return postings.decode_blocks(blocks, arrays) if blocks else None
+
+    def get_terms_statistics(self, terms):
+        ans = dict()
+        for term in set(terms):
+            for segment in self.segments:
+                segment_statistics = segment.get_term_statistics(term)
+                if segment_statistics is not None:
+                    df, max_impact = segment_statistics
+                    if term in ans:
+                        ans[term]['df'] += df
+                        ans[term]['max_impact'] = max(ans[term]['max_impact'], max_impact)
+                    else:
+                        ans[term] = {'df': df, 'max_impact': max_impact}
+        return ans
+
+    def get_document_ids(self):
+        return self.documents.keys() - self.deleted if self.deleted else self.documents.keys()
+
+    def get_deleted_document_ids(self):
+        return self.deleted - self.purged if self.purged else self.deleted
+
+    def get_document_metadata(self, doc):
+        doc_id = self.ids.get(doc)
+        if doc_id is None or doc_id in self.deleted:
+            return None
+        entry = self.metadata.get(doc_id, dict())
+        return {'id': doc_id, 'etag': entry.get('etag'), 'last_modified': entry.get('last_modified'),
+                'hash': entry.get('hash')}
+
+    def get_documents_metadata(self):
+        for location, doc_id in self.ids.items():
+            if doc_id not in self.deleted:
+                entry = self.metadata.get(doc_id, dict())
+                yield location, {'id': doc_id, 'etag': entry.get('etag'), 'last_modified': entry.get('last_modified'),
+                                 'hash': entry.get('hash')}
+
+    def get_duplicates(self):
+        return ((location, dict(entry)) for location, entry in self.duplicates.items())
+
+    def get_document_L_d(self, doc):
+        return self.documents[doc][1] if doc in self.documents else None
+
+    def get_documents_L_d(self, docs):
+        return {doc: self.documents[doc][1] for doc in docs if doc in self.documents}
+
+    def get_documents_L_d_array(self, docs):
+        # L_d of all documents in an array indexed by document id, built on first use after a write
+        L_d = self._L_d_array
+        if L_d is None:
+            L_d = np.full(max(self.documents, default=-1) + 1, math.nan)
+            L_d[np.fromiter(self.documents.keys(), dtype=np.int64, count=len(self.documents))] = \
+                [value for _, value in self.documents.values()]
+            self._L_d_array = L_d
+        ans = np.full(len(docs), math.nan)
+        stored = docs < len(L_d)
+        ans[stored] = L_d[docs[stored]]
+        return ans
+
+    def get_documents_locations(self, docs):
+        return {doc: self.documents[doc][0] for doc in docs if doc in self.documents}
+
+    def get_locations(self):
+        return set(location for location, doc_id in self.ids.items() if doc_id not in self.deleted)
+
+    def get_fingerprints(self):
+        return ((self.documents[doc_id][0], entry['simhash']) for doc_id, entry in self.metadata.items()
+                if 'simhash' in entry and doc_id not in self.deleted)
+
+    def get_next_document_id(self):
+        return max(self.documents) + 1 if self.documents else 0
+
+    def has_document(self, doc):
+        return doc in self.ids and self.ids[doc] not in self.deleted
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
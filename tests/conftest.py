@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from collection import Collection  # noqa: E402
+from document import LocalDocument, textpreprocess  # noqa: E402
+from storage import LocalStorage  # noqa: E402
+
+# Count of generated documents and of distinct words in them
+DOCUMENTS = 200
+VOCABULARY = 300
+
+# Small flush limit, so that generated indexes are written in many segments
+FLUSH_POSTINGS = 1500
+
+
+def generate_corpus(directory, seed=7):
+    """
+    Writes documents of words 'w1', 'w2', ... with skewed frequencies, like those of natural language
+    :return: list of paths of documents
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(DOCUMENTS):
+        words = ['w{}'.format(min(int(rng.paretovariate(0.8)), VOCABULARY)) for _ in range(rng.randint(5, 80))]
+        path = os.path.join(directory, 'doc{:03d}.txt'.format(i))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(' '.join(words))
+        paths.append(path)
+    return paths
+
+
+def read_collection(directory, paths):
+    """
+    :return: Collection on a LocalStorage in directory with documents of paths read and flushed
+    """
+    collection = Collection(storage=LocalStorage(directory), flush_postings=FLUSH_POSTINGS)
+    collection.read_documents([LocalDocument(path) for path in paths])
+    collection.flush_to_mongo()
+    return collection
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """ Paths of generated documents """
+    directory = tmp_path / 'corpus'
+    directory.mkdir()
+    return generate_corpus(str(directory))
+
+
+@pytest.fixture
+def indexed(tmp_path, corpus):
+    """
+    Collection of the generated documents, with every tenth document deleted, and dict with locations of documents
+    that are not deleted as keys and sets of their tokens as values
+    """
+    collection = read_collection(str(tmp_path / 'index'), corpus)
+    tokens = dict()
+    for i, path in enumerate(corpus):
+        location = os.path.basename(path)
+        if i % 10 == 0:
+            collection.delete_document(location)
+        else:
+            with open(path, encoding='utf-8') as f:
+                tokens[location] = set(textpreprocess(f.read()))
+    collection.flush_to_mongo()
+    return collection, tokens
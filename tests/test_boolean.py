@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+import bitmap
+import boolean_expression_parse
+from bitmap import Bitmap
+from document import textpreprocess
+
+QUERIES = [
+    'w1',
+    'w1 and w2',
+    'w1 or w9',
+    'w3 and not w1',
+    'not w2',
+    'not not w2',
+    'not w1 and not w2 and w5',
+    'w1 and w2 or w3 and not w4',
+    'w2 and w3 and w4 and w6',
+    'w8 or w1 and w2 or w7',
+    'w1 and missing',
+    'missing or w7',
+    'not missing',
+]
+
+
+def holds(node, tokens):
+    """
+    Plain evaluation of an expression tree on the set of tokens of one document
+    :return: True if document satisfies the expression
+    """
+    if node.op == 'term':
+        return node.value in tokens
+    if node.op == 'not':
+        return not holds(node.value, tokens)
+    if node.op == 'and':
+        return all(holds(operand, tokens) for operand in node.value)
+    return any(holds(operand, tokens) for operand in node.value)
+
+
+@pytest.mark.parametrize('q', QUERIES)
+def test_boolean_query_matches_set_evaluation(indexed, q):
+    collection, tokens = indexed
+    # Tree as it is parsed, before it is simplified and planned
+    tree = boolean_expression_parse.parser.boolExpr.parseString(' '.join(textpreprocess(q)))[0]
+    expected = {location for location, t in tokens.items() if holds(tree, t)}
+    assert {location for location, _ in collection.processquery_boolean(q)} == expected
+    assert {location for location, _ in collection.iter_boolean(q)} == expected
+
+
+def test_iter_boolean_pages_the_results(indexed):
+    collection, _ = indexed
+    results = list(collection.iter_boolean('w1 or w2'))
+    assert list(collection.iter_boolean('w1 or w2', offset=4, limit=10)) == results[4:14]
+
+
+def test_bitmap_set_operations_match_sets():
+    rng = random.Random(5)
+    # Ids in a few containers, with gaps and a container of one set only
+    a = {rng.randrange(3 << 16) for _ in range(5000)} | {(5 << 16) + 7}
+    b = {rng.randrange(1 << 16, 4 << 16) for _ in range(5000)}
+    x, y = Bitmap.from_ids(a), Bitmap.from_ids(b)
+    assert list(x) == sorted(a) and len(x) == len(a)
+    assert list(x & y) == sorted(a & b)
+    assert list(x | y) == sorted(a | b)
+    assert list(x - y) == sorted(a - b) and list(y - x) == sorted(b - a)
+    assert (5 << 16) + 7 in x and (5 << 16) + 7 not in y
+    assert not (x - x) and Bitmap.from_ids([]) == x - x
+    if bitmap.np is not None:
+        assert Bitmap.from_array(bitmap.np.array(sorted(a), dtype=bitmap.np.int64)) == x
+
+
+def parse(q):
+    return boolean_expression_parse.parser.parse(q)
+
+
+def term(value):
+    return boolean_expression_parse.Node('term', value)
+
+
+def test_expressions_are_simplified():
+    Node = boolean_expression_parse.Node
+    assert parse('a and (b and c) and a') == Node('and', (term('a'), term('b'), term('c')))
+    assert parse('a or (b or a)') == Node('or', (term('a'), term('b')))
+    assert parse('not not a') == term('a')
+    assert parse('not a and not b and not c') == Node('not', Node('or', (term('a'), term('b'), term('c'))))
+    assert parse('a and not a and not b') == Node('and', (term('a'), Node('not', term('a')), Node('not', term('b'))))
+
+
+# Documents of terms of a planned evaluation, with the universe of its complements
+SETS = {'a': set(range(0, 100)), 'b': set(range(50, 60)), 'c': set(range(55, 1000)), 'd': set(range(200, 210)),
+        'e': {1, 2, 3}}
+UNIVERSE = set(range(1000))
+
+
+def evaluate(q, costfn=None):
+    """ :return: tuple (result, list of terms in order of evaluation) of q on SETS """
+    calls = []
+
+    def evalfn(term):
+        calls.append(term)
+        return SETS.get(term, set())
+
+    return boolean_expression_parse.evaluate(parse(q), evalfn, lambda s: UNIVERSE - s, costfn), calls
+
+
+def size(term):
+    return len(SETS.get(term, ()))
+
+
+def test_and_operands_are_evaluated_cheapest_first():
+    result, calls = evaluate('c and a and b', size)
+    assert result == SETS['a'] & SETS['b'] & SETS['c'] and calls == ['b', 'a', 'c']
+    # Evaluation stops at the first empty intersection
+    result, calls = evaluate('c and a and e and d', size)
+    assert result == set() and calls == ['e', 'd']
+    # Negated operands are evaluated last and subtracted
+    result, calls = evaluate('not e and a and b', size)
+    assert result == SETS['b'] and calls == ['b', 'a', 'e']
+
+
+def test_repeated_subexpressions_are_evaluated_once():
+    result, calls = evaluate('(a or b) and c or (a or b) and d or not (a or b)', size)
+    ab = SETS['a'] | SETS['b']
+    assert result == ab & SETS['c'] | ab & SETS['d'] | UNIVERSE - ab
+    assert sorted(calls) == ['a', 'b', 'c', 'd']
+
+
+@pytest.mark.parametrize('q', ['c and a and b', 'a and b or c and not d', 'not (a or e) and c', 'e and missing or b',
+                               'c and (d or b) and not (b and a)', 'not a and not c and d'])
+def test_planned_evaluation_matches_query_order(q):
+    assert evaluate(q, size)[0] == evaluate(q)[0]
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from fetcher import Fetcher, RejectedResponse, read_body
+
+PAGE = b'<html><body>' + b'information retrieval ' * 200 + b'</body></html>'
+MAX_BODY_SIZE = 10000
+
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def corrupt(data):
+    """ :return: data with bytes in its middle changed """
+    middle = len(data) // 2
+    return data[:middle] + bytes(b ^ 0xff for b in data[middle:middle + 8]) + data[middle + 8:]
+
+
+# Bodies of compressed responses, by path, with their Content-Encoding
+COMPRESSED = {
+    '/deflate': (zlib.compress(PAGE), 'deflate'),
+    '/raw-deflate': (raw_deflate(PAGE), 'deflate'),
+    '/corrupt-gzip': (corrupt(gzip.compress(PAGE)), 'gzip'),
+    '/corrupt-deflate': (corrupt(zlib.compress(PAGE)), 'deflate'),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Client ports of connections and max count of concurrent requests to '/slow' urls, of all handlers
+    lock = threading.Lock()
+    ports = set()
+    running = 0
+    max_running = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, content_type='text/html', headers=None, length=True):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        if length:
+            self.send_header('Content-Length', str(len(body)))
+        else:
+            # Body size is known only when connection is closed
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with Handler.lock:
+            Handler.ports.add(self.client_address[1])
+        if self.path.startswith('/slow'):
+            with Handler.lock:
+                Handler.running += 1
+                Handler.max_running = max(Handler.max_running, Handler.running)
+            time.sleep(0.05)
+            with Handler.lock:
+                Handler.running -= 1
+            self.send(PAGE)
+        elif self.path == '/gzip':
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                self.send(gzip.compress(PAGE), headers={'Content-Encoding': 'gzip'})
+            else:
+                self.send(PAGE)
+        elif self.path in COMPRESSED:
+            body, encoding = COMPRESSED[self.path]
+            self.send(body, headers={'Content-Encoding': encoding})
+        elif self.path == '/big':
+            self.send(b'x' * (MAX_BODY_SIZE + 1))
+        elif self.path == '/big-stream':
+            self.send(b'x' * (MAX_BODY_SIZE + 1), length=False)
+        elif self.path == '/big-gzip':
+            self.send(gzip.compress(b'x' * (100 * MAX_BODY_SIZE)), headers={'Content-Encoding': 'gzip'})
+        elif self.path == '/pdf':
+            self.send(b'%PDF-1.4', content_type='application/pdf')
+        elif self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send(PAGE, headers={'ETag': '"v1"'})
+        elif self.path.startswith('/page'):
+            self.send(PAGE)
+        else:
+            self.send_error(404)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture(scope='module')
+def base_url():
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = Fetcher(max_connections=4, max_connections_per_host=2, timeout=5, max_body_size=MAX_BODY_SIZE)
+    yield fetcher
+    fetcher.close()
+
+
+def test_fetch_all(base_url, fetcher):
+    urls = [base_url + '/page{}'.format(i) for i in range(20)] + [base_url + '/missing', 'ftp://x/y']
+    results = {url: (response, error) for url, response, error in fetcher.fetch_all(urls)}
+    assert set(results) == set(urls)
+    for url in urls[:20]:
+        response, error = results[url]
+        assert error is None and response.status == 200 and response.body == PAGE
+    assert results[base_url + '/missing'][1].code == 404
+    assert results['ftp://x/y'][1] is not None
+
+
+def test_gzip_body_is_decompressed(base_url, fetcher):
+    response = fetcher.fetch(base_url + '/gzip')
+    assert response.status == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.body == PAGE
+
+
+@pytest.mark.parametrize('path', ['/deflate', '/raw-deflate'])
+def test_deflate_body_is_decompressed(base_url, fetcher, path):
+    assert fetcher.fetch(base_url + path).body == PAGE
+
+
+class Chunked:
+    """ Response with a Content-Encoding whose body is read in chunks of one byte """
+
+    def __init__(self, body, encoding):
+        self.body = body
+        self.encoding = encoding
+
+    def getheader(self, name):
+        return self.encoding if name == 'Content-Encoding' else None
+
+    def read1(self, size):
+        chunk, self.body = self.body[:1], self.body[1:]
+        return chunk
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('path', ['/deflate', '/raw-deflate'])
+def test_deflate_body_is_decompressed_from_small_chunks(path):
+    assert read_body(Chunked(*COMPRESSED[path])) == PAGE
+
+
+@pytest.mark.parametrize('path', ['/corrupt-gzip', '/corrupt-deflate'])
+def test_corrupt_body_is_rejected(base_url, fetcher, path):
+    with pytest.raises(RejectedResponse):
+        fetcher.fetch(base_url + path)
+    assert fetcher.fetch(base_url + '/page').body == PAGE
+
+
+@pytest.mark.parametrize('path', ['/big', '/big-stream', '/big-gzip'])
+def test_oversized_body_is_rejected(base_url, fetcher, path):
+    with pytest.raises(RejectedResponse):
+        fetcher.fetch(base_url + path)
+    # Connection of rejected response is not reused
+    assert fetcher.fetch(base_url + '/page').body == PAGE
+
+
+def test_content_type_is_rejected(base_url, fetcher):
+    with pytest.raises(RejectedResponse):
+        fetcher.fetch(base_url + '/pdf')
+    assert fetcher.fetch(base_url + '/page').body == PAGE
+
+
+def test_fetch_all_reports_rejected_responses(base_url, fetcher):
+    urls = [base_url + path for path in ('/pdf', '/big', '/corrupt-gzip', '/corrupt-deflate', '/gzip', '/page')]
+    results = {url: (response, error) for url, response, error in fetcher.fetch_all(urls)}
+    for path in ('/pdf', '/big', '/corrupt-gzip', '/corrupt-deflate'):
+        assert isinstance(results[base_url + path][1], RejectedResponse)
+    assert results[base_url + '/gzip'][0].body == results[base_url + '/page'][0].body == PAGE
+
+
+def test_not_modified(base_url, fetcher):
+    response = fetcher.fetch(base_url + '/etag')
+    assert response.status == 200 and response.body == PAGE
+    response = fetcher.fetch(base_url + '/etag', {'If-None-Match': response.headers['ETag']})
+    assert response.status == 304
+    assert response.body == b''
+
+
+def test_fetch_all_conditional_headers(base_url, fetcher):
+    urls = [base_url + '/etag', base_url + '/page']
+    results = {url: response for url, response, _ in
+               fetcher.fetch_all(urls, get_headers=lambda url: {'If-None-Match': '"v1"'})}
+    assert results[base_url + '/etag'].status == 304
+    assert results[base_url + '/page'].body == PAGE
+
+
+def test_connections_are_pooled_per_host(base_url, fetcher):
+    with Handler.lock:
+        Handler.ports.clear()
+        Handler.max_running = 0
+    urls = [base_url + '/slow{}'.format(i) for i in range(12)]
+    assert all(error is None for _, _, error in fetcher.fetch_all(urls))
+    # Requests to one host run on at most max_connections_per_host keep-alive connections at a time
+    assert Handler.max_running <= 2 and len(Handler.ports) <= 2
+
+
+def test_requests_to_a_host_are_spaced_by_delay(base_url):
+    fetcher = Fetcher(max_connections=4, max_connections_per_host=4, timeout=5, delay=0.05)
+    try:
+        start = time.monotonic()
+        results = list(fetcher.fetch_all([base_url + '/page{}'.format(i) for i in range(5)]))
+        assert all(error is None for _, _, error in results)
+        assert time.monotonic() - start >= 4 * 0.05
+    finally:
+        fetcher.close()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from frontier import BloomFilter, Frontier
+
+
+def test_bloom_filter_grows_without_false_negatives():
+    bloom = BloomFilter(capacity=100, error_rate=0.01)
+    items = ['http://example.com/{}'.format(i) for i in range(1000)]
+    # A new item is taken for a seen one only on a false positive
+    added = sum(bloom.add(item) for item in items)
+    assert added > 980 and len(bloom) == added and len(bloom._filters) > 1
+    assert all(item in bloom for item in items)
+    assert not bloom.add(items[0])
+    false_positives = sum('http://example.org/{}'.format(i) in bloom for i in range(1000))
+    assert false_positives < 30
+
+
+def test_links_are_queued_once(tmp_path):
+    frontier = Frontier(str(tmp_path))
+    assert frontier.add('http://a/1') and frontier.add('http://a/2')
+    assert not frontier.add('http://a/1')
+    assert list(frontier.pending()) == ['http://a/1', 'http://a/2']
+    frontier.mark_done('http://a/1')
+    assert frontier.pending_count() == 1
+    frontier.close()
+
+
+def test_crawl_resumes_from_last_checkpoint(tmp_path):
+    directory = str(tmp_path)
+    frontier = Frontier(directory)
+    for i in range(3):
+        frontier.add('http://a/{}'.format(i))
+    frontier.next_depth()
+    for i in range(3, 8):
+        frontier.add('http://a/{}'.format(i))
+    frontier.mark_done('http://a/3')
+    frontier.mark_done('http://a/4')
+    frontier.checkpoint()
+    # Done after the last checkpoint, so it is crawled again on resume
+    frontier.mark_done('http://a/5')
+
+    resumed = Frontier(directory, resume=True)
+    assert resumed.depth == 1
+    assert list(resumed.pending()) == ['http://a/{}'.format(i) for i in range(5, 8)]
+    assert resumed.pending_count() == 3
+    # Links of every depth are still seen
+    assert not resumed.add('http://a/0') and not resumed.add('http://a/7')
+    assert resumed.add('http://a/8', depth=2)
+    assert list(resumed.links()) == ['http://a/{}'.format(i) for i in range(9)]
+
+
+def test_frontier_without_resume_starts_over(tmp_path):
+    frontier = Frontier(str(tmp_path))
+    frontier.add('http://a/1')
+    frontier.next_depth()
+    frontier.close()
+
+    fresh = Frontier(str(tmp_path))
+    assert fresh.depth == 0 and not list(fresh.links())
+    assert fresh.add('http://a/1')
+
+
+def test_temporary_frontier_is_removed_on_close():
+    frontier = Frontier()
+    frontier.add('http://a/1')
+    directory = frontier.directory
+    frontier.close()
+    assert not os.path.exists(directory)
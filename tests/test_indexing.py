@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from collection import Collection
+from conftest import FLUSH_POSTINGS, VOCABULARY
+from document import LocalDocument
+from storage import LocalStorage
+
+TERMS = ['w{}'.format(i) for i in range(1, VOCABULARY + 1)]
+
+
+def index(directory, paths, workers=1, background_flush=False):
+    """ :return: LocalStorage in directory with documents of paths read in chunks of FLUSH_POSTINGS postings """
+    collection = Collection(storage=LocalStorage(directory), flush_postings=FLUSH_POSTINGS,
+                            background_flush=background_flush)
+    collection.read_documents([LocalDocument(path) for path in paths], workers=workers)
+    collection.flush_to_mongo()
+    return collection.storage
+
+
+def contents(storage):
+    """ :return: tuple (postings of all terms, L_d of all documents, locations of all documents) of storage """
+    ids = list(storage.get_document_ids())
+    return ({term: tuple(map(list, docs)) for term, docs in storage.get_documents_for_terms(TERMS).items()},
+            storage.get_documents_L_d(ids), storage.get_documents_locations(ids))
+
+
+@pytest.mark.parametrize('workers, background_flush', [(2, False), (1, True), (3, True)])
+def test_parallel_and_background_indexing_match_sequential(tmp_path, corpus, workers, background_flush):
+    expected = contents(index(str(tmp_path / 'sequential'), corpus))
+    storage = index(str(tmp_path / 'index'), corpus, workers, background_flush)
+    assert storage.get_generation() > 1
+    assert contents(storage) == expected
+
+
+def test_documents_already_stored_are_skipped(tmp_path, corpus):
+    directory = str(tmp_path / 'index')
+    index(directory, corpus[:120], workers=2)
+    storage = index(directory, corpus, workers=2)
+    assert contents(storage) == contents(index(str(tmp_path / 'sequential'), corpus))
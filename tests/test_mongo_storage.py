@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+import collection as collection_module
+import postings
+import storage as storage_module
+from collection import Collection
+from conftest import FLUSH_POSTINGS, read_collection
+from document import LocalDocument
+from storage import MongoStorage
+
+mongomock = pytest.importorskip('mongomock')
+
+COLLECTIONS = {'invertedIndex': 'invertedIndex', 'documents': 'documents'}
+
+# Small blocks, so that postings of generated documents are split in many blocks
+BLOCK_SIZE = 16
+
+QUERIES = ['w1', 'w2 w3', 'w1 w5 w9', 'w4 w4 w7', 'w40 w1', 'w1 w2 w3 w6 w8']
+
+
+@pytest.fixture(autouse=True)
+def block_size(monkeypatch):
+    monkeypatch.setattr(storage_module, 'POSTINGS_BLOCK_SIZE', BLOCK_SIZE)
+    monkeypatch.setattr(collection_module, 'SKIP_BLOCKS_MIN_DF', 2 * BLOCK_SIZE)
+
+
+def read_mongo(paths):
+    """ :return: Collection on a MongoStorage of a mongomock database with documents of paths read and flushed """
+    collection = Collection(storage=MongoStorage(mongomock.MongoClient()['test'], COLLECTIONS),
+                            flush_postings=FLUSH_POSTINGS)
+    collection.read_documents([LocalDocument(path) for path in paths])
+    collection.flush_to_mongo()
+    return collection
+
+
+def delete(collections, corpus):
+    """ Deletes every seventh document of corpus from each of collections """
+    for collection in collections:
+        for path in corpus[::7]:
+            collection.delete_document(os.path.basename(path))
+        collection.flush_to_mongo()
+
+
+def rounded(results):
+    return [(location, round(similarity, 9)) for location, similarity in results]
+
+
+def scores(collection, top=-1):
+    return [rounded(collection.processquery_vector(q, above=0, top=top)) for q in QUERIES]
+
+
+def term_blocks(storage):
+    """ :return: dict with terms as keys and lists of their blocks, in ascending order of ids, as values """
+    ans = dict()
+    for entry in storage.index_collection.find():
+        ans.setdefault(entry['term'], []).append(entry)
+    for blocks in ans.values():
+        blocks.sort(key=lambda entry: entry['min_id'])
+    return ans
+
+
+def test_blocks_and_term_statistics_are_written(tmp_path, corpus):
+    mongo = read_mongo(corpus).storage
+    local = read_collection(str(tmp_path / 'index'), corpus).storage
+
+    blocks = term_blocks(mongo)
+    assert any(len(entries) > 2 for entries in blocks.values())
+    for term, entries in blocks.items():
+        expected = local.get_documents_for_term(term)
+        doc_ids, counts = [], []
+        for entry in entries:
+            block_ids, block_counts = postings.decode(entry['postings'])
+            assert 0 < entry['df'] == len(block_ids) <= BLOCK_SIZE
+            assert (entry['min_id'], entry['max_id']) == (block_ids[0], block_ids[-1])
+            assert entry['max_tf'] == max(block_counts)
+            doc_ids.extend(block_ids)
+            counts.extend(block_counts)
+        assert (doc_ids, counts) == (expected.doc_ids, expected.counts)
+
+        statistics = mongo.terms_collection.find_one({'_id': term})
+        assert statistics['df'] == len(doc_ids)
+        assert statistics['max_impact'] == pytest.approx(local.get_terms_statistics([term])[term]['max_impact'])
+        assert statistics['fragments'] == sum(entry['df'] < BLOCK_SIZE for entry in entries)
+
+    headers = mongo.get_blocks_for_terms(['w1', 'w2'])
+    assert [(header['min_id'], header['max_id'], header['max_tf']) for header in headers['w1']] == \
+        [(entry['min_id'], entry['max_id'], entry['max_tf']) for entry in blocks['w1']]
+
+
+def test_compact_merges_fragments(corpus):
+    collection = read_mongo(corpus)
+    mongo = collection.storage
+    before = {term: mongo.get_documents_for_term(term) for term in term_blocks(mongo)}
+    assert any(entry['fragments'] > 1 for entry in mongo.terms_collection.find())
+
+    assert collection.compact(min_fragments=2) > 0
+    for term, entries in term_blocks(mongo).items():
+        assert mongo.get_documents_for_term(term) == before[term]
+        fragments = sum(entry['df'] < BLOCK_SIZE for entry in entries)
+        assert fragments <= 1 and mongo.terms_collection.find_one({'_id': term})['fragments'] == fragments
+
+
+def test_full_compact_purges_deleted_documents(tmp_path, corpus):
+    collection = read_mongo(corpus)
+    local = read_collection(str(tmp_path / 'index'), corpus)
+    delete([collection, local], corpus)
+    mongo = collection.storage
+    deleted = set(mongo.get_deleted_document_ids())
+    assert deleted
+
+    collection.compact(full=True)
+    local.compact(full=True)
+    assert not set(mongo.get_deleted_document_ids())
+    for term, entries in term_blocks(mongo).items():
+        doc_ids = mongo.get_documents_for_term(term).doc_ids
+        assert not deleted & set(doc_ids)
+        assert mongo.terms_collection.find_one({'_id': term})['df'] == len(doc_ids)
+    assert scores(Collection(storage=mongo)) == scores(local)
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_top_k_skips_blocks(tmp_path, corpus, monkeypatch, vectorized):
+    collection = read_mongo(corpus)
+    local = read_collection(str(tmp_path / 'index'), corpus)
+    if not vectorized:
+        monkeypatch.setattr(collection_module, 'np', None)
+    elif collection_module.np is None:
+        pytest.skip('numpy is not installed')
+
+    fetched = []
+    fetch = collection.storage.get_documents_for_blocks
+    monkeypatch.setattr(collection.storage, 'get_documents_for_blocks',
+                        lambda term, blocks, arrays=False: fetched.append(len(blocks)) or fetch(term, blocks, arrays))
+    for top in (1, 5, 20):
+        assert scores(collection, top) == [results[:top] for results in scores(local)]
+    assert fetched
+    # Once documents of the rare term are scored, most blocks of the common term cannot lift any of them to the top
+    del fetched[:]
+    collection.processquery_vector('w40 w1', above=0, top=2)
+    assert 0 < sum(fetched) < len(collection.storage.get_blocks_for_terms(['w1'])['w1'])
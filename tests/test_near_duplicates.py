@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from collection import Collection
+from document import LocalDocument
+from sharding import ShardedCollection, shard_of
+from simhash import FingerprintIndex
+from storage import LocalStorage
+
+TEXT = 'information retrieval with inverted indexes and the vector model of documents and queries'
+
+
+def write(directory, name, text):
+    with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def open_collection(index_directory, shards=1):
+    """ :return: Collection, or ShardedCollection if there are many shards, that detects near-duplicates """
+    near_duplicates = FingerprintIndex()
+    if shards == 1:
+        return Collection(storage=LocalStorage(index_directory), near_duplicates=near_duplicates)
+    return ShardedCollection([Collection(storage=LocalStorage(os.path.join(index_directory, 'shard{}'.format(i))),
+                                         near_duplicates=near_duplicates) for i in range(shards)])
+
+
+def sync(index_directory, directory, workers=1, shards=1):
+    """ :return: tuple (Collection, counts) of a sync of documents of directory, with missing documents deleted """
+    collection = open_collection(index_directory, shards)
+    docs = [LocalDocument(os.path.join(directory, name), directory) for name in sorted(os.listdir(directory))]
+    counts = collection.sync_documents(docs, workers=workers, delete_missing=True)
+    collection.flush_to_mongo()
+    return collection, counts
+
+
+@pytest.fixture
+def directories(tmp_path):
+    documents = tmp_path / 'documents'
+    documents.mkdir()
+    write(str(documents), 'a.txt', TEXT)
+    write(str(documents), 'b.txt', TEXT)
+    write(str(documents), 'c.txt', 'crawling the web politely')
+    return str(documents), str(tmp_path / 'index')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_near_duplicate_is_stored_and_not_read_again(directories, workers):
+    directory, index_directory = directories
+    collection, counts = sync(index_directory, directory, workers)
+    assert counts['added'] == 2 and counts['duplicates'] == 1
+    assert collection.get_locations() == {'a.txt', 'c.txt'}
+    assert dict(collection.storage.get_duplicates())['b.txt']['duplicate_of'] == 'a.txt'
+
+    _, counts = sync(index_directory, directory, workers)
+    assert counts == {'added': 0, 'changed': 0, 'unchanged': 3, 'deleted': 0, 'duplicates': 0}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_near_duplicate_of_deleted_document_is_added(directories, workers):
+    directory, index_directory = directories
+    sync(index_directory, directory, workers)
+    os.remove(os.path.join(directory, 'a.txt'))
+
+    collection, counts = sync(index_directory, directory, workers)
+    assert counts == {'added': 0, 'changed': 1, 'unchanged': 1, 'deleted': 1, 'duplicates': 0}
+    assert collection.get_locations() == {'b.txt', 'c.txt'}
+    assert not dict(collection.storage.get_duplicates())
+    assert [location for location, _ in collection.processquery_vector('vector model')] == ['b.txt']
+
+    _, counts = sync(index_directory, directory, workers)
+    assert counts['unchanged'] == 2 and counts['changed'] == 0
+
+
+def test_near_duplicate_of_changed_document_is_added(directories):
+    directory, index_directory = directories
+    sync(index_directory, directory)
+    write(directory, 'a.txt', 'a page about something else entirely')
+
+    collection, counts = sync(index_directory, directory)
+    assert counts == {'added': 0, 'changed': 2, 'unchanged': 1, 'deleted': 0, 'duplicates': 0}
+    assert collection.get_locations() == {'a.txt', 'b.txt', 'c.txt'}
+    assert not dict(collection.storage.get_duplicates())
+
+
+def test_near_duplicate_of_changed_document_stays_duplicate(directories):
+    directory, index_directory = directories
+    sync(index_directory, directory)
+    # After a small edit of a.txt, b.txt is read again and stored again as its near-duplicate
+    write(directory, 'a.txt', TEXT + ' again')
+
+    collection, counts = sync(index_directory, directory)
+    assert counts['changed'] == 1 and counts['duplicates'] == 1
+    assert collection.get_locations() == {'a.txt', 'c.txt'}
+    assert dict(collection.storage.get_duplicates())['b.txt']['duplicate_of'] == 'a.txt'
+
+
+def test_near_duplicates_are_found_across_shards(tmp_path, directories):
+    directory, index_directory = directories
+    # Near-duplicates a.txt and b.txt are in different shards
+    assert shard_of('a.txt', 2) != shard_of('b.txt', 2)
+    os.rename(os.path.join(directory, 'b.txt'), str(tmp_path / 'b.txt'))
+    _, counts = sync(index_directory, directory, shards=2)
+    assert counts['added'] == 2
+
+    # b.txt is checked against stored a.txt of the other shard
+    os.rename(str(tmp_path / 'b.txt'), os.path.join(directory, 'b.txt'))
+    collection, counts = sync(index_directory, directory, shards=2)
+    assert counts == {'added': 0, 'changed': 0, 'unchanged': 2, 'deleted': 0, 'duplicates': 1}
+    assert collection.get_locations() == {'a.txt', 'c.txt'}
+
+    # b.txt is read again when a.txt of the other shard is deleted
+    os.remove(os.path.join(directory, 'a.txt'))
+    collection, counts = sync(index_directory, directory, shards=2)
+    assert counts == {'added': 0, 'changed': 1, 'unchanged': 1, 'deleted': 1, 'duplicates': 0}
+    assert collection.get_locations() == {'b.txt', 'c.txt'}
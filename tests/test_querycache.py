@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from collection import Collection, search
+from document import LocalDocument
+from querycache import QueryCache, estimate_size
+from sharding import ShardedCollection
+from storage import LocalStorage, MongoStorage
+
+
+def index(directory, documents):
+    """
+    :param documents: dict with file names as keys and texts as values, written in directory/documents
+    :return: Collection in directory/index with documents read and flushed
+    """
+    os.makedirs(os.path.join(directory, 'documents'))
+    paths = []
+    for name, text in documents.items():
+        paths.append(os.path.join(directory, 'documents', name))
+        with open(paths[-1], 'w', encoding='utf-8') as f:
+            f.write(text)
+    collection = Collection(storage=LocalStorage(os.path.join(directory, 'index')))
+    collection.read_documents([LocalDocument(path) for path in paths])
+    collection.flush_to_mongo()
+    return collection
+
+
+def test_results_are_valid_for_their_generation():
+    cache = QueryCache()
+    cache.put('q', 1, [('a', 0.5)])
+    assert cache.get('q', 1) == [('a', 0.5)]
+    assert cache.get('q', 2) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_results_are_evicted():
+    result = [('a', 0.5)]
+    cache = QueryCache(max_size=2 * estimate_size('q1', result))
+    cache.put('q1', 1, result)
+    cache.put('q2', 1, result)
+    cache.get('q1', 1)
+    cache.put('q3', 1, result)
+    assert cache.get('q2', 1) is None
+    assert cache.get('q1', 1) == result and cache.get('q3', 1) == result
+    assert cache.size <= cache.max_size
+
+
+def test_cache_is_saved_and_loaded(tmp_path):
+    path = str(tmp_path / 'cache.pkl')
+    cache = QueryCache(path)
+    cache.put('q', 3, [('a', 1)])
+    cache.save()
+    loaded = QueryCache(path)
+    assert loaded.get('q', 3) == [('a', 1)] and loaded.size == cache.size
+
+
+def test_collection_results_are_cached_till_next_flush(tmp_path):
+    collection = index(str(tmp_path), {'x.txt': 'apple pie', 'y.txt': 'banana split'})
+    collection.query_cache = QueryCache()
+    result = list(search(collection, 'vector', 'apple'))
+    assert [location for location, _ in result] == ['x.txt']
+    assert list(search(collection, 'vector', 'apple')) == result
+    assert collection.query_cache.hits == 1
+
+    collection.delete_document('x.txt')
+    collection.flush_to_mongo()
+    assert list(search(collection, 'boolean', 'apple or banana')) == [('y.txt', 1)]
+    assert collection.query_cache.misses == 2
+
+
+def test_cache_file_shared_by_indexes(tmp_path):
+    path = str(tmp_path / 'cache.pkl')
+    first = index(str(tmp_path / 'first'), {'x.txt': 'apple pie'})
+    second = index(str(tmp_path / 'second'), {'y.txt': 'apple juice'})
+    assert first.get_generation() == second.get_generation()
+
+    first.query_cache = QueryCache(path)
+    assert [location for location, _ in search(first, 'vector', 'apple')] == ['x.txt']
+    assert list(search(first, 'boolean', 'apple')) == [('x.txt', 1)]
+    first.query_cache.save()
+
+    # Results of the first index, at the same generation, are not results of the second one
+    second.query_cache = QueryCache(path)
+    assert [location for location, _ in search(second, 'vector', 'apple')] == ['y.txt']
+    assert list(search(second, 'boolean', 'apple')) == [('y.txt', 1)]
+    assert second.query_cache.hits == 0
+
+    sharded = ShardedCollection([first, second], QueryCache(path))
+    assert sorted(location for location, _ in search(sharded, 'boolean', 'apple')) == ['x.txt', 'y.txt']
+    assert sharded.query_cache.hits == 0
+
+
+def test_storage_identities():
+    mongomock = pytest.importorskip('mongomock')
+    client = mongomock.MongoClient()
+    collections = {'invertedIndex': 'invertedIndex', 'documents': 'documents'}
+    identities = {MongoStorage(client['first'], collections).get_identity(),
+                  MongoStorage(client['second'], collections).get_identity(),
+                  MongoStorage(client['first'], dict(collections, documents='other')).get_identity()}
+    assert len(identities) == 3
+    assert MongoStorage(client['first'], collections).get_identity() in identities
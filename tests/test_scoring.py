@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import collection as collection_module
+from conftest import read_collection
+
+QUERIES = ['w1', 'w2 w3', 'w1 w5 w9', 'w4 w4 w7', 'w11 w2 w30', 'w1 w2 w3 w6 w8']
+
+
+def rounded(results):
+    return [(location, round(similarity, 9)) for location, similarity in results]
+
+
+@pytest.mark.parametrize('q', QUERIES)
+def test_numpy_and_python_scorers_rank_alike(indexed, monkeypatch, q):
+    collection, _ = indexed
+    if collection_module.np is None:
+        pytest.skip('numpy is not installed')
+    numpy_results = rounded(collection.processquery_vector(q, above=0))
+    monkeypatch.setattr(collection_module, 'np', None)
+    assert numpy_results
+    assert rounded(collection.processquery_vector(q, above=0)) == numpy_results
+
+
+@pytest.mark.parametrize('q', QUERIES)
+@pytest.mark.parametrize('top', [1, 5, 20])
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_maxscore_ranks_as_exhaustive_scoring(indexed, monkeypatch, q, top, vectorized):
+    collection, _ = indexed
+    if vectorized and collection_module.np is None:
+        pytest.skip('numpy is not installed')
+    if not vectorized:
+        monkeypatch.setattr(collection_module, 'np', None)
+    for above in (0, 0.2):
+        results = rounded(collection.processquery_vector(q, above=above))
+        assert rounded(collection.processquery_vector(q, above=above, top=top)) == results[:top]
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_maxscore_skips_documents_that_cannot_enter_top(tmp_path, monkeypatch, vectorized):
+    # Documents with the rare term are short, so once they are scored no document with only the common term can enter
+    # the top-k
+    directory = tmp_path / 'corpus'
+    directory.mkdir()
+    paths = []
+    for i in range(100):
+        words = ['common'] + ['filler{}'.format(i * 20 + j) for j in range(20)] + (['rare'] * 3 if i < 3 else [])
+        if i < 3:
+            words = words[:2] + words[-3:]
+        paths.append(str(directory / 'doc{:03d}.txt'.format(i)))
+        with open(paths[-1], 'w', encoding='utf-8') as f:
+            f.write(' '.join(words))
+    collection = read_collection(str(tmp_path / 'index'), paths)
+    if not vectorized:
+        monkeypatch.setattr(collection_module, 'np', None)
+    elif collection_module.np is None:
+        pytest.skip('numpy is not installed')
+
+    fetched = []
+    for name in ('get_documents_L_d', 'get_documents_L_d_array'):
+        fetch = getattr(collection, name)
+        monkeypatch.setattr(collection, name, lambda docs, fetch=fetch: fetched.append(len(docs)) or fetch(docs))
+    results = collection.processquery_vector('rare common', above=0, top=2)
+    assert [location for location, _ in results] == ['doc000.txt', 'doc001.txt']
+    assert sum(fetched) == 3
+
+    monkeypatch.undo()
+    assert rounded(results) == rounded(collection.processquery_vector('rare common', above=0))[:2]
+
+
+@pytest.mark.parametrize('q', QUERIES)
+def test_iter_vector_pages_the_ranking(indexed, q):
+    collection, _ = indexed
+    results = rounded(collection.processquery_vector(q, above=0.1))
+    assert rounded(collection.iter_vector(q, above=0.1)) == results
+    assert rounded(collection.iter_vector(q, above=0.1, offset=3, limit=5)) == results[3:8]
+
+
+def test_deleted_documents_are_not_ranked(indexed):
+    collection, tokens = indexed
+    assert {location for location, _ in collection.processquery_vector('w1 w2', above=0)} <= set(tokens)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import pytest
+
+from collection import Collection
+from document import LocalDocument
+from querycache import QueryCache
+from server import SearchService, make_server
+from storage import LocalStorage
+
+
+def write(directory, name, text):
+    path = os.path.join(directory, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def add(index_directory, *paths):
+    """ Adds documents of paths to the index in index_directory, as another process would """
+    collection = Collection(storage=LocalStorage(index_directory))
+    collection.read_documents([LocalDocument(path) for path in paths])
+    collection.flush_to_mongo()
+    collection.close()
+
+
+@pytest.fixture
+def index(tmp_path):
+    """ Tuple (directory of documents, directory of index with apple.txt and banana.txt) """
+    documents = tmp_path / 'documents'
+    documents.mkdir()
+    index_directory = str(tmp_path / 'index')
+    add(index_directory, write(str(documents), 'apple.txt', 'apple pie with apple'),
+        write(str(documents), 'banana.txt', 'banana split'))
+    return str(documents), index_directory
+
+
+@pytest.fixture
+def service(index):
+    opened = []
+
+    def open_collection():
+        opened.append(Collection(storage=LocalStorage(index[1])))
+        return opened[-1]
+
+    service = SearchService(open_collection, QueryCache())
+    service.opened = opened
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def base_url(service):
+    server = make_server(service, port=0, threads=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def get(url, path, **params):
+    """ :return: tuple (status, JSON answer) of a GET request """
+    try:
+        with urlopen(url + path + ('?' + urlencode(params) if params else ''), timeout=10) as response:
+            return response.status, json.loads(response.read().decode('utf-8'))
+    except HTTPError as e:
+        return e.code, json.loads(e.read().decode('utf-8'))
+
+
+def closed(collection):
+    return all(segment.postings.closed for segment in collection.storage.segments)
+
+
+def test_search_over_http(base_url):
+    status, ans = get(base_url, '/search', q='apple')
+    assert status == 200 and [location for location, _ in ans['results']] == ['apple.txt']
+    status, ans = get(base_url, '/search', q='apple or banana', model='boolean', limit=1, offset=1)
+    assert status == 200 and len(ans['results']) == 1
+
+    assert get(base_url, '/search', q='apple')[1] == get(base_url, '/search', q='apple')[1]
+    status, ans = get(base_url, '/stats')
+    assert status == 200 and ans['query_cache']['hits'] >= 1
+    assert get(base_url, '/health') == (200, {'status': 'ok', 'generation': 1})
+
+
+def test_errors_over_http(base_url):
+    assert get(base_url, '/search', q='cherry')[0] == 400
+    assert get(base_url, '/search')[0] == 400
+    assert get(base_url, '/search', q='apple', model='other')[0] == 400
+    assert get(base_url, '/missing')[0] == 404
+
+
+def test_collection_is_reopened_and_closed_after_write(index, service):
+    documents, index_directory = index
+    old = service.get_collection()
+    add(index_directory, write(documents, 'cherry.txt', 'cherry pie'))
+
+    assert [location for location, _ in service.search('vector', 'pie')] == ['cherry.txt', 'apple.txt']
+    assert len(service.opened) == 2 and service.get_collection() is service.opened[1]
+    assert closed(old) and not closed(service.opened[1])
+
+
+def test_collection_in_use_is_closed_by_its_last_query(index, service):
+    documents, index_directory = index
+    old = service._acquire()
+    add(index_directory, write(documents, 'cherry.txt', 'cherry pie'))
+
+    assert service.get_collection() is not old
+    # A query still runs on the replaced collection
+    assert not closed(old)
+    assert [location for location, _ in old.processquery_vector('apple')] == ['apple.txt']
+    service._release(old)
+    assert closed(old)
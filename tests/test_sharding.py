@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from collection import Collection
+from conftest import FLUSH_POSTINGS, read_collection
+from document import LocalDocument
+from sharding import ShardedCollection, shard_of
+from storage import LocalStorage
+
+SHARDS = 3
+
+QUERIES = ['w1', 'w2 w3', 'w1 w5 w9', 'w4 w4 w7', 'w11 w2 w30', 'w1 w2 w3 w6 w8']
+
+BOOLEAN_QUERIES = ['w1 and w2', 'w3 or w9', 'w2 and not w1', 'not w4']
+
+
+def rounded(results):
+    return [(location, round(similarity, 9)) for location, similarity in results]
+
+
+@pytest.fixture
+def collections(tmp_path, corpus):
+    """ Tuple (Collection, ShardedCollection) of the generated documents, with every tenth document deleted """
+    single = read_collection(str(tmp_path / 'single'), corpus)
+    sharded = ShardedCollection([Collection(storage=LocalStorage(str(tmp_path / 'shard{}'.format(i))),
+                                            flush_postings=FLUSH_POSTINGS) for i in range(SHARDS)])
+    sharded.read_documents([LocalDocument(path) for path in corpus])
+    sharded.flush_to_mongo()
+    for collection in (single, sharded):
+        for path in corpus[::10]:
+            collection.delete_document(os.path.basename(path))
+        collection.flush_to_mongo()
+    yield single, sharded
+    sharded.close()
+
+
+def test_documents_are_partitioned_by_location(collections):
+    single, sharded = collections
+    assert sharded.get_locations() == single.get_locations()
+    assert sharded.get_documents_count() == single.get_documents_count()
+    for i, shard in enumerate(sharded.shards):
+        locations = shard.get_locations()
+        assert locations and all(shard_of(location, SHARDS) == i for location in locations)
+
+
+@pytest.mark.parametrize('q', QUERIES)
+def test_vector_results_match_single_collection(collections, q):
+    single, sharded = collections
+    # Ties of similarity are ordered by document id, which differs between shards, so results are compared as sets
+    expected = rounded(single.processquery_vector(q, above=0))
+    assert sorted(rounded(sharded.processquery_vector(q, above=0))) == sorted(expected)
+    assert sorted(rounded(sharded.iter_vector(q, above=0))) == sorted(expected)
+    top = rounded(sharded.processquery_vector(q, above=0, top=5))
+    assert [similarity for _, similarity in top] == [similarity for _, similarity in expected[:5]]
+    assert set(top) <= set(expected)
+
+
+@pytest.mark.parametrize('q', BOOLEAN_QUERIES)
+def test_boolean_results_match_single_collection(collections, q):
+    single, sharded = collections
+    expected = {location for location, _ in single.processquery_boolean(q)}
+    assert {location for location, _ in sharded.processquery_boolean(q)} == expected
+    assert {location for location, _ in sharded.iter_boolean(q)} == expected
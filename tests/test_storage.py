@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+
+import pytest
+
+from collection import Collection
+from conftest import VOCABULARY, FLUSH_POSTINGS, generate_corpus, read_collection
+from document import LocalDocument
+from simhash import FingerprintIndex
+from storage import LocalStorage
+
+TERMS = ['w{}'.format(i) for i in range(1, VOCABULARY + 1)]
+
+QUERIES = ['w1', 'w2 w3', 'w1 w5 w9', 'w4 w4 w7', 'w1 w2 w3 w6 w8']
+
+def snapshot(storage):
+    """
+    :return: dict with everything that storage returns about its index and documents
+    """
+    terms_statistics = storage.get_terms_statistics(TERMS)
+    return {
+        'terms_statistics': terms_statistics,
+        'postings': {term: tuple(list(values) for values in storage.get_documents_for_term(term))
+                     for term in terms_statistics},
+        'index_count': storage.get_index_count(),
+        'documents_count': storage.get_documents_count(),
+        'document_ids': set(storage.get_document_ids()),
+        'deleted': set(storage.get_deleted_document_ids()),
+        'L_d': storage.get_documents_L_d(storage.get_document_ids()),
+        'locations': storage.get_locations(),
+        'metadata': dict(storage.get_documents_metadata()),
+        'duplicates': dict(storage.get_duplicates()),
+        'fingerprints': sorted(storage.get_fingerprints()),
+        'next_document_id': storage.get_next_document_id(),
+        'generation': storage.get_generation(),
+    }
+
+
+def scores(collection):
+    """ :return: list with dict {location: similarity} of results of each query """
+    return [{location: round(similarity, 9) for location, similarity in collection.processquery_vector(q, above=0)}
+            for q in QUERIES]
+
+
+def rewrite(paths, seed):
+    """ Writes other random words in files of paths """
+    rng = random.Random(seed)
+    for path in paths:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(' '.join('w{}'.format(rng.randint(1, 40)) for _ in range(rng.randint(5, 40))))
+
+
+def test_write_and_reopen_keeps_index(tmp_path, corpus):
+    directory = str(tmp_path / 'index')
+    root = os.path.dirname(corpus[0])
+    # Copies of documents, which are stored as their near-duplicates
+    for i in (5, 6):
+        shutil.copy(corpus[i], os.path.join(root, 'dup{:03d}.txt'.format(i)))
+    paths = sorted(os.path.join(root, name) for name in os.listdir(root))
+
+    collection = Collection(storage=LocalStorage(directory), flush_postings=FLUSH_POSTINGS,
+                            near_duplicates=FingerprintIndex())
+    counts = collection.sync_documents(LocalDocument(path, root) for path in paths)
+    assert counts['duplicates'] >= 2
+    for i in range(0, len(corpus), 15):
+        collection.delete_document(os.path.basename(corpus[i]))
+    collection.flush_to_mongo()
+
+    written = snapshot(collection.storage)
+    assert written['deleted'] and written['duplicates'] and written['metadata']
+    assert {'dup005.txt', 'dup006.txt'} <= set(written['duplicates'])
+    assert snapshot(LocalStorage(directory)) == written
+
+    collection.compact(full=True)
+    compacted = snapshot(collection.storage)
+    assert not compacted['deleted']
+    assert snapshot(LocalStorage(directory)) == compacted
+
+
+@pytest.mark.parametrize('limits', [{'flush_postings': 500, 'flush_bytes': 0},
+                                    {'flush_postings': 0, 'flush_bytes': 50000}])
+def test_flush_limits_split_writes(tmp_path, corpus, limits):
+    docs = [LocalDocument(path) for path in corpus]
+    whole = Collection(storage=LocalStorage(str(tmp_path / 'whole')), flush_postings=0, flush_bytes=0)
+    whole.read_documents(docs)
+    whole.flush_to_mongo()
+    split = Collection(storage=LocalStorage(str(tmp_path / 'split')), **limits)
+    split.read_documents(docs)
+    split.flush_to_mongo()
+
+    assert split.storage.get_generation() > whole.storage.get_generation() == 1
+    written, expected = snapshot(split.storage), snapshot(whole.storage)
+    del written['generation'], expected['generation']
+    assert written == expected
+
+
+def test_tombstones_and_compaction_keep_scores(tmp_path, corpus):
+    directory = str(tmp_path / 'index')
+    collection = read_collection(directory, corpus)
+
+    # Changed documents are stored again with new ids and missing documents are deleted
+    rewrite(corpus[:40:3], seed=11)
+    for path in corpus[1:60:7]:
+        os.remove(path)
+    paths = [path for path in corpus if os.path.exists(path)]
+    counts = collection.sync_documents((LocalDocument(path) for path in paths), delete_missing=True)
+    assert counts['changed'] and counts['deleted']
+    collection.flush_to_mongo()
+
+    fresh_directory = tmp_path / 'fresh'
+    fresh_corpus = tmp_path / 'fresh_corpus'
+    fresh_corpus.mkdir()
+    for path in paths:
+        shutil.copy(path, str(fresh_corpus))
+    expected = scores(read_collection(str(fresh_directory), sorted(str(p) for p in fresh_corpus.iterdir())))
+    assert all(expected)
+
+    assert collection.storage.get_deleted_document_ids()
+    assert scores(collection) == expected
+    collection.compact()
+    assert scores(collection) == expected
+    collection.compact(full=True)
+    assert scores(collection) == expected
+    assert scores(Collection(storage=LocalStorage(directory))) == expected
+
+
+def test_compact_merges_segments(tmp_path):
+    directory = str(tmp_path / 'index')
+    corpus = tmp_path / 'corpus'
+    corpus.mkdir()
+    collection = read_collection(directory, generate_corpus(str(corpus)))
+    storage = collection.storage
+    assert len(storage.segments) > 1
+
+    before = snapshot(storage)
+    collection.compact(full=True)
+    assert len(storage.segments) == 1
+    after = snapshot(storage)
+    assert after['postings'] == before['postings'] and after['terms_statistics'] == before['terms_statistics']
+    # Files of merged segments are removed
+    assert {name.split('.')[0] for name in os.listdir(directory) if name.startswith('seg') and '.' in name} == \
+        {storage.segments[0].name}
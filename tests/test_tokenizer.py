@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import io
+import os
+import random
+
+import pytest
+from stemming.porter2 import stem
+
+from document import RE_LINKS, RE_NONALPHABETIC, Tokenizer, stopwords, textpreprocess
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEXTS = [
+    '',
+    'The quick brown fox jumps over the lazy dog',
+    'Links http://example.com/a?b=c and https://x.y/z, then text.',
+    'xhttp://a.b yhttps text-with-hyphens snake_case_words',
+    'http://a.b/c.dhttp://e.f',
+    'Punctuation!!! everywhere?? (yes) [really] {ok} "quoted" \'single\'',
+    'Ünïcödé ΕΛΛΗΝΙΚΑ κείμενα καί straße 東京',
+    'THE And OR Not IS being Having',
+    'tabs\tand\nnewlines\r\nand nbsp separators',
+    '-- - -a- _ __init__ 3.14 1,000 x²',
+]
+
+# Characters of random texts: letters, digits, separators, punctuation and fragments of links
+ALPHABET = list('abcdeHTPS019 -_.,:/?\t\néα') + ['http', 'https', '://']
+
+
+def old_textpreprocess(text):
+    """ textpreprocess with regular expression substitutions and split, as it was before Tokenizer """
+    text = RE_LINKS.sub(' ', text)
+    text = RE_NONALPHABETIC.sub(' ', text)
+    return [stem(word.lower()) for word in text.split() if word.lower() not in stopwords]
+
+
+def repository_texts():
+    paths = glob.glob(os.path.join(REPOSITORY, 'documents', '*')) + \
+        glob.glob(os.path.join(REPOSITORY, 'documents_demo', '*'))
+    for path in sorted(paths):
+        with io.open(path, 'r', encoding='utf-8') as f:
+            yield f.read()
+
+
+def random_texts(count=500, seed=3):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 60)))
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_tokenize_matches_old_textpreprocess(text):
+    assert textpreprocess(text) == old_textpreprocess(text)
+
+
+def test_tokenize_matches_old_textpreprocess_on_documents():
+    texts = list(repository_texts())
+    assert texts
+    for text in texts:
+        assert textpreprocess(text) == old_textpreprocess(text)
+
+
+def test_tokenize_matches_old_textpreprocess_on_random_texts():
+    for text in random_texts():
+        assert textpreprocess(text) == old_textpreprocess(text), text
+
+
+def test_tokenize_many_and_cache_stats():
+    tokenizer = Tokenizer(cache_size=2)
+    assert tokenizer.tokenize_many(['running runs', 'running']) == [['run', 'run'], ['run']]
+    info = tokenizer.cache_stats()
+    assert info['maxsize'] == 2 and info['size'] == 2
+    assert info['hits'] + info['misses'] == 3